@@ -1,119 +1,253 @@
+import io
 import json
+import os
+import threading
+import uuid
 
+from flask import (Blueprint, Flask, current_app, g, render_template, request, redirect, session,
+                   stream_with_context, url_for)
+from werkzeug.utils import secure_filename
 from pymongo import MongoClient
-import pymongo
-from flask import Flask, render_template, request, redirect, url_for
 import chess
-from chess import pgn
-from werkzeug.contrib.profiler import ProfilerMiddleware
 
-from explorer import Explorer, Trainer
-
-DEBUG = False
-
-explorer = Explorer("user")
-trainer = Trainer("user")
-
-app = Flask(__name__)
-board = chess.Board()
-
-@app.route("/")
+import metrics
+import handlers
+from explorer import PgnExporter, PositionCache
+from sessions import SessionPool, SessionStore
+from storage import create_client, open_storage
+
+DEFAULT_CONFIG = {
+    "DEBUG": False,
+    # "mongodb", "sqlite:<directory>" or "memory", see storage.create_client
+    "STORAGE": os.environ.get("STORAGE", "mongodb"),
+    "MONGO_URI": os.environ.get("MONGO_URI", "mongodb://localhost:27017"),
+    "MONGO_MAX_POOL_SIZE": 50,
+    "MONGO_CONNECT_TIMEOUT_MS": 5000,
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": 5000,
+    "MONGO_SOCKET_TIMEOUT_MS": 30000,
+    # db of the repertoire
+    "USER": "user",
+    # One of explorer.FLUSH_POLICIES, when review updates are written to the db
+    "FLUSH_POLICY": "batched",
+    # Requests taking longer (in seconds) are logged with their db queries
+    "SLOW_REQUEST": 1.,
+    # Sessions kept in memory by every worker and seconds until an idle session is evicted
+    "MAX_SESSIONS": 64,
+    "MAX_IDLE": 30*60,
+    # Positions in the cache of legal moves and expected answers (about 4 KB each)
+    "POSITION_CACHE_SIZE": 4096,
+    # Create the indexes with the first request
+    "ENSURE_INDEXES": True,
+    # Has to be the same for all workers, otherwise the session cookies are not accepted
+    "SECRET_KEY": os.environ.get("SECRET_KEY"),
+}
+
+routes = Blueprint("app", __name__)
+
+
+def create_app(config=None):
+    """Create the flask app, config overrides DEFAULT_CONFIG.
+    The db is not contacted until the first request: the MongoClient connects lazily,
+    Explorer and Trainer are created with the first request of a session.
+    Sessions are only shared between workers with mongodb.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    if config is not None:
+        app.config.from_mapping(config)
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = os.urandom(24)
+
+    # The listener has to be registered before the client is created
+    metrics.register_mongo_listener()
+    if app.config["STORAGE"] == "mongodb":
+        client = MongoClient(app.config["MONGO_URI"],
+                             connect=False,
+                             maxPoolSize=app.config["MONGO_MAX_POOL_SIZE"],
+                             connectTimeoutMS=app.config["MONGO_CONNECT_TIMEOUT_MS"],
+                             serverSelectionTimeoutMS=app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+                             socketTimeoutMS=app.config["MONGO_SOCKET_TIMEOUT_MS"])
+        store = SessionStore(client[app.config["USER"]].sessions)
+    else:
+        client = create_client(app.config["STORAGE"])
+        store = None
+    app.extensions["storage"] = client
+    app.extensions["position_cache"] = PositionCache(app.config["POSITION_CACHE_SIZE"])
+    app.extensions["sessions"] = SessionPool(app.config["USER"], client, app.config["FLUSH_POLICY"],
+                                             app.config["MAX_SESSIONS"], app.config["MAX_IDLE"], store,
+                                             app.extensions["position_cache"])
+
+    indexed = threading.Event()
+    indexing = threading.Lock()
+
+    def setup():
+        """Create the indexes once, the repertoire queries rely on them."""
+        if indexed.is_set():
+            return
+        with indexing:
+            if not indexed.is_set():
+                open_storage(client, app.config["USER"]).ensure_indexes()
+                if store is not None:
+                    store.ensure_indexes()
+                indexed.set()
+
+    app.extensions["ensure_indexes"] = setup
+    if app.config["ENSURE_INDEXES"]:
+        app.before_request(setup)
+
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        """Create the indexes of the db."""
+        setup()
+
+    metrics.init_app(app, app.config["SLOW_REQUEST"])
+    app.register_blueprint(routes)
+    return app
+
+
+def current_session():
+    """The Explorer and Trainer of the session of the request."""
+    if "session" not in g:
+        if "id" not in session:
+            session["id"] = uuid.uuid4().hex
+        g.session = current_app.extensions["sessions"].acquire(session["id"])
+    return g.session
+
+
+@routes.teardown_app_request
+def release_session(exception):
+    current = g.pop("session", None)
+    if current is not None:
+        current_app.extensions["sessions"].release(current)
+
+@routes.route("/")
 def main():
-    return redirect(url_for('repertoire'))
+    return redirect(url_for('.repertoire'))
 
 
-@app.route("/repertoire")
+@routes.route("/repertoire")
 def repertoire():
     return render_template('index.html')
 
-@app.route("/opening", methods=['POST'])
+@routes.route("/opening", methods=['POST'])
 def opening():
-    db = explorer.db
+    current = current_session()
+    explorer, trainer = current.explorer, current.trainer
 
     if "opening" in request.form:
         explorer.opening = {"name": request.form["opening"], "color": request.form["color"]}
         trainer.change_opening(explorer.opening)
-        return json.dumps(explorer.candidate_moves)
+        result = explorer.candidate_moves
+        result["opening"] = explorer.opening
+        result["board"] = explorer.board.board_id
+        return json.dumps(result)
     elif "remove" in request.form:
         explorer.remove_opening(request.form["remove"], request.form["color"])
         trainer.change_opening(-1)
     elif "name" in request.form:
-        form_name = request.form["name"]
-        form_color = request.form["color"]
+        explorer.add_opening(request.form["name"], request.form["color"])
 
-        exists = db["opening"].find_one({"name": form_name, "color": form_color})
-        if not exists:
-            new_id = db.opening.find_one(sort=[("id", pymongo.DESCENDING)])
-            new_id = new_id["id"] + 1
-            db["opening"].insert_one({"name": form_name, "color": form_color, "id": new_id})
+    return json.dumps(explorer.openings())
 
-    white = db["opening"].find({"color": "White"})
-    black = db["opening"].find({"color": "Black"})
-    result = dict()
-    result["white"] = [o["name"] for o in white]
-    result["black"] = [o["name"] for o in black]
-    return json.dumps(result)
-
-@app.route("/training", methods=['GET'])
+@routes.route("/training", methods=['GET'])
 def training():
     return render_template('training.html')
 
-@app.route("/positions", methods=['POST'])
+@routes.route("/positions", methods=['POST'])
 def positions():
-    if "load" in request.form:
-        if request.form["load"] == "random":
-            board, move = trainer.random_position()
-            return json.dumps((board["fen"], move["move"]))
-        elif request.form["load"] == "full":
-            trainer.complete_opening()
-            board, move = trainer.next()
-            return json.dumps((board.fen, move.uci))
-        elif request.form["load"] == "next":
-            board, move = trainer.next()
-            if board is None or move is None:
-                return json.dumps("finished")
-            return json.dumps((board.fen, move.uci))
-    elif "performance" in request.form:
-        if request.form["performance"] == "wrong":
-            trainer.update_move_performance(False)
-        elif request.form["performance"] == "correct":
-            trainer.update_move_performance()
-    return ""
-
-@app.route("/moves",  methods=['POST'])
+    return handlers.positions(current_session().trainer, request.form)
+
+@routes.route("/forecast", methods=['POST'])
+def forecast():
+    """Review statistics and forecast of the active training opening."""
+    return handlers.forecast(current_session().trainer, request.form)
+
+@routes.route("/openings/<int:opening>/tree", methods=['GET'])
+def opening_tree(opening):
+    """All positions and moves of the opening below root (at most depth moves deep),
+    so the board can be navigated without a request per move.
+    Supports conditional requests, the ETag changes with the revision of the opening.
+    """
+    root = request.args.get("root", 0, type=int)
+    depth = request.args.get("depth", None, type=int)
+    explorer = current_session().explorer
+    revision = explorer.revision(opening)
+    etag = "{0}-{1}-{2}-{3}".format(opening, revision, root, depth)
+    if etag in request.if_none_match:
+        return "", 304
+
+    result = explorer.tree(opening, root, depth)
+    result["revision"] = revision
+    response = current_app.response_class(json.dumps(result), mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@routes.route("/openings/<int:opening>/pgn", methods=['GET'])
+def export_pgn(opening):
+    """The opening as pgn file, streamed while it is generated.
+    Does not use the session, so a long download does not block its requests."""
+    db = open_storage(current_app.extensions["storage"], current_app.config["USER"])
+    document = db.find_opening(id=opening)
+    if document is None:
+        return json.dumps({"error": "Opening not found"}), 404
+    exporter = PgnExporter(db, document)
+    response = current_app.response_class(stream_with_context(exporter.chunks()),
+                                          mimetype="application/x-chess-pgn")
+    filename = secure_filename(document["name"]) or "opening"
+    response.headers["Content-Disposition"] = 'attachment; filename="{0}.pgn"'.format(filename)
+    return response
+
+@routes.route("/moves",  methods=['POST'])
 def moves():
+    explorer = current_session().explorer
     result = dict()
     if "previous" in request.form:
         explorer.previous()
-        result["candidates"] = explorer.candidate_moves
-        return json.dumps(result)
     elif "next" in request.form:
-        notation = explorer.next()
-        result["move"] = notation
-        result["candidates"] = explorer.candidate_moves
-        return json.dumps(result)
+        result["move"] = explorer.next()
     elif "remove" in request.form:
-        explorer.remove_last_move()
-        result["candidates"] = explorer.candidate_moves
-        return json.dumps(result)
+        if "board" in request.form:
+            explorer.remove_move(int(request.form["board"]), request.form["move"])
+        else:
+            explorer.remove_last_move()
     elif ("new[source]" in request.form and
           "new[target]" in request.form):
+        if "board" in request.form:
+            explorer.goto(int(request.form["board"]))
         source = request.form.get("new[source]")
         target = request.form.get("new[target]")
         move = chess.Move.from_uci(source+target)
-        notation = explorer.push(move)    
-        result["move"] = notation
-        result["candidates"] = explorer.candidate_moves
+        result["move"] = explorer.push(move)
+    else:
         return json.dumps(result)
+    result["board"] = explorer.board.board_id
+    result["candidates"] = explorer.candidate_moves
+    return json.dumps(result)
 
-def import_pgn(pgn_file):
-    with open(pgn_file) as pgn_f:
-        game = pgn.read_game(pgn_f)
-    return game
+@routes.route("/import", methods=['POST'])
+def import_pgn():
+    """Import every game of the uploaded pgn file into the opening."""
+    explorer = current_session().explorer
+    opening = explorer.db.find_opening(request.form["opening"], request.form["color"])
+    if not opening:
+        return json.dumps({"error": "Opening not found"}), 404
+    try:
+        batch_size = int(request.form.get("batch_size", 1000))
+    except ValueError:
+        batch_size = 0
+    if batch_size < 1:
+        return json.dumps({"error": "batch_size must be a positive integer"}), 400
+    pgn_file = io.TextIOWrapper(request.files["pgn"].stream, encoding="utf-8", errors="replace")
+    stats = explorer.import_pgn(pgn_file, opening["id"], batch_size)
+    return json.dumps(stats)
+
+@routes.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """Request, db and function latencies in the Prometheus text format."""
+    return current_app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+app = create_app()
 
 if __name__ == "__main__":
-    if DEBUG:
-        app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
-        app.run(debug=True)
-    else:
-        app.run()
+    app.run(debug=app.config["DEBUG"])
@@ -0,0 +1,230 @@
+"""Asyncio serving mode of the app.
+
+app is an ASGI application, e.g. run it with an ASGI server: uvicorn asgi:app
+The training requests (/positions, /forecast) bypass flask: they are answered
+by the functions of the handlers module, which the flask routes use as well,
+in a bounded thread pool and the positions of the opening in a complete
+training are queried concurrently on the event loop.
+All other routes are served by the flask app, which runs in the same pool
+and reads the request body as it arrives (e.g. a pgn upload).
+Sessions, config and metrics are shared with the flask app.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from itsdangerous import BadSignature
+
+import metrics
+import handlers
+from app import create_app
+from storage import offload
+
+# Threads running the db calls and the flask routes
+WORKERS = 32
+
+# Longest body (in bytes) of the training requests, which are read before they are answered
+MAX_FORM_SIZE = 64*1024
+
+
+class RequestBody(io.RawIOBase):
+    """wsgi.input of an ASGI request, the body messages are received from
+    the event loop when the flask app in a pool thread reads them."""
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self._chunk = b""
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            self._chunk = message.get("body", b"")
+            self._more_body = message.get("more_body", False)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+class AsgiApp:
+    """ASGI application serving the flask app, the training routes natively."""
+    def __init__(self, flask_app, workers=WORKERS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="asgi")
+        self.routes = {("POST", "/positions"): self.positions,
+                       ("POST", "/forecast"): self.forecast}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            handler = self.routes.get((scope["method"], scope["path"]))
+            session_id = self._session_id(scope) if handler is not None else None
+            if session_id is None:
+                # New sessions get their cookie from flask
+                await self._wsgi(scope, receive, send)
+            else:
+                await self._native(handler, scope, session_id, receive, send)
+
+    async def positions(self, session, form):
+        """handlers.positions in the pool, the complete training
+        queries the positions of the opening concurrently."""
+        if form.get("load") == "full":
+            await session.trainer.complete_opening_async(self.executor)
+            form = dict(form, load="next")
+        return await offload(self.executor, handlers.positions, session.trainer, form)
+
+    async def forecast(self, session, form):
+        return await offload(self.executor, handlers.forecast, session.trainer, form)
+
+    async def _native(self, handler, scope, session_id, receive, send):
+        pool = self.flask_app.extensions["sessions"]
+        metrics.start_request()
+        status = 500
+        try:
+            body = await self._read_body(receive, MAX_FORM_SIZE)
+            if body is None:
+                status = 413
+                await self._respond(send, status, [(b"content-type", b"text/plain")], b"Request Entity Too Large")
+                return
+            await offload(self.executor, self.flask_app.extensions["ensure_indexes"])
+            session = await offload(self.executor, pool.acquire, session_id)
+            try:
+                result = await handler(session, dict(parse_qsl(body.decode("utf-8"))))
+            finally:
+                await offload(self.executor, pool.release, session)
+            status = 200
+            await self._respond(send, status, [(b"content-type", b"text/html; charset=utf-8")],
+                                result.encode("utf-8"))
+        except Exception:
+            self.flask_app.logger.exception("Exception on %s [%s]", scope["path"], scope["method"])
+            await self._respond(send, status, [(b"content-type", b"text/plain")], b"Internal Server Error")
+        finally:
+            metrics.end_request(scope["path"], scope["method"], status,
+                                self.flask_app.config["SLOW_REQUEST"])
+
+    def _session_id(self, scope):
+        """The session id of the flask session cookie, None if there is no valid one."""
+        name = self.flask_app.config["SESSION_COOKIE_NAME"].encode("latin-1")
+        for key, value in scope["headers"]:
+            if key != b"cookie":
+                continue
+            for cookie in value.split(b";"):
+                cookie_name, _, cookie_value = cookie.strip().partition(b"=")
+                if cookie_name != name:
+                    continue
+                serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+                try:
+                    return serializer.loads(cookie_value.decode("latin-1")).get("id")
+                except BadSignature:
+                    return None
+        return None
+
+    async def _wsgi(self, scope, receive, send):
+        """Run the flask app in the pool, the request body is read
+        and the response is sent chunk by chunk."""
+        started = dict()
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(key.lower().encode("latin-1"), value.encode("latin-1"))
+                                  for key, value in headers]
+
+        environ = self._environ(scope, io.BufferedReader(RequestBody(receive, asyncio.get_running_loop())))
+        iterable = await offload(self.executor, self.flask_app.wsgi_app, environ, start_response)
+        try:
+            chunks = iter(iterable)
+            chunk = await offload(self.executor, next, chunks, None)
+            await send({"type": "http.response.start", "status": started["status"],
+                        "headers": started["headers"]})
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await offload(self.executor, next, chunks, None)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(iterable, "close"):
+                await offload(self.executor, iterable.close)
+
+    @staticmethod
+    def _environ(scope, body):
+        """The WSGI environ of the request, body is the file object of its body."""
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            # The body ends with the last message, also without a content length
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        if scope.get("client"):
+            environ["REMOTE_ADDR"] = scope["client"][0]
+        for key, value in scope["headers"]:
+            key = key.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            else:
+                key = "HTTP_" + key
+                environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    @staticmethod
+    async def _read_body(receive, limit):
+        """The whole body of the request, None if it is longer than limit bytes."""
+        body = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            size += len(body[-1])
+            if size > limit:
+                return None
+            more_body = message.get("more_body", False)
+        return b"".join(body)
+
+    @staticmethod
+    async def _respond(send, status, headers, body):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Write the buffered review updates of all sessions
+                await offload(self.executor, self.flask_app.extensions["sessions"].close)
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_asgi_app(config=None, workers=None):
+    """ASGI application of create_app(config), workers threads run the blocking calls."""
+    if workers is None:
+        workers = int(os.environ.get("ASGI_WORKERS", WORKERS))
+    return AsgiApp(create_app(config), workers)
+
+
+app = create_asgi_app()
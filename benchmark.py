@@ -0,0 +1,269 @@
+"""Benchmarks of the Explorer and Trainer on synthetic repertoires.
+
+The repertoire is generated into a throwaway db of any storage backend
+(mongod, sqlite or in memory). The results are written as json, so runs of
+different commits can be compared.
+
+Usage: python benchmark.py [--positions 1000] [--depth 20] [--branching 3]
+                           [--transpositions 0.1] [--repeat 20] [--seed 0]
+                           [--storage URI] [--output results.json]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import chess
+
+import explorer
+from explorer import Explorer, Trainer, position_hash
+from storage import create_client, open_storage
+
+OPENING = {"name": "Benchmark", "color": "White"}
+# Number of lines in a row without a new position, after which the generator gives up
+MAX_STALLED_LINES = 1000
+
+
+def generate_repertoire(db, positions=1000, depth=20, branching=3, transpositions=0.1,
+                        reviewed=0.5, seed=0, batch_size=1000):
+    """Write a synthetic opening (id 0) with about positions positions into the db.
+    The opening is built from lines (move sequences) of at most depth moves.
+    A new line either continues an existing line from a random position with
+    random legal moves (at most branching different moves per position),
+    or plays an existing line with two moves of the same side swapped, which reaches
+    the same position by another move order. Lines are swapped as long as less than
+    the fraction transpositions of all moves lead to an already known position.
+    A fraction (reviewed) of the moves gets a random review state.
+
+    Returns:
+        dict: number of generated positions, moves and transpositions
+
+    Raises:
+        ValueError: if depth and branching do not allow positions positions,
+                    i.e. MAX_STALLED_LINES lines in a row found no new position
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    db.insert_opening({"name": OPENING["name"], "color": OPENING["color"], "id": 0})
+
+    start = chess.Board()
+    known = {position_hash(start): 0}
+    children = dict()
+    lines = []
+    position_docs = [{"fen": start.fen(), "BoardId": 0, "hash": position_hash(start)}]
+    move_docs = []
+    stats = {"positions": 1, "moves": 0, "transpositions": 0}
+
+    def add_move(board, board_id, move):
+        """Play the move on board and store it, returns the BoardId of the new position."""
+        uci = move.uci()
+        san = board.san(move)
+        board.push(move)
+        key = position_hash(board)
+        if key not in known:
+            known[key] = stats["positions"]
+            position_docs.append({"fen": board.fen(), "BoardId": known[key], "hash": key})
+            stats["positions"] += 1
+        elif uci not in children.get(board_id, ()):
+            stats["transpositions"] += 1
+        if uci not in children.setdefault(board_id, set()):
+            children[board_id].add(uci)
+            move_docs.append(move_document(board_id, known[key], uci, san, board.turn))
+        return known[key]
+
+    def move_document(board_start, board_end, uci, san, color):
+        document = {"board_start": board_start, "board_end": board_end,
+                    "move": uci, "san": san, "color": color, "opening": [0]}
+        if rng.random() < reviewed:
+            days = rng.randint(1, 30)
+            document["difficulty"] = rng.random()
+            document["days_between_reviews"] = days
+            document["date_last_reviewed"] = now - timedelta(days=rng.uniform(0, 2*days))
+            document["date_due"] = document["date_last_reviewed"] + timedelta(days=days)
+        stats["moves"] += 1
+        return document
+
+    def play(line, extend):
+        """Play the line from the start, extend it with random moves up to depth."""
+        board = chess.Board()
+        board_id = 0
+        played = []
+        for move in line:
+            if move not in board.legal_moves:
+                return played
+            board_id = add_move(board, board_id, move)
+            played.append(move)
+        while extend and len(played) < depth and stats["positions"] < positions:
+            legal = list(board.legal_moves)
+            if not legal:
+                break
+            existing = [move for move in legal if move.uci() in children.get(board_id, ())]
+            if len(existing) >= branching:
+                move = rng.choice(existing)
+            else:
+                move = rng.choice(legal)
+            board_id = add_move(board, board_id, move)
+            played.append(move)
+        return played
+
+    stalled = 0
+    while stats["positions"] < positions:
+        if stalled >= MAX_STALLED_LINES:
+            raise ValueError("Found only {0} of {1} positions with depth {2} and branching {3}".format(
+                stats["positions"], positions, depth, branching))
+        found_positions = stats["positions"]
+        line = rng.choice(lines) if lines else []
+        transposed = False
+        attempts = 0
+        while (not transposed and attempts < 10 and len(line) >= 3 and
+               stats["transpositions"] < transpositions*stats["moves"]):
+            i = rng.randrange(len(line)-2)
+            j = rng.randrange(i+2, len(line), 2)
+            swapped = list(line[:j+1])
+            swapped[i], swapped[j] = swapped[j], swapped[i]
+            found = stats["transpositions"]
+            play(swapped, extend=False)
+            transposed = stats["transpositions"] > found
+            attempts += 1
+        if not transposed:
+            lines.append(play(line[:rng.randrange(len(line)+1)], extend=True))
+        stalled = stalled + 1 if stats["positions"] == found_positions else 0
+
+        if len(position_docs) >= batch_size:
+            db.insert_positions(position_docs)
+            del position_docs[:]
+        if len(move_docs) >= batch_size:
+            db.insert_moves(move_docs)
+            del move_docs[:]
+    if position_docs:
+        db.insert_positions(position_docs)
+    if move_docs:
+        db.insert_moves(move_docs)
+    return stats
+
+
+def measure(function, repeat):
+    """Call function repeat times, returns the durations in seconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations):
+    return {"runs": len(durations),
+            "min": min(durations),
+            "median": statistics.median(durations),
+            "mean": statistics.mean(durations),
+            "max": max(durations)}
+
+
+def run(client, user, repeat=20, seed=0, **generator):
+    """Generate the repertoire into client[user] and run all benchmarks on it."""
+    rng = random.Random(seed)
+    results = dict()
+    db = open_storage(client, user)
+
+    start = time.perf_counter()
+    results["generated"] = generate_repertoire(db, seed=seed, **generator)
+    results["generate"] = time.perf_counter() - start
+    db.ensure_indexes()
+
+    timings = dict()
+    timings["Explorer.__init__"] = measure(lambda: Explorer(user, client=client), 1)
+    exp = Explorer(user, client=client)
+    exp.opening = OPENING
+    board_ids = sorted(exp.repertoire.positions)
+
+    def candidate_moves():
+        exp.goto(rng.choice(board_ids))
+        return exp.candidate_moves
+    timings["Explorer.candidate_moves"] = measure(candidate_moves, repeat)
+
+    def push():
+        board_id = rng.choice(board_ids)
+        exp.goto(board_id)
+        move = rng.choice(list(exp.repertoire.boards.get(board_id).legal_moves))
+        exp.push(move)
+    timings["Explorer.push"] = measure(push, repeat)
+
+    trainer = Trainer(user, "batched", client=client)
+    trainer.change_opening(0)
+
+    def complete_opening_cold():
+        explorer.variation_trees.invalidate(trainer.db, 0)
+        trainer.complete_opening()
+    timings["Trainer.complete_opening (cold)"] = measure(complete_opening_cold, max(1, repeat//10))
+    timings["Trainer.complete_opening (warm)"] = measure(trainer.complete_opening, repeat)
+
+    trainer.complete_opening()
+    timings["Trainer.next"] = measure(trainer.next, repeat)
+
+    def answer():
+        if trainer.next()[1] is not None:
+            trainer.update_move_performance(rng.random() < 0.8)
+    timings["Trainer.update_move_performance"] = measure(answer, repeat)
+    timings["PerformanceBuffer.flush"] = measure(trainer.end_session, 1)
+
+    timings["Trainer.random_position"] = measure(trainer.random_position, repeat)
+    timings["Trainer.random_position (weighted)"] = measure(lambda: trainer.random_position(True), repeat)
+
+    timings["Explorer.remove_opening"] = measure(lambda: exp.remove_opening(OPENING["name"], OPENING["color"]), 1)
+
+    results["timings"] = dict((name, summarize(durations)) for name, durations in timings.items())
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--positions", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=20)
+    parser.add_argument("--branching", type=int, default=3)
+    parser.add_argument("--transpositions", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", default="mongodb://localhost:27017",
+                        help="mongodb uri, sqlite:<directory> or memory; a throwaway db is created and dropped")
+    parser.add_argument("--output", help="json file for the results (default: stdout)")
+    args = parser.parse_args(argv)
+
+    client = create_client(args.storage)
+    user = "benchmark_{0}".format(os.getpid())
+
+    try:
+        results = run(client, user, repeat=args.repeat, seed=args.seed,
+                      positions=args.positions, depth=args.depth,
+                      branching=args.branching, transpositions=args.transpositions)
+    finally:
+        client.drop_database(user)
+
+    results["commit"] = _commit()
+    results["date"] = datetime.now().isoformat()
+    results["backend"] = args.storage.split(":")[0]
+    results["parameters"] = vars(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,24 @@
+import asyncio
+import atexit
+import bisect
+import heapq
+import itertools
 import random
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-import pymongo
-from pymongo import MongoClient
-
 import chess
+import chess.polyglot
 from chess import pgn
 
+import metrics
+import scheduling
+from storage import AsyncStorage, DuplicatePositionError, offload, open_storage
+
 
 class OpeningTrainerError(Exception):
     """Base class for exceptions in this module."""
@@ -24,11 +36,35 @@ class OpeningNotFoundError(OpeningTrainerError):
         self.message = message
 
 
+def position_hash(board):
+    """Polyglot zobrist hash of the chess.Board as signed 64 bit integer,
+    so it can be stored by mongodb. Move counters are not part of the hash,
+    the same position reached by another move order has the same hash.
+    """
+    key = chess.polyglot.zobrist_hash(board)
+    if key >= 1 << 63:
+        key -= 1 << 64
+    return key
+
+
 class BoardNode:
-    def __init__(self, fen, board_id):
+    __slots__ = ("fen", "board_id", "_hash")
+
+    def __init__(self, fen, board_id, hash=None):
         self.fen = fen
         self.board_id = board_id
-        self.color = fen.split(" ")[1]
+        self._hash = hash
+
+    @property
+    def color(self):
+        """Side to move, "w" or "b"."""
+        return self.fen[self.fen.index(" ")+1]
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = position_hash(chess.Board(self.fen))
+        return self._hash
 
     def next(self, move):
         pass
@@ -37,90 +73,100 @@ class BoardNode:
         find = {"board_start": self.board_id}
         if not opening is None:
             find["opening"] = opening
-        moves = db.moves.find(find)
-        return Move.from_mongodb(moves)
+        return Move.from_mongodb(db.find_moves(fields=Move.FIELDS, **find))
 
     @staticmethod
     def from_mongodb(positions):
         for pos in positions:
-            yield BoardNode(pos["fen"], pos["BoardId"])
+            yield BoardNode(pos["fen"], pos["BoardId"], pos.get("hash"))
 
     def __repr__(self):
         return "BoardNode({0},id: {1}, to move: {2})".format(self.fen, self.board_id, self.color)
 
 
 class Move:
-    def __init__(self, uci, from_id, to_id, opening=[], difficulty=0.3, date_last_reviewed=None, days_between_reviews=3, **kwargs):
+    """A move of the repertoire and its review state.
+    The review state is kept as read from the db, dates and intervals
+    are only converted when they are used.
+    """
+    __slots__ = ("uci", "san", "from_id", "to_id", "opening", "doc_id",
+                 "_difficulty", "_date_last_reviewed", "_days_between_reviews")
+
+    # Fields of the move documents, which are needed to create Moves
+    FIELDS = ("move", "board_start", "board_end", "opening", "san",
+              "difficulty", "date_last_reviewed", "days_between_reviews")
+
+    def __init__(self, uci, from_id, to_id, opening=None, difficulty=0.3, date_last_reviewed=None,
+                 days_between_reviews=3, san=None, doc_id=None):
         self.uci = uci
+        self.san = san
         self.from_id = from_id
         self.to_id = to_id
+        if opening is None:
+            opening = []
+        elif not isinstance(opening, list):
+            opening = list(opening)
         self.opening = opening
+        self.doc_id = doc_id
         self._difficulty = difficulty
-        self._days_between_reviews = timedelta(days=days_between_reviews)
-        if not isinstance(self.opening, list):
-            self.opening = list(self.opening)
-
-        if isinstance(date_last_reviewed, datetime):
-            self._date_last_reviewed = date_last_reviewed
-        elif isinstance(date_last_reviewed, int):
-            self._date_last_reviewed = datetime.fromtimestamp(date_last_reviewed)
-        else:
-            self._date_last_reviewed = date_last_reviewed
-
-        if self._date_last_reviewed is None:
-            self._review_possible = True
-        elif ((self._date_last_reviewed + self._days_between_reviews) <
-               datetime.now()):
-            self._review_possible = True
-        else:
-            self._review_possible = False
+        self._date_last_reviewed = date_last_reviewed
+        self._days_between_reviews = days_between_reviews
 
     @staticmethod
     def from_mongodb(query_result):
         for move in query_result:
-            m = move.pop("move")
-            board_start = move.pop("board_start")
-            board_end = move.pop("board_end")
-            opening = move.pop("opening")
-            yield Move(m,
-                       board_start,
-                       board_end,
-                       opening,
-                       **move)
-
-    def execute(self, db):
-        pos = db.positions.find({"BoardId": self.to_id})
-        return next(BoardNode.from_mongodb(pos))
-
-    def undo(self, db):
-        pos = db.positions.find({"BoardId": self.from_id})
-        return next(BoardNode.from_mongodb(pos))
+            yield Move(move["move"],
+                       move["board_start"],
+                       move["board_end"],
+                       move.get("opening"),
+                       move.get("difficulty", 0.3),
+                       move.get("date_last_reviewed"),
+                       move.get("days_between_reviews", 3),
+                       move.get("san"),
+                       move.get("_id"))
+
+    def execute(self, repertoire):
+        return repertoire.position(self.to_id)
+
+    def undo(self, repertoire):
+        return repertoire.position(self.from_id)
 
     def update_performance(self, difficulty, date_last_reviewed, days_between_reviews, db=None):
-        if self._review_possible:
+        if self.needs_review:
             self._difficulty = difficulty
             self._date_last_reviewed = date_last_reviewed
-            self._days_between_reviews = days_between_reviews
-            if db:
-                db.moves.update({"board_start": self.from_id,
-                                 "board_end": self.to_id},
-                                {"$set": {"difficulty": self.difficulty,
-                                          "date_last_reviewed": self.date_last_reviewed,
-                                          "days_between_reviews": self.days_between_reviews.days}})
-            self._review_possible = False
+            self._days_between_reviews = days_between_reviews.total_seconds()/scheduling.SECONDS_PER_DAY
+            if db is not None:
+                db.update_moves([self.performance_update()])
             return True
         else:
             print("Move note ready for review.")
             return False
 
+    def performance_update(self):
+        """Return the (filter, fields) update, which stores the review state of the move."""
+        if self.doc_id is not None:
+            find = {"_id": self.doc_id}
+        else:
+            find = {"board_start": self.from_id, "board_end": self.to_id}
+        return (find, {"difficulty": self.difficulty,
+                       "date_last_reviewed": self.date_last_reviewed,
+                       "days_between_reviews": self._days_between_reviews,
+                       "date_due": self.date_due})
+
     @property
     def needs_review(self):
-        if self._date_last_reviewed is None:
-            return True
-        elif (self._date_last_reviewed + self._days_between_reviews)<datetime.now():
-            return True
-        else:
-            return False
+        date_due = self.date_due
+        return date_due is None or date_due < datetime.now()
+
+    @property
+    def date_due(self):
+        """Date from which on the move should be reviewed again,
+        None if it was never reviewed."""
+        date_last_reviewed = self.date_last_reviewed
+        if date_last_reviewed is None:
+            return None
+        return date_last_reviewed + self.days_between_reviews
 
     @property
     def difficulty(self):
@@ -128,11 +174,13 @@ class Move:
 
     @property
     def date_last_reviewed(self):
+        if isinstance(self._date_last_reviewed, int):
+            return datetime.fromtimestamp(self._date_last_reviewed)
         return self._date_last_reviewed
 
     @property
     def days_between_reviews(self):
-        return self._days_between_reviews
+        return timedelta(days=self._days_between_reviews)
 
     def __repr__(self):
         return "Move({0},from: {1}, to: {2}, opening: {3})".format(self.uci, self.from_id, self.to_id, self.opening)
@@ -140,98 +188,1127 @@ class Move:
 
 class VariationTree:
     def __init__(self, moves=None, positions=None):
+        self.adjaceny_list = dict()
+        self.moves = dict()
+        self.nodes = dict()
         if not (moves is None or positions is None):
             self._build_graph(moves, positions)
 
+    @staticmethod
+    def from_db(db, opening):
+        """Build the tree of all moves of the opening reachable from the starting position."""
+        moves = list(db.variation(opening, fields=Move.FIELDS))
+        pos_ids = set(move["board_start"] for move in moves)
+        pos_ids.update(move["board_end"] for move in moves)
+        positions = db.find_positions(pos_ids)
+        return VariationTree(moves, positions)
+
+    @staticmethod
+    async def from_db_async(db, opening, batch_size=1000):
+        """from_db for an AsyncStorage, the positions are fetched
+        in batches of batch_size with concurrent queries.
+        The tree is built in the executor of the storage, not on the event loop."""
+        moves = await db.variation(opening, fields=Move.FIELDS)
+        pos_ids = set(move["board_start"] for move in moves)
+        pos_ids.update(move["board_end"] for move in moves)
+        pos_ids = list(pos_ids)
+        batches = await asyncio.gather(*(db.find_positions(pos_ids[i:i+batch_size])
+                                         for i in range(0, len(pos_ids), batch_size)))
+        return await offload(db.executor, VariationTree, moves, itertools.chain.from_iterable(batches))
+
+    @metrics.timed("VariationTree.traverse")
     def traverse(self, start=0):
-        nodes = []
-        edges = []
-        stack = [start]
+        """Yield every (position, move) pair of the tree in depth first order.
+        Children are visited in the order of their BoardId, i.e. the variation
+        entered first comes first. Positions which are reached by a transposition
+        are only expanded once, so every move is yielded exactly once.
+        """
+        if start not in self.nodes:
+            return
+        visited = set([start])
+        stack = [(self.nodes[start], iter(self.adjaceny_list.get(start, [])))]
         while stack:
-            cur_node = stack[0]
-            stack = stack[1:]
-            nodes.append(self.nodes[cur_node])
-            if cur_node in self.adjaceny_list:
-                for child in self.adjaceny_list[cur_node]:
-                    stack.insert(0, child)
-        return self._positions_to_moves(nodes)
-
-    def _positions_to_moves(self, positions):
-        for i in range(len(positions)-1):
-            start_pos = positions[i].board_id
-            end_pos = positions[i+1].board_id
-            try:
-                yield positions[i], self.moves[str(start_pos)+"-"+str(end_pos)]
-            except:
+            board, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
                 continue
-
+            yield board, self.moves[(board.board_id, child)]
+            if child not in visited and child in self.nodes:
+                visited.add(child)
+                stack.append((self.nodes[child], iter(self.adjaceny_list.get(child, []))))
+
+    def add_move(self, move, board_start, board_end):
+        """Add a single move and its positions to an already built tree."""
+        key = (move.from_id, move.to_id)
+        self.nodes.setdefault(board_start.board_id, board_start)
+        self.nodes.setdefault(board_end.board_id, board_end)
+        if key in self.moves:
+            return
+        self.moves[key] = move
+        bisect.insort(self.adjaceny_list.setdefault(move.from_id, []), move.to_id)
+
+    @metrics.timed("VariationTree._build_graph")
     def _build_graph(self, moves, positions):
-        if not isinstance(moves, Move):
+        moves = list(moves)
+        positions = list(positions)
+        if moves and not isinstance(moves[0], Move):
             moves = Move.from_mongodb(moves)
-        if not isinstance(positions, BoardNode):
+        if positions and not isinstance(positions[0], BoardNode):
             positions = BoardNode.from_mongodb(positions)
-        
-        self.adjaceny_list = dict()
-        self.moves = dict()
+
         for move in moves:
-            self.moves[str(move.from_id)+"-"+str(move.to_id)] = move
+            self.moves[(move.from_id, move.to_id)] = move
             if move.from_id in self.adjaceny_list:
-                self.adjaceny_list[move.from_id].add(move.to_id)
+                self.adjaceny_list[move.from_id].append(move.to_id)
             else:
-                self.adjaceny_list[move.from_id] = set([move.to_id])
+                self.adjaceny_list[move.from_id] = [move.to_id]
+        for children in self.adjaceny_list.values():
+            children.sort()
 
-        self.nodes = dict()
         for pos in positions:
             self.nodes[pos.board_id] = pos
 
 
+class VariationTreeCache:
+    """Keep the built VariationTree of every opening,
+    so a training session does not have to rebuild it from the db.
+    Explorer patches or invalidates the trees whenever it changes an opening,
+    all trees of a db are dropped when another process changed its repertoire.
+    """
+    def __init__(self):
+        self._trees = dict()
+
+    def get(self, db, opening):
+        key = (db.name, opening)
+        if key not in self._trees:
+            self._trees[key] = VariationTree.from_db(db, opening)
+        return self._trees[key]
+
+    async def get_async(self, db, opening):
+        """get for an AsyncStorage."""
+        key = (db.name, opening)
+        if key not in self._trees:
+            self._trees[key] = await VariationTree.from_db_async(db, opening)
+        return self._trees[key]
+
+    def add_move(self, db, opening, move, board_start, board_end):
+        tree = self._trees.get((db.name, opening))
+        if tree is not None:
+            tree.add_move(move, board_start, board_end)
+
+    def find_move(self, db, opening, move):
+        """Return the cached instance of the Move, None if the tree is not cached."""
+        tree = self._trees.get((db.name, opening))
+        if tree is None:
+            return None
+        return tree.moves.get((move.from_id, move.to_id))
+
+    def invalidate(self, db, opening):
+        self._trees.pop((db.name, opening), None)
+
+    def clear(self, db):
+        for key in [key for key in self._trees if key[0] == db.name]:
+            del self._trees[key]
+
+
+variation_trees = VariationTreeCache()
+
+
+class OpeningStatisticsCache:
+    """Keep the statistics of every opening (see Storage.opening_statistics).
+    An entry is recomputed once the revision of its opening changed or it is
+    older than max_age seconds, as reviews and time change the due moves.
+    """
+    EMPTY = {"moves": 0, "positions": 0, "due": 0, "difficulty": None, "depth": 0}
+
+    def __init__(self, max_age=60.):
+        self.max_age = max_age
+        self._statistics = dict()
+
+    def get(self, db, openings):
+        """Statistics of the opening documents keyed by their id,
+        all stale openings are computed with a single query."""
+        now = time.time()
+        result = dict()
+        stale = []
+        for opening in openings:
+            cached = self._statistics.get((db.name, opening["id"]))
+            if (cached is not None and cached[0] == opening.get("revision", 0) and
+                    now - cached[1] < self.max_age):
+                result[opening["id"]] = cached[2]
+            else:
+                stale.append(opening)
+        if stale:
+            # The trainee answers with the moves after which the opponent is to move
+            computed = db.opening_statistics(dict((opening["id"], opening["color"] != "White")
+                                                  for opening in stale), datetime.now())
+            for opening in stale:
+                statistics = computed.get(opening["id"], self.EMPTY)
+                self._statistics[(db.name, opening["id"])] = (opening.get("revision", 0), now, statistics)
+                result[opening["id"]] = statistics
+        return result
+
+    def invalidate(self, db, opening):
+        self._statistics.pop((db.name, opening), None)
+
+
+opening_statistics = OpeningStatisticsCache()
+
+
+class PositionCache:
+    """Bounded LRU cache of what the training needs to know about a position,
+    keyed by the db and BoardId: the legal moves with their notation (uci: san)
+    and the moves of the repertoire (uci: opening ids), i.e. the expected answers.
+    Explorer invalidates a position when it changes its moves, so the Explorer
+    and Trainer of a db have to share the cache (the app keeps one per app).
+    warm computes entries in a background thread, ahead of the requests.
+    Entries computed while a position of their db was invalidated are not stored.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = set()
+        # Invalidations and clears of every db so far, one counter per db keeps it bounded
+        self._generations = dict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, db, board):
+        """The entry of the BoardNode, computed now if it is not cached."""
+        key = (db.name, board.board_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+        if entry is not None:
+            metrics.POSITION_CACHE.inc("hit")
+            return entry
+        with self._lock:
+            self.misses += 1
+            generation = self._generation(key)
+        metrics.POSITION_CACHE.inc("miss")
+        entry = self._compute(db, board)
+        self._store(key, entry, generation)
+        return entry
+
+    def cached(self, db, board_id):
+        """The entry of the position if it is cached, None otherwise."""
+        with self._lock:
+            return self._entries.get((db.name, board_id))
+
+    def warm(self, db, boards):
+        """Compute the entries of the BoardNodes, which are not cached, in the background."""
+        with self._lock:
+            missing = [board for board in boards if (db.name, board.board_id) not in self._entries and
+                       (db.name, board.board_id) not in self._pending]
+            if not missing:
+                return
+            self._pending.update((db.name, board.board_id) for board in missing)
+            generations = [self._generation((db.name, board.board_id)) for board in missing]
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix="position-cache")
+        self._executor.submit(self._warm, db, missing, generations)
+
+    def invalidate(self, db, board_id):
+        with self._lock:
+            self._entries.pop((db.name, board_id), None)
+            self._generations[db.name] = self._generations.get(db.name, 0) + 1
+
+    def clear(self, db):
+        """Invalidate every position of the db."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == db.name]:
+                del self._entries[key]
+            self._generations[db.name] = self._generations.get(db.name, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+    def _warm(self, db, boards, generations):
+        for board, generation in zip(boards, generations):
+            key = (db.name, board.board_id)
+            try:
+                self._store(key, self._compute(db, board), generation)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+    def _generation(self, key):
+        return self._generations.get(key[0], 0)
+
+    def _store(self, key, entry, generation):
+        """Store the entry, unless a position of its db was invalidated since its computation started."""
+        with self._lock:
+            if self._generation(key) != generation:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _compute(db, board):
+        chess_board = chess.Board(board.fen)
+        legal = dict((move.uci(), chess_board.san(move)) for move in chess_board.legal_moves)
+        answers = dict((move["move"], move.get("opening", []))
+                       for move in db.find_moves(board_start=board.board_id, fields=("move", "opening")))
+        return {"legal": legal, "answers": answers}
+
+
+def _heap_order(heap):
+    """Yield the entries of the heap in ascending order without changing it,
+    only the entries which are yielded and their children are compared."""
+    if not heap:
+        return
+    candidates = [(heap[0], 0)]
+    while candidates:
+        entry, index = heapq.heappop(candidates)
+        yield entry
+        for child in (2*index+1, 2*index+2):
+            if child < len(heap):
+                heapq.heappush(candidates, (heap[child], child))
+
+
+class ReviewQueue:
+    """Moves of an opening ordered by the date they are due for review.
+    Every side to move has its own queue, so the trainer only looks at the
+    moves it actually has to answer.
+    """
+    def __init__(self):
+        self._queues = {"w": [], "b": []}
+        self._boards = dict()
+        self._moves = dict()
+        self._order = dict()
+        self._due = dict()
+        self._popped = set()
+
+    def fill(self, variations):
+        """Fill the queue with the (board, move) pairs of the variations.
+        The order of the variations breaks ties between moves with the same due date
+        (e.g. all moves which were never reviewed).
+        """
+        for board, move in variations:
+            self._queues[board.color].append(self._add(board, move))
+        for queue in self._queues.values():
+            heapq.heapify(queue)
+
+    def push(self, board, move):
+        """Add the move or move it to its new due date."""
+        # An older entry of the move stays in the heap and is skipped by pop
+        heapq.heappush(self._queues[board.color], self._add(board, move))
+        self._popped.discard((move.from_id, move.to_id))
+
+    def pop(self, color, now=None):
+        """Return the board and move for the side to move (color),
+        which is overdue the longest. (None, None) if no move is due."""
+        if now is None:
+            now = datetime.now()
+        queue = self._queues[color]
+        while queue:
+            due, order, key = queue[0]
+            if self._due.get(key) != due:
+                # Entry was replaced by a later push
+                heapq.heappop(queue)
+                continue
+            if due > now:
+                break
+            heapq.heappop(queue)
+            del self._due[key]
+            self._popped.add(key)
+            return self._boards[key], self._moves[key]
+        return None, None
+
+    def peek(self, color, n, now=None):
+        """The next (up to) n boards and moves, which pop would return, without taking them."""
+        if now is None:
+            now = datetime.now()
+        upcoming = []
+        seen = set()
+        for due, order, key in _heap_order(self._queues[color]):
+            if len(upcoming) >= n or due > now:
+                break
+            if self._due.get(key) == due and key not in seen:
+                seen.add(key)
+                upcoming.append((self._boards[key], self._moves[key]))
+        return upcoming
+
+    def get(self, key):
+        """Return the board and move of the key (from_id, to_id), (None, None) if unknown."""
+        return self._boards.get(key), self._moves.get(key)
+
+    @property
+    def popped(self):
+        """Keys of the moves taken from the queue, which were not pushed again."""
+        return list(self._popped)
+
+    def discard(self, keys):
+        """Take the moves out of the queue, e.g. to restore a queue after they were popped."""
+        for key in keys:
+            key = tuple(key)
+            if key in self._due:
+                del self._due[key]
+                self._popped.add(key)
+
+    def _add(self, board, move):
+        key = (move.from_id, move.to_id)
+        if key not in self._order:
+            self._order[key] = len(self._order)
+        due = move.date_due or datetime.min
+        self._boards[key] = board
+        self._moves[key] = move
+        self._due[key] = due
+        return (due, self._order[key], key)
+
+    def __len__(self):
+        return len(self._due)
+
+
+class DueQueue:
+    """Due moves of several openings (of both colors) in one queue,
+    the move with the highest review priority (scheduling.priority) first.
+
+    The moves are read page by page with Storage.due_moves in the order they
+    became due, no VariationTree is built. At least lookahead moves are read
+    ahead of the ones handed out, the priority orders the moves read so far.
+    Moves which become due after the queue was created are left for the next one.
+
+    Args:
+        db: Storage
+        openings: dict of the side to move (bool) of the answers to the opening ids
+    """
+    def __init__(self, db, openings, now=None, page_size=100, lookahead=50):
+        self.db = db
+        self.openings = openings
+        self.now = now or datetime.now()
+        self.page_size = page_size
+        self.lookahead = lookahead
+        # Position after the last read move of every color, which has more due moves
+        self._after = dict((color, None) for color, ids in openings.items() if ids)
+        self._heap = []
+        self._boards = dict()
+        self._moves = dict()
+        self._popped = set()
+        self._order = itertools.count()
+
+    def pop(self):
+        """Return the board and move with the highest priority, (None, None) if no move is due."""
+        while True:
+            if len(self._heap) < self.lookahead:
+                self._read()
+            if not self._heap:
+                return None, None
+            key = heapq.heappop(self._heap)[2]
+            if key not in self._popped:
+                self._popped.add(key)
+                return self._boards[key], self._moves[key]
+
+    def peek(self, n):
+        """The next (up to) n boards and moves of the moves read so far, without taking them."""
+        upcoming = []
+        for _, _, key in _heap_order(self._heap):
+            if len(upcoming) >= n:
+                break
+            if key not in self._popped:
+                upcoming.append((self._boards[key], self._moves[key]))
+        return upcoming
+
+    def push(self, board, move):
+        """Answered moves are due again after the session, they are not queued again."""
+        key = (move.from_id, move.to_id)
+        self._boards[key] = board
+        self._moves[key] = move
+
+    def get(self, key):
+        """Return the board and move of the key (from_id, to_id), (None, None) if unknown."""
+        return self._boards.get(key), self._moves.get(key)
+
+    @property
+    def popped(self):
+        """Keys of the moves taken from the queue."""
+        return list(self._popped)
+
+    def discard(self, keys):
+        """Take the moves out of the queue, e.g. to restore a queue after they were popped."""
+        self._popped.update(tuple(key) for key in keys)
+
+    def _read(self):
+        """Read the next page of due moves of every color."""
+        documents = []
+        for color, after in list(self._after.items()):
+            page = list(self.db.due_moves(self.openings[color], color, self.now, after, self.page_size))
+            if len(page) < self.page_size:
+                del self._after[color]
+            else:
+                self._after[color] = (page[-1].get("date_due"), page[-1]["_id"])
+            documents += page
+        if not documents:
+            return
+        positions = dict((board.board_id, board) for board in BoardNode.from_mongodb(
+            self.db.find_positions(set(move["board_start"] for move in documents))))
+        schedule = scheduling.ReviewSchedule(documents)
+        priorities = scheduling.priority(schedule.difficulty, schedule.overdue(self.now))
+        for move, priority in zip(Move.from_mongodb(documents), priorities.tolist()):
+            key = (move.from_id, move.to_id)
+            if key in self._moves or move.from_id not in positions:
+                continue
+            self._boards[key] = positions[move.from_id]
+            self._moves[key] = move
+            heapq.heappush(self._heap, (-priority, next(self._order), key))
+
+    def __len__(self):
+        """Number of moves read and not handed out yet."""
+        return len(set(entry[2] for entry in self._heap) - self._popped)
+
+
+class IdAllocator:
+    """Hand out unique ids from an atomic counter in the db.
+    Ids are reserved in blocks with a single atomic increment
+    and then handed out from memory, so parallel writers never get the same id.
+    """
+    def __init__(self, db, collection, field, first=0, block_size=100):
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1, got %r" % (block_size,))
+        self.db = db
+        self.collection = collection
+        self.field = field
+        self.first = first
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+
+    def next(self):
+        if self._next >= self._end:
+            self._end = self.db.reserve_ids(self.collection, self.field, self.block_size, self.first)
+            self._next = self._end - self.block_size
+        new_id = self._next
+        self._next += 1
+        return new_id
+
+
+class BoardCache:
+    """LRU cache of parsed chess.Boards keyed by BoardId.
+    The returned boards are shared, copy them before pushing moves.
+    """
+    def __init__(self, repertoire, maxsize=1024):
+        self.repertoire = repertoire
+        self.maxsize = maxsize
+        self._boards = OrderedDict()
+
+    def get(self, board_id):
+        board = self._boards.pop(board_id, None)
+        if board is None:
+            board = chess.Board(self.repertoire.position(board_id).fen)
+            if len(self._boards) >= self.maxsize:
+                self._boards.popitem(last=False)
+        self._boards[board_id] = board
+        return board
+
+
+class Repertoire:
+    """In memory graph of all positions and moves of a user.
+    The graph is loaded once per user. Inserts and deletes are written through
+    to the db and applied to the graph, so navigating never reads from the db.
+    Every write increases the revision of the repertoire in the db, a graph
+    whose revision differs was changed by another process and is loaded again.
+    """
+    _loaded = dict()
+
+    def __init__(self, db):
+        self.db = db
+        # Read before the graph, so writes during the load make the graph stale
+        self.revision = db.repertoire_revision()
+        # BoardId 0 is reserved for the starting position
+        self.board_ids = IdAllocator(db, "positions", "BoardId", first=1)
+        self.opening_ids = IdAllocator(db, "opening", "id", block_size=1)
+        self.boards = BoardCache(self)
+        self.positions = dict()
+        self._hash_index = dict()
+        self._moves = dict()
+        self._parents = dict()
+        # moves of every opening keyed by (from_id, uci), so an opening is removed
+        # without looking at the moves of the other openings
+        self._opening_moves = dict()
+        for pos in BoardNode.from_mongodb(db.find_positions()):
+            self._add_position(pos)
+        for move in Move.from_mongodb(db.find_moves(fields=Move.FIELDS)):
+            self._add_move(move)
+
+    @staticmethod
+    def load(db, reload=False):
+        """Return the repertoire of the user, it is read from the db on first use
+        and again if it is stale (or reload), the cached trees of the db are dropped then."""
+        repertoire = Repertoire._loaded.get(db.name)
+        if repertoire is None or reload or repertoire.stale():
+            if repertoire is not None:
+                variation_trees.clear(db)
+            repertoire = Repertoire._loaded[db.name] = Repertoire(db)
+        return repertoire
+
+    def stale(self):
+        """True if another process changed the repertoire since it was loaded."""
+        return self.db.repertoire_revision() != self.revision
+
+    def position(self, board_id):
+        return self.positions[board_id]
+
+    def find_position(self, hash):
+        """Return the BoardNode with the position hash, None if it does not exist."""
+        board_id = self._hash_index.get(hash)
+        if board_id is None:
+            return None
+        return self.positions[board_id]
+
+    def moves_from(self, board_id):
+        return list(self._moves.get(board_id, {}).values())
+
+    def openings_at(self, board_id):
+        """Ids of all openings with a move from or to the position."""
+        openings = set()
+        for move in self.moves_from(board_id):
+            openings.update(move.opening)
+        for parent in self.parents(board_id):
+            for move in self.moves_from(parent):
+                if move.to_id == board_id:
+                    openings.update(move.opening)
+        return openings
+
+    def window(self, opening, root=0, depth=None):
+        """All positions reachable from root with moves of the opening,
+        at most depth moves deep. Moves of other openings from these positions
+        are part of the edges, but are not followed.
+
+        Returns:
+            (dict, list): fen of every BoardId and the edges as
+                          [from, to, uci, san, 1 if the move is part of the opening else 0]
+        """
+        positions = dict()
+        edges = []
+        if root not in self.positions:
+            return positions, edges
+        positions[root] = self.positions[root].fen
+        level = [root]
+        current_depth = 0
+        while level and (depth is None or current_depth < depth):
+            next_level = []
+            for board_id in level:
+                for move in sorted(self.moves_from(board_id), key=lambda move: move.to_id):
+                    major = opening in move.opening
+                    edges.append([move.from_id, move.to_id, move.uci, move.san, int(major)])
+                    if major and move.to_id not in positions and move.to_id in self.positions:
+                        positions[move.to_id] = self.positions[move.to_id].fen
+                        next_level.append(move.to_id)
+            level = next_level
+            current_depth += 1
+        return positions, edges
+
+    def find_move(self, board_id, uci):
+        """Return the Move played from the position, None if it does not exist."""
+        return self._moves.get(board_id, {}).get(uci)
+
+    def parents(self, board_id):
+        """BoardIds of all positions with a move to the position."""
+        return self._parents.get(board_id, set())
+
+    def insert_position(self, board_node):
+        self.db.insert_positions([self._position_document(board_node)])
+        self._changed()
+        self._add_position(board_node)
+        return board_node
+
+    def insert_move(self, move, color):
+        """Insert the Move, color is the side to move after the move was played."""
+        document = self._move_document(move, color)
+        self.db.insert_moves([document])
+        self._changed()
+        move.doc_id = document["_id"]
+        self._add_move(move)
+        return move
+
+    def insert_many(self, positions, moves):
+        """Bulk insert new BoardNodes and (Move, color) pairs."""
+        if positions:
+            self.db.insert_positions([self._position_document(pos) for pos in positions])
+        if moves:
+            documents = [self._move_document(move, color) for move, color in moves]
+            self.db.insert_moves(documents)
+            for (move, _), document in zip(moves, documents):
+                move.doc_id = document["_id"]
+        if positions or moves:
+            self._changed()
+        for pos in positions:
+            self._add_position(pos)
+        for move, _ in moves:
+            self._add_move(move)
+
+    def add_opening(self, move, opening):
+        """Mark an existing move as part of the opening."""
+        self.add_opening_many([move], opening)
+
+    def add_opening_many(self, moves, opening):
+        if not moves:
+            return
+        self.db.add_opening([(move.from_id, move.uci) for move in moves], opening)
+        self._changed()
+        for move in moves:
+            if opening not in move.opening:
+                move.opening.append(opening)
+            self._opening_moves.setdefault(opening, dict())[(move.from_id, move.uci)] = move
+
+    def pull_opening(self, opening):
+        """Remove the opening from all moves holding it.
+        Returns the moves, which are not part of any opening anymore.
+        """
+        self.db.pull_opening(opening)
+        self._changed()
+        orphans = []
+        for move in self._opening_moves.pop(opening, {}).values():
+            if opening in move.opening:
+                move.opening.remove(opening)
+                if not move.opening:
+                    orphans.append(move)
+        return orphans
+
+    def subtree(self, moves, opening):
+        """Collect the moves and positions, which are removed with the moves.
+        A move is only removed if it belongs to no other opening, a position
+        if every move leading to it is removed, then its moves of the opening follow.
+        """
+        delete_moves = []
+        delete_positions = []
+        remaining_parents = dict()
+        stack = list(moves)
+        while stack:
+            move = stack.pop()
+            if set(move.opening) - set([opening]):
+                continue
+            delete_moves.append(move)
+            if move.to_id not in remaining_parents:
+                remaining_parents[move.to_id] = len(self.parents(move.to_id))
+            remaining_parents[move.to_id] -= 1
+            if remaining_parents[move.to_id] == 0 and move.to_id != 0:
+                delete_positions.append(move.to_id)
+                stack.extend(child for child in self.moves_from(move.to_id)
+                             if opening in child.opening)
+        return delete_moves, delete_positions
+
+    def remove_moves(self, moves):
+        self.db.delete_moves([move.doc_id for move in moves])
+        self._changed()
+        for move in moves:
+            removed = self._moves.get(move.from_id, {}).pop(move.uci, None)
+            if removed is not None:
+                self._parents.get(removed.to_id, set()).discard(removed.from_id)
+                for opening in removed.opening:
+                    self._opening_moves.get(opening, {}).pop((removed.from_id, removed.uci), None)
+
+    def remove_positions(self, board_ids):
+        self.db.delete_positions(board_ids)
+        self._changed()
+        for board_id in board_ids:
+            board_node = self.positions.pop(board_id, None)
+            if board_node is not None:
+                self._hash_index.pop(board_node.hash, None)
+
+    def _changed(self):
+        """Increase the revision after a write, the graph stays current
+        unless another process wrote since the last write."""
+        revision = self.db.touch_repertoire()
+        if revision == self.revision + 1:
+            self.revision = revision
+
+    @staticmethod
+    def _position_document(board_node):
+        return {"fen": board_node.fen, "BoardId": board_node.board_id, "hash": board_node.hash}
+
+    @staticmethod
+    def _move_document(move, color):
+        return {"board_start": move.from_id,
+                "board_end": move.to_id,
+                "move": move.uci,
+                "san": move.san,
+                "color": color,
+                "opening": list(move.opening)}
+
+    def _add_position(self, board_node):
+        self.positions[board_node.board_id] = board_node
+        self._hash_index[board_node.hash] = board_node.board_id
+
+    def _add_move(self, move):
+        self._moves.setdefault(move.from_id, dict())[move.uci] = move
+        self._parents.setdefault(move.to_id, set()).add(move.from_id)
+        for opening in move.opening:
+            self._opening_moves.setdefault(opening, dict())[(move.from_id, move.uci)] = move
+
+
+class PgnImporter:
+    """Read all games of a pgn file, including every variation, into an opening.
+    Positions and moves are deduplicated against the repertoire and the pending batch,
+    new documents are written with insert_many once batch_size of them are pending.
+    """
+    def __init__(self, repertoire, opening, batch_size=1000):
+        self.repertoire = repertoire
+        self.opening = opening
+        self.batch_size = batch_size
+        self.stats = {"games": 0, "positions": 0, "moves": 0}
+        self._positions = dict()
+        self._moves = dict()
+        self._openings = dict()
+        self._board_ids = IdAllocator(repertoire.db, "positions", "BoardId",
+                                      first=1, block_size=batch_size)
+
+    def read(self, pgn_file):
+        """Import every game of the (text) file object and return the statistics."""
+        start = time.time()
+        game = pgn.read_game(pgn_file)
+        while game is not None:
+            self._import_game(game)
+            self.stats["games"] += 1
+            game = pgn.read_game(pgn_file)
+        self.flush()
+
+        seconds = time.time() - start
+        self.stats["seconds"] = seconds
+        self.stats["positions_per_second"] = self.stats["positions"]/seconds if seconds else 0
+        return self.stats
+
+    def flush(self):
+        """Write all pending positions and moves to the db."""
+        self.repertoire.insert_many(list(self._positions.values()),
+                                    list(self._moves.values()))
+        self.repertoire.add_opening_many(list(self._openings.values()), self.opening)
+        self._positions = dict()
+        self._moves = dict()
+        self._openings = dict()
+
+    def _import_game(self, game):
+        board = game.board()
+        stack = [(game, board, self._position(board))]
+        while stack:
+            node, board, board_node = stack.pop()
+            for variation in reversed(node.variations):
+                child_board = board.copy(stack=False)
+                child_board.push(variation.move)
+                child_node = self._position(child_board)
+                self._move(board, board_node, child_node, variation.move, child_board.turn)
+                stack.append((variation, child_board, child_node))
+
+            pending = len(self._positions) + len(self._moves) + len(self._openings)
+            if pending >= self.batch_size:
+                self.flush()
+
+    def _position(self, board):
+        key = position_hash(board)
+        board_node = self.repertoire.find_position(key) or self._positions.get(key)
+        if board_node is None:
+            board_node = BoardNode(board.fen(), self._board_ids.next(), key)
+            self._positions[key] = board_node
+            self.stats["positions"] += 1
+        return board_node
+
+    def _move(self, board, board_start, board_end, move, color):
+        uci = move.uci()
+        key = (board_start.board_id, uci)
+        if key in self._moves or key in self._openings:
+            return
+        exists = self.repertoire.find_move(board_start.board_id, uci)
+        if exists is None:
+            self._moves[key] = (Move(uci, board_start.board_id, board_end.board_id, [self.opening],
+                                     san=board.san(move)),
+                                color)
+            self.stats["moves"] += 1
+        elif self.opening not in exists.opening:
+            self._openings[key] = exists
+
+
+class PgnExporter:
+    """Write an opening as one pgn game, which contains every move of the opening.
+    The move to the lowest BoardId is the main line of a position, the other moves
+    are nested variations. A position reached again by another move order is only
+    continued the first time. Every move gets its review state as comment.
+    Only the edges of the opening are kept in memory, the text is generated
+    line by line while it is sent.
+    """
+    FIELDS = ("board_start", "board_end", "move", "san", "difficulty", "date_last_reviewed")
+
+    def __init__(self, db, opening, line_length=80):
+        self.db = db
+        self.opening = opening
+        self.line_length = line_length
+
+    def chunks(self, chunk_size=16*1024):
+        """Yield the pgn text in chunks of about chunk_size characters."""
+        chunk = []
+        size = 0
+        for line in self.lines():
+            chunk.append(line + "\n")
+            size += len(line) + 1
+            if size >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+
+    def lines(self):
+        """Yield the lines of the pgn game."""
+        name = self.opening["name"].replace("\\", "\\\\").replace('"', '\\"')
+        for tag, value in (("Event", name), ("Site", "?"), ("Date", "????.??.??"), ("Round", "?"),
+                           ("White", "?"), ("Black", "?"), ("Result", "*")):
+            yield '[{0} "{1}"]'.format(tag, value)
+        yield ""
+
+        line = ""
+        for token in itertools.chain(self._variation(self._children(), 0, 0, set([0])), ["*"]):
+            if line and len(line) + 1 + len(token) > self.line_length:
+                yield line
+                line = token
+            else:
+                line = line + " " + token if line else token
+        yield line
+        yield ""
+
+    def _children(self):
+        """(board_end, uci, san, difficulty, date_last_reviewed) of the moves of every position."""
+        children = dict()
+        for move in self.db.find_moves(opening=self.opening["id"], fields=self.FIELDS):
+            children.setdefault(move["board_start"], []).append(
+                (move["board_end"], move["move"], move.get("san"),
+                 move.get("difficulty", scheduling.DEFAULT_DIFFICULTY), move.get("date_last_reviewed")))
+        for moves in children.values():
+            moves.sort()
+        return children
+
+    def _variation(self, children, board_id, ply, expanded):
+        """Tokens of the line from board_id, the alternative moves as nested variations."""
+        while board_id in children:
+            moves = children[board_id]
+            main = moves[0]
+            continue_main = main[0] not in expanded
+            expanded.add(main[0])
+            yield from self._move(board_id, main, ply, continue_main)
+            for alternative in moves[1:]:
+                continue_alternative = alternative[0] not in expanded
+                expanded.add(alternative[0])
+                yield "("
+                yield from self._move(board_id, alternative, ply, continue_alternative)
+                if continue_alternative:
+                    yield from self._variation(children, alternative[0], ply+1, expanded)
+                yield ")"
+            if not continue_main:
+                return
+            board_id = main[0]
+            ply += 1
+
+    def _move(self, board_id, move, ply, continued):
+        board_end, uci, san, difficulty, date_last_reviewed = move
+        if san is None:
+            fen = next(BoardNode.from_mongodb(self.db.find_positions([board_id]))).fen
+            san = chess.Board(fen).san(chess.Move.from_uci(uci))
+        yield "{0}{1}".format(ply//2 + 1, "." if ply % 2 == 0 else "...")
+        yield san
+        comment = ["difficulty {0:.2f}".format(difficulty)]
+        if isinstance(date_last_reviewed, int):
+            date_last_reviewed = datetime.fromtimestamp(date_last_reviewed)
+        if date_last_reviewed is None:
+            comment.append("never reviewed")
+        else:
+            comment.append("last reviewed " + date_last_reviewed.strftime("%Y-%m-%d"))
+        if not continued:
+            comment.append("transposition")
+        yield "{" + ", ".join(comment) + "}"
+
+
 class History:
     """Keep track of the last move played and store the corresponding board positions.
     Used to undo/redo moves.
     """
-    def __init__(self, db):
+    def __init__(self, repertoire):
         self._moves = list()
         self._index = -1
-        self._db = db
+        self._repertoire = repertoire
 
     def execute(self, move):
         self._moves = self._moves[:(self._index+1)]
         self._moves.append(move)
-        board = move.execute(self._db)
+        board = move.execute(self._repertoire)
         self._index = len(self._moves)-1
         return board
 
     def undo(self):
-        board = self._moves[self._index].undo(self._db)
+        board = self._moves[self._index].undo(self._repertoire)
         self._index -= 1
         return board
 
     def redo(self):
         self._index += 1
         move = self._moves[self._index]
-        board = move.execute(self._db)
+        board = move.execute(self._repertoire)
         return move, board
 
     @property
     def last_move(self):
         return self._moves[self._index]
 
+    def state(self):
+        """The played moves as json serializable dict."""
+        return {"moves": [[move.from_id, move.uci] for move in self._moves],
+                "index": self._index}
+
+    @staticmethod
+    def restore(repertoire, state):
+        """Rebuild the History from state, it ends before the first move,
+        which does not exist anymore."""
+        history = History(repertoire)
+        for from_id, uci in state["moves"]:
+            move = repertoire.find_move(from_id, uci)
+            if move is None:
+                break
+            history._moves.append(move)
+        history._index = min(state["index"], len(history._moves)-1)
+        return history
+
+
+# Number of moves sampled by the db for a weighted random position
+RANDOM_CANDIDATES = 20
+
+# Number of upcoming positions of the review queue, which are put into the position cache
+WARM_POSITIONS = 5
+
+# Flush policies of the PerformanceBuffer:
+# immediate -- write every answer before the response is sent
+# batched -- write after 50 answers or 10 seconds
+# session -- write only at the end of the training session and at exit
+FLUSH_POLICIES = {
+    "immediate": {"max_pending": 1, "max_delay": None},
+    "batched": {"max_pending": 50, "max_delay": 10.},
+    "session": {"max_pending": None, "max_delay": None},
+}
+
+
+def _flush_buffers():
+    """Flush every open PerformanceBuffer, registered once with atexit."""
+    for buffer in list(PerformanceBuffer.open_buffers):
+        try:
+            buffer.flush()
+        except Exception as err:
+            print(err)
+
+
+class PerformanceBuffer:
+    """Buffer the review updates of moves in memory and write them with one bulk_write.
+    Pending updates are flushed when max_pending moves are buffered, max_delay seconds
+    after the first update was buffered, when flush is called and at interpreter exit.
+    Several updates of the same move are merged into the last one.
+    Open buffers are only weakly referenced for the exit flush, close a buffer
+    before dropping it, otherwise its pending updates are lost.
+    """
+    open_buffers = weakref.WeakSet()
+
+    def __init__(self, db, max_pending=50, max_delay=10.):
+        self.db = db
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._timer = None
+        PerformanceBuffer.open_buffers.add(self)
+
+    def add(self, move):
+        with self._lock:
+            self._pending[(move.from_id, move.to_id)] = move.performance_update()
+            full = self.max_pending is not None and len(self._pending) >= self.max_pending
+            if not full and self.max_delay is not None and self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write all pending updates, returns the number of written moves."""
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        try:
+            self.db.update_moves(list(pending.values()))
+        except Exception:
+            # Keep the updates for the next flush, unless the move was updated again
+            with self._lock:
+                pending.update(self._pending)
+                self._pending = pending
+            raise
+        return len(pending)
+
+    def close(self):
+        """Flush and stop flushing at exit, e.g. when the session is evicted."""
+        PerformanceBuffer.open_buffers.discard(self)
+        return self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+
+atexit.register(_flush_buffers)
+
 
 class Trainer:
     """Train an opening and keep track of the list of moves, which need to be reviewed.
     Updates the rating of a Move if it was answered correctly/wrong.
     """  
-    def __init__(self, user):
-        client = MongoClient()
-        self.db = client[user]
+    def __init__(self, user, flush_policy="batched", client=None, position_cache=None):
+        self.db = open_storage(client, user)
+        self.position_cache = PositionCache() if position_cache is None else position_cache
         self.opening = -1
         self._color = True
-
-    def random_position(self):
+        self.queue = ReviewQueue()
+        self._queue_active = False
+        # Ids of the openings of an interleaved review (review_due), None otherwise
+        self.openings = None
+        self.performance = PerformanceBuffer(self.db, **FLUSH_POLICIES[flush_policy])
+        self.current_board = None
+        self.last_move = None
+
+    def random_position(self, weighted=False):
         """Choose a random position from the db with the active opening.
+        The sample is drawn by the db ($sample) and joined with its position ($lookup),
+        so only the chosen moves are transferred.
+        If weighted, one of RANDOM_CANDIDATES sampled moves is chosen,
+        overdue and difficult moves are more likely.
+        Random positions are not known before they are drawn, so unlike next
+        the position cache is not warmed ahead, prompt computes their entry.
         """
-        move = random.sample(list(self.db.moves.find({"opening": self.opening, "color": self._color})), 1)[0]
-        board = self.db.positions.find_one({"BoardId": move["board_start"]})
+        size = RANDOM_CANDIDATES if weighted else 1
+        candidates = list(self.db.sample_moves(self.opening, self._color, size))
+        candidates = [move for move in candidates if move["position"]]
+        if not candidates:
+            return None, None
+
+        if weighted:
+            schedule = scheduling.ReviewSchedule(candidates)
+            weights = scheduling.priority(schedule.difficulty, schedule.overdue())
+            total = float(weights.sum())
+            if 0 < total < float("inf"):
+                move = random.choices(candidates, weights=weights.tolist())[0]
+            else:
+                move = random.choice(candidates)
+        else:
+            move = candidates[0]
+        board = next(BoardNode.from_mongodb(move.pop("position")))
+        move = next(Move.from_mongodb([move]))
+        # Share the state with the moves of a cached training session
+        move = variation_trees.find_move(self.db, self.opening, move) or move
+
         self.current_board = board
         self.last_move = move
         return board, move
@@ -240,26 +1317,125 @@ class Trainer:
         """Inialize a complete training for the active opening.
         Sets all variations, which can be accessed with next.
         """
-        moves = self.db.moves.find({"opening": self.opening})
-        pos_ids = list(set(moves.distinct("board_start")).union(set(moves.distinct("board_end"))))
-        positions = self.db.positions.find({"BoardId": {"$in":pos_ids}})
-        tree = VariationTree(moves, positions)
-        self.variations = tree.traverse()
+        self.end_session()
+        tree = variation_trees.get(self.db, self.opening)
+        self.queue = ReviewQueue()
+        self.queue.fill(tree.traverse())
+        self._queue_active = True
+        self.openings = None
+
+    async def complete_opening_async(self, executor=None):
+        """complete_opening for an event loop. The db is queried in the executor,
+        the positions of the tree with concurrent queries. The tree and the queue
+        are built in the executor as well, so other requests on the loop do not wait."""
+        await offload(executor, self.end_session)
+        tree = await variation_trees.get_async(AsyncStorage(self.db, executor), self.opening)
+        queue = ReviewQueue()
+        await offload(executor, queue.fill, tree.traverse())
+        self.queue = queue
+        self._queue_active = True
+        self.openings = None
+
+    def review_due(self, openings=None):
+        """Initialize an interleaved training of the due moves of several openings,
+        the most overdue and difficult moves first. The moves are read from the db
+        while the training goes on, see DueQueue.
+
+        Args:
+            openings: IDs of the openings, all openings if None
+        """
+        self.end_session()
+        documents = self.db.find_openings()
+        if openings is not None:
+            openings = set(openings)
+            documents = [opening for opening in documents if opening["id"] in openings]
+        # The answers of a White opening are the moves after which Black is to move
+        by_color = {False: [], True: []}
+        for opening in documents:
+            by_color[opening["color"] != "White"].append(opening["id"])
+        self.queue = DueQueue(self.db, by_color)
+        self._queue_active = True
+        self.openings = by_color[False] + by_color[True]
 
-    # FIXME: Serious performance issue, some calls take like 6s to process
     def next(self):
         """Access the next board state, which should be tested.
-        The variations have to be initailized beforehand (i.e. call complete_opening).
+        The review queue has to be initailized beforehand (i.e. call complete_opening or review_due).
         """
-        try:
-            board, move = next(self.variations)
-            while board.color != self.color or  not move.needs_review:                
-                board, move = next(self.variations)
+        if self.openings is not None:
+            board, move = self.queue.pop()
+            upcoming = self.queue.peek(WARM_POSITIONS)
+        else:
+            board, move = self.queue.pop(self.color)
+            upcoming = self.queue.peek(self.color, WARM_POSITIONS)
+        if move is not None:
             self.current_board = board
             self.last_move = move
-            return board, move
-        except StopIteration:
-            return None, None      
+            self.position_cache.warm(self.db, [upcoming_board for upcoming_board, _ in upcoming])
+        else:
+            self.end_session()
+        return board, move
+
+    def prompt(self, board, move):
+        """What the training page needs to check the answers of the position:
+        the notation of the move, the legal moves (uci: san) and the moves of the
+        repertoire which share an opening with the move and are accepted as well.
+        """
+        entry = self.position_cache.get(self.db, board)
+        openings = set(move.opening)
+        return {"san": entry["legal"].get(move.uci, move.san),
+                "legal": entry["legal"],
+                "answers": [uci for uci, move_openings in entry["answers"].items()
+                            if uci != move.uci and openings.intersection(move_openings)]}
+
+    def end_session(self):
+        """Write all buffered review updates to the db."""
+        written = self.performance.flush()
+        if written:
+            for opening in (self.opening,) if self.openings is None else self.openings:
+                opening_statistics.invalidate(self.db, opening)
+        return written
+
+    def close(self):
+        """Write all buffered review updates, the Trainer is not used anymore."""
+        written = self.end_session()
+        self.performance.close()
+        return written
+
+    def state(self):
+        """The light session state (active opening, current move and the moves
+        already taken from the review queue) as json serializable dict.
+        Buffered review updates are not written, they stay in the PerformanceBuffer
+        until its flush policy, the end of the training or close writes them, and
+        are lost if the worker crashes before.
+        """
+        current = None
+        if self.current_board is not None and self.last_move is not None:
+            current = [self.current_board.board_id, self.last_move.from_id, self.last_move.to_id]
+        return {"opening": self.opening,
+                "queue": self._queue_active,
+                "openings": self.openings,
+                "popped": self.queue.popped,
+                "current": current}
+
+    def restore(self, state):
+        """Restore the session state, the review queue is rebuilt from the db."""
+        self.change_opening(state["opening"])
+        if state.get("openings") is not None:
+            self.review_due(state["openings"])
+            self.queue.discard(state["popped"])
+        elif state["queue"]:
+            self.complete_opening()
+            self.queue.discard(state["popped"])
+        if state["current"] is not None:
+            board_id, from_id, to_id = state["current"]
+            board, move = self.queue.get((from_id, to_id))
+            if move is None:
+                move = next(Move.from_mongodb(self.db.find_moves(board_start=from_id, board_end=to_id,
+                                                                fields=Move.FIELDS)), None)
+                board = next(BoardNode.from_mongodb(self.db.find_positions([board_id])), None)
+            if board is not None and move is not None:
+                self.current_board = board
+                self.last_move = move
 
     def change_opening(self, opening):
         """Change the active opening.
@@ -267,39 +1443,63 @@ class Trainer:
         Args:
             opening (int): ID of the opening
         """
+        self.end_session()
         self.opening = opening
+        self.queue = ReviewQueue()
+        self._queue_active = False
+        self.openings = None
         self._query_opening()
     
     def update_move_performance(self, performance=True):
         difficulty = self.last_move.difficulty
         date_last_reviewed = self.last_move.date_last_reviewed
         days_between_reviews = self.last_move.days_between_reviews
-        performance_rating = performance #Value between 0 and 1
-
-        if performance:
-            if date_last_reviewed:
-                percent_overdue = min(2, (datetime.now() - date_last_reviewed).days/days_between_reviews.days)
-            else:
-                percent_overdue = 2
-        else:
-            percent_overdue = 1
-        
-        difficulty += percent_overdue*1/17.*(8-9*performance_rating)
-        difficulty = max(min(difficulty, 1), 0)
-        difficulty_weight = 3-1.7*difficulty
-        if performance:
-            days_between_reviews = days_between_reviews.days*(1+(difficulty_weight-1)*percent_overdue)
+        now = datetime.now()
+        if date_last_reviewed:
+            days_since_review = (now - date_last_reviewed).total_seconds()/scheduling.SECONDS_PER_DAY
         else:
-            days_between_reviews = min(1, days_between_reviews.days*1./(difficulty_weight**2))
-        date_last_reviewed = datetime.now()
-        days_between_reviews = timedelta(days=days_between_reviews)
+            days_since_review = float("nan")
+
+        difficulty, days_between_reviews = scheduling.review(difficulty,
+                                                             days_between_reviews.total_seconds()
+                                                             / scheduling.SECONDS_PER_DAY,
+                                                             days_since_review,
+                                                             performance)
+        difficulty = float(difficulty)
+        date_last_reviewed = now
+        days_between_reviews = timedelta(days=float(days_between_reviews))
 
         success = self.last_move.update_performance(difficulty,
                                                    date_last_reviewed,
-                                                   days_between_reviews,
-                                                   self.db)
+                                                   days_between_reviews)
+        if success:
+            self.performance.add(self.last_move)
+            if self.current_board is not None:
+                self.queue.push(self.current_board, self.last_move)
         return success
 
+    def forecast(self, days=30):
+        """Due moves, overdue ratio and the number of reviews for each
+        of the next days of the active opening."""
+        self.performance.flush()
+        schedule = scheduling.ReviewSchedule.from_db(self.db, self.opening)
+        return schedule.summary(days, color=self._color)
+
+    def reschedule(self, performance=None):
+        """Re-run the schedule of every move of the active opening in one batch.
+        With performance all moves are reviewed as answered correctly/wrong,
+        otherwise only the stored due dates are recomputed.
+        Returns the number of updated moves.
+        """
+        self.end_session()
+        schedule = scheduling.ReviewSchedule.from_db(self.db, self.opening)
+        if performance is not None:
+            schedule.review(performance)
+        written = schedule.write(self.db)
+        variation_trees.invalidate(self.db, self.opening)
+        opening_statistics.invalidate(self.db, self.opening)
+        return written
+
     @property
     def color(self):
         if self._color:
@@ -308,7 +1508,7 @@ class Trainer:
             return "w"
 
     def _query_opening(self):
-        result = self.db.opening.find_one({"id": self.opening})
+        result = self.db.find_opening(id=self.opening)
         try:
             if result["color"] == "White":
                 self._color = False
@@ -323,12 +1523,15 @@ class Explorer:
         The class primary focus is to return all candidate moves 
         for the current position.
     """
-    def __init__(self, user):
-        client = MongoClient()
-        self.db = client[user]
-        
-        self.history = History(self.db)
+    def __init__(self, user, client=None, position_cache=None):
+        self.db = open_storage(client, user)
+        # Shared with the Trainer, which reads the positions changed by the Explorer
+        self.position_cache = PositionCache() if position_cache is None else position_cache
+        self.repertoire = Repertoire.load(self.db)
+
+        self.history = History(self.repertoire)
         self._current_board_id = 0
+        self._opening = -1
         self.board = self._starting_position()
 
     def push(self, move):
@@ -336,15 +1539,22 @@ class Explorer:
            and check if the occuring position already exists in the db.
 
         """
-        notation = self._notation(move)
-        m = self._check_move(move.uci())
+        try:
+            m = self._check_move(move.uci())
+        except DuplicatePositionError:
+            # Another process inserted the position, read its moves and positions
+            self.refresh(reload=True)
+            m = self._check_move(move.uci())
+        notation = self._notation(m)
+        board_start = self.board
         self.board = self.history.execute(m)
+        variation_trees.add_move(self.db, self._opening, m, board_start, self.board)
 
         return notation
 
     def next(self):
         move, new_board = self.history.redo()
-        notation = self._notation(chess.Move.from_uci(move.uci))
+        notation = self._notation(move)
         self.board = new_board
         return notation
 
@@ -353,132 +1563,231 @@ class Explorer:
 
     def remove_last_move(self):
         """Remove the last move and possible 
-        all following moves and positions."""
+        all following moves and positions.
+
+        Returns:
+            dict: number of removed moves and positions
+        """
         move = self.history.last_move
-        move = self.db.moves.find_one({"board_start": move.from_id, "board_end": move.to_id})
-        self._remove_moves(move, self.opening)
+        self._touch(move.from_id)
+        removed = self._remove_moves([move], self.opening)
+        variation_trees.invalidate(self.db, self.opening)
+
+        self.board = self.history.undo()
+        return removed
 
-        self.board = self.history.undo()        
+    def remove_move(self, board_id, uci):
+        """Remove the move played from the position (BoardId) and possible
+        all following moves and positions. The explorer moves to the position.
+
+        Returns:
+            dict: number of removed moves and positions
+        """
+        removed = {"moves": 0, "positions": 0}
+        move = self.repertoire.find_move(board_id, uci)
+        if move is not None:
+            self._touch(board_id)
+            removed = self._remove_moves([move], self.opening)
+            variation_trees.invalidate(self.db, self.opening)
+        self.goto(board_id)
+        return removed
+
+    def goto(self, board_id):
+        """Move the explorer to the position (BoardId), e.g. if the client navigated on its own.
+        The history starts again from there.
+        """
+        self.history = History(self.repertoire)
+        self.board = self.repertoire.position(board_id)
+
+    def tree(self, opening, root=0, depth=None):
+        """The positions and moves of the opening reachable from root as json serializable dict."""
+        positions, edges = self.repertoire.window(opening, root, depth)
+        return {"opening": opening,
+                "root": root,
+                "positions": positions,
+                "edges": edges}
+
+    def revision(self, opening):
+        """Revision of the opening, it changes whenever a position of the opening is written."""
+        exists = self.db.find_opening(id=opening)
+        if not exists:
+            return 0
+        return exists.get("revision", 0)
+
+    def openings(self):
+        """Names of the White and Black openings and the statistics of every opening by color and name."""
+        result = {"white": [], "black": [], "statistics": {"White": dict(), "Black": dict()}}
+        openings = list(self.db.find_openings())
+        statistics = opening_statistics.get(self.db, openings)
+        for opening in openings:
+            result[opening["color"].lower()].append(opening["name"])
+            result["statistics"][opening["color"]][opening["name"]] = statistics[opening["id"]]
+        return result
+
+    def add_opening(self, name, color):
+        """Create a new opening, if it does not exist yet."""
+        exists = self.db.find_opening(name, color)
+        if not exists:
+            self.db.insert_opening({"name": name, "color": color,
+                                    "id": self.repertoire.opening_ids.next()})
 
     def remove_opening(self, name, color):
-        exists = self.db.opening.find_one({"name": name, "color": color})
+        """Remove the opening and all moves and positions only used by it.
+
+        Returns:
+            dict: number of removed moves and positions
+        """
+        removed = {"moves": 0, "positions": 0}
+        exists = self.db.find_opening(name, color)
         if exists:
             opening_id = exists["id"]
-            self.db.moves.update({}, {"$pull":{"opening": opening_id}}, multi=True)
-            moves = self.db.moves.find({"opening.0": {"$exists": False}})
-            
-            self._remove_moves(moves, opening_id)
+            orphans = self.repertoire.pull_opening(opening_id)
+            removed = self._remove_moves(orphans, opening_id)
+            variation_trees.invalidate(self.db, opening_id)
+            opening_statistics.invalidate(self.db, opening_id)
+            self._touch_all()
 
-            self.db.opening.delete_one({"name": name, "color": color})
+            self.db.delete_opening(name, color)
+        return removed
 
     @property
     def opening(self):
         return self._opening
 
+    def state(self):
+        """The light session state (opening, board and history) as json serializable dict."""
+        return {"opening": self._opening,
+                "board": self.board.board_id,
+                "history": self.history.state()}
+
+    def refresh(self, reload=False):
+        """Load the repertoire again if another process changed it (or if reload),
+        called whenever a session is acquired. The explorer stays at its position."""
+        repertoire = Repertoire.load(self.db, reload)
+        if repertoire is not self.repertoire:
+            self.repertoire = repertoire
+            self.position_cache.clear(self.db)
+            self.restore(self.state())
+
+    def restore(self, state):
+        """Restore the session state, positions which do not exist anymore
+        fall back to the starting position."""
+        self._opening = state["opening"]
+        if state["board"] in self.repertoire.positions:
+            self.board = self.repertoire.position(state["board"])
+            self.history = History.restore(self.repertoire, state["history"])
+        else:
+            self.board = self._starting_position()
+            self.history = History(self.repertoire)
+
     @opening.setter
     def opening(self, opening):
-        exists = self.db.opening.find_one({"name": opening["name"], "color": opening["color"]})
+        exists = self.db.find_opening(opening["name"], opening["color"])
         if exists:
             self._opening = exists["id"]
             self.board = self._starting_position()
 
-    def _remove_moves(self, moves, opening):
-        if isinstance(moves, pymongo.cursor.Cursor):
-            stack = list(moves)
-        else:
-            stack = [moves]
-        delete_moves = []
-        delete_positions = []
-        while stack:
-            move = stack.pop()
-            if len(move["opening"]) > 1:
-                continue
-            delete_moves.append(move["_id"])
-            if self.db.moves.find({"board_end": move["board_end"]}).count() == 1:
-                delete_positions.append(move["board_end"])
+    def _touch(self, board_id):
+        """Increase the revision of every opening, which shows the position."""
+        openings = self.repertoire.openings_at(board_id)
+        openings.add(self._opening)
+        self.db.touch_openings(openings)
+        self.position_cache.invalidate(self.db, board_id)
 
-                moves = self.db.moves.find({"board_start": move["board_end"],
-                                           "opening": opening})
-                stack.extend(moves)
-        self.db.moves.delete_many({"_id":{"$in":delete_moves}})
-        self.db.positions.delete_many({"_id":{"$in":delete_positions}})
+    def _touch_all(self):
+        self.db.touch_openings()
+        self.position_cache.clear(self.db)
+
+    @metrics.timed("Explorer._remove_moves")
+    def _remove_moves(self, moves, opening):
+        delete_moves, delete_positions = self.repertoire.subtree(moves, opening)
+        if delete_moves:
+            self.repertoire.remove_moves(delete_moves)
+        if delete_positions:
+            self.repertoire.remove_positions(delete_positions)
+        return {"moves": len(delete_moves), "positions": len(delete_positions)}
 
     def _starting_position(self):
         """Check if the starting position is in the db, if not insert it."""
+        if 0 in self.repertoire.positions:
+            return self.repertoire.position(0)
+        board = chess.Board()
         try:
-            board = self.db.positions.find({"BoardId": 0})
-            return next(BoardNode.from_mongodb(board))
-        except StopIteration:
-            fen = chess.Board().fen()
-            self.db.positions.insert_one({"fen": fen, "BoardId": 0})
-            return BoardNode(fen, 0)
+            return self.repertoire.insert_position(BoardNode(board.fen(), 0, position_hash(board)))
+        except DuplicatePositionError:
+            # Another process inserted it since the repertoire was loaded
+            self.repertoire = Repertoire.load(self.db, reload=True)
+            return self.repertoire.position(0)
 
     def _notation(self, move):
-        """Return the notation of the last move."""
-        return chess.Board(self.board.fen).san(move)
+        """Return the notation of the Move, stored moves already know it."""
+        if move.san is None:
+            entry = self.position_cache.cached(self.db, move.from_id)
+            if entry is not None and move.uci in entry["legal"]:
+                move.san = entry["legal"][move.uci]
+            else:
+                board = self.repertoire.boards.get(move.from_id)
+                move.san = board.san(chess.Move.from_uci(move.uci))
+        return move.san
 
     def _check_move(self, move):
         """Check if the move already exists."""
-        exists = self.db.moves.find_one({"board_start": self.board.board_id,
-                                     "move": move})
-
-        if exists:
-            if self._opening in exists["opening"]:
-                #FIXME: not very pythonic
-                return next(Move.from_mongodb([exists]))
-            else:
-                self.db.moves.update({"_id": exists["_id"]},{"$addToSet":{"opening": self._opening}})
-                exists = self.db.moves.find_one({"board_start": self.board.board_id,
-                                             "move": move})
-                return next(Move.from_mongodb([exists]))
-                
-        else: 
+        exists = self.repertoire.find_move(self.board.board_id, move)
+        if exists is None:
+            self._touch(self.board.board_id)
             return self._insert_move(move)
+        if self._opening not in exists.opening:
+            self._touch(self.board.board_id)
+            self.repertoire.add_opening(exists, self._opening)
+        return exists
             
     def _insert_move(self, move):
         """Insert the move into the db,
            if the resulting position does not exist insert it. 
         """
-        chess_board = chess.Board(self.board.fen)
+        chess_board = self.repertoire.boards.get(self.board.board_id).copy(stack=False)
+        san = chess_board.san(chess.Move.from_uci(move))
         chess_board.push_uci(move)
 
-        position = self.db.positions.find({"fen": chess_board.fen()})
-        try:
-            board_node = next(BoardNode.from_mongodb(position))
-        except StopIteration:
-            board_node = self._insert_position(chess_board.fen())
+        board_node = self.repertoire.find_position(position_hash(chess_board))
+        if board_node is None:
+            board_node = self._insert_position(chess_board)
 
-        self.db.moves.insert_one({"board_start": self.board.board_id,
-                                  "board_end": board_node.board_id,
-                                  "move": move,
-                                  "color": chess_board.turn,
-                                  "opening": [self._opening]})
-
-        return Move(move, self.board.board_id, board_node.board_id, self._opening)
+        return self.repertoire.insert_move(Move(move, self.board.board_id,
+                                                board_node.board_id, [self._opening], san=san),
+                                           chess_board.turn)
     
-    def _insert_position(self, fen):
+    def _insert_position(self, chess_board):
         """Insert a new position into the db."""
-        max_board_id = self.db.positions.find_one(
-                        sort=[("BoardId", pymongo.DESCENDING)]
-                       )
-        max_board_id = max_board_id["BoardId"]+1
-        self.db.positions.insert_one({"fen": fen,
-                                      "BoardId": max_board_id})
-        return BoardNode(fen, max_board_id)
+        board_id = self.repertoire.board_ids.next()
+        return self.repertoire.insert_position(BoardNode(chess_board.fen(), board_id,
+                                                         position_hash(chess_board)))
 
-    @staticmethod
-    def import_pgn(pgn_file):
-        pass
+    def import_pgn(self, pgn_file, opening=None, batch_size=1000):
+        """Import all games of the pgn file (path or text file object) into the opening,
+        by default into the active opening. Returns the import statistics.
+        """
+        if opening is None:
+            opening = self._opening
+        importer = PgnImporter(self.repertoire, opening, batch_size)
+        if isinstance(pgn_file, str):
+            with open(pgn_file) as pgn_f:
+                stats = importer.read(pgn_f)
+        else:
+            stats = importer.read(pgn_file)
+        variation_trees.invalidate(self.db, opening)
+        self._touch_all()
+        return stats
 
     @property
+    @metrics.timed("Explorer.candidate_moves")
     def candidate_moves(self):
         candidates = {"major": [], "minor": []}
-        chess_board = chess.Board(self.board.fen)
-        for move in self.board.candidate_moves(self.db):
+        for move in self.repertoire.moves_from(self.board.board_id):
             if self.opening in move.opening:
-                candidates["major"].append(chess_board.san(chess.Move.from_uci(move.uci)))
+                candidates["major"].append(self._notation(move))
             else:
-                candidates["minor"].append(chess_board.san(chess.Move.from_uci(move.uci)))
+                candidates["minor"].append(self._notation(move))
 
         return candidates
 
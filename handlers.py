@@ -0,0 +1,50 @@
+"""Training request handlers shared by the flask app and the asgi app.
+
+Both apps answer /positions and /forecast with these functions, the form
+is a dict like mapping of the posted fields. The functions block on the db,
+the asgi app calls them in its thread pool.
+"""
+import json
+
+
+def positions(trainer, form):
+    """Load the next position of the training (load: random, weighted, full, due or next)
+    or rate the answer to the last one (performance: wrong or correct).
+    Returns (fen, uci, prompt) as json, "finished" if there is no position left.
+    """
+    if "load" in form:
+        load = form["load"]
+        if load in ("random", "weighted"):
+            board, move = trainer.random_position(load == "weighted")
+        elif load == "full":
+            trainer.complete_opening()
+            board, move = trainer.next()
+        elif load == "due":
+            trainer.review_due(parse_openings(form.get("openings")))
+            board, move = trainer.next()
+        elif load == "next":
+            board, move = trainer.next()
+        else:
+            return ""
+        if board is None or move is None:
+            return json.dumps("finished")
+        return json.dumps((board.fen, move.uci, trainer.prompt(board, move)))
+    elif "performance" in form:
+        if form["performance"] == "wrong":
+            trainer.update_move_performance(False)
+        elif form["performance"] == "correct":
+            trainer.update_move_performance()
+    return ""
+
+
+def forecast(trainer, form):
+    """Review statistics and forecast of the active training opening."""
+    days = int(form.get("days", 30))
+    return json.dumps(trainer.forecast(days))
+
+
+def parse_openings(openings):
+    """Opening ids of a comma separated form value, None (all openings) if it is empty."""
+    if not openings:
+        return None
+    return [int(opening) for opening in openings.split(",")]
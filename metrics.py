@@ -0,0 +1,282 @@
+"""Request and database instrumentation in the Prometheus text format.
+
+Collects latency histograms of the routes, the MongoDB commands (via a pymongo
+CommandListener) and of functions decorated with timed. Every request keeps a
+breakdown of its commands and spans, which is logged for slow requests.
+"""
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+logger = logging.getLogger(__name__)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in zip(names, values)) + "}"
+
+
+def _with_le(labels, le):
+    if labels:
+        return labels[:-1] + ',le="{0}"}}'.format(le)
+    return '{{le="{0}"}}'.format(le)
+
+
+class Histogram:
+    """Prometheus histogram with a fixed set of label names."""
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            if labels not in self._series:
+                self._series[labels] = [[0]*len(self.buckets), 0., 0]
+            counts, _, _ = series = self._series[labels]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} histogram".format(self.name)]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                label_text = _labels(self.labels, labels)
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append("{0}_bucket{1} {2}".format(self.name, _with_le(label_text, bucket), cumulative))
+                lines.append("{0}_bucket{1} {2}".format(self.name, _with_le(label_text, "+Inf"), count))
+                lines.append("{0}_sum{1} {2}".format(self.name, label_text, total))
+                lines.append("{0}_count{1} {2}".format(self.name, label_text, count))
+        return "\n".join(lines)
+
+
+class Counter:
+    """Prometheus counter with a fixed set of label names."""
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} counter".format(self.name)]
+        with self._lock:
+            for labels, value in sorted(self._series.items()):
+                lines.append("{0}{1} {2}".format(self.name, _labels(self.labels, labels), value))
+        return "\n".join(lines)
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Latency of the http requests.",
+                             ("route", "method"))
+REQUESTS = Counter("http_requests_total", "Number of http requests.", ("route", "method", "status"))
+REQUEST_COMMANDS = Histogram("http_request_mongodb_commands", "MongoDB commands per http request.",
+                             ("route",), COUNT_BUCKETS)
+REQUEST_COMMAND_DURATION = Histogram("http_request_mongodb_duration_seconds",
+                                     "Time per http request spent in MongoDB commands.", ("route",))
+COMMAND_DURATION = Histogram("mongodb_command_duration_seconds", "Latency of the MongoDB commands.",
+                             ("command", "collection"))
+COMMAND_FAILURES = Counter("mongodb_command_failures_total", "Number of failed MongoDB commands.",
+                           ("command", "collection"))
+SPAN_DURATION = Histogram("function_duration_seconds", "Time spent in instrumented functions.",
+                          ("function",))
+
+POSITION_CACHE = Counter("position_cache_lookups_total", "Lookups of the position cache by result.",
+                         ("result",))
+
+REGISTRY = [REQUEST_DURATION, REQUESTS, REQUEST_COMMANDS, REQUEST_COMMAND_DURATION,
+            COMMAND_DURATION, COMMAND_FAILURES, SPAN_DURATION, POSITION_CACHE]
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class RequestStats:
+    """Breakdown of the MongoDB commands and spans of a single request."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.commands = dict()
+        self.spans = dict()
+
+    def add_command(self, name, collection, duration):
+        self._add(self.commands, (name, collection), duration)
+
+    def add_span(self, name, duration):
+        self._add(self.spans, name, duration)
+
+    @property
+    def command_count(self):
+        return sum(count for count, _ in self.commands.values())
+
+    @property
+    def command_duration(self):
+        return sum(duration for _, duration in self.commands.values())
+
+    def breakdown(self):
+        """Human readable summary, slowest first."""
+        parts = ["{0} {1}: {2}x {3:.1f}ms".format(name, collection, count, duration*1000)
+                 for (name, collection), (count, duration)
+                 in sorted(self.commands.items(), key=lambda item: -item[1][1])]
+        parts += ["{0}: {1}x {2:.1f}ms".format(name, count, duration*1000)
+                  for name, (count, duration) in sorted(self.spans.items(), key=lambda item: -item[1][1])]
+        return ", ".join(parts)
+
+    @staticmethod
+    def _add(stats, key, duration):
+        count, total = stats.get(key, (0, 0.))
+        stats[key] = (count+1, total+duration)
+
+
+_request = contextvars.ContextVar("request_stats", default=None)
+
+
+def start_request():
+    stats = RequestStats()
+    _request.set(stats)
+    return stats
+
+
+def end_request(route, method, status, slow_request=1.):
+    """Record the metrics of the current request and log it if it was slow."""
+    stats = _request.get()
+    if stats is None:
+        return
+    _request.set(None)
+    duration = time.perf_counter() - stats.start
+    REQUEST_DURATION.observe(duration, route, method)
+    REQUESTS.inc(route, method, status)
+    REQUEST_COMMANDS.observe(stats.command_count, route)
+    REQUEST_COMMAND_DURATION.observe(stats.command_duration, route)
+    if slow_request is not None and duration >= slow_request:
+        logger.warning("Slow request %s %s: %.1fms, %d mongodb commands (%.1fms): %s",
+                       method, route, duration*1000, stats.command_count,
+                       stats.command_duration*1000, stats.breakdown())
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records the latency of every MongoDB command."""
+    def __init__(self):
+        self._collections = dict()
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._collections[event.request_id] = (collection, _request.get())
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        collection, _ = self._record(event)
+        COMMAND_FAILURES.inc(event.command_name, collection)
+
+    def _record(self, event):
+        with self._lock:
+            collection, stats = self._collections.pop(event.request_id, ("", None))
+        duration = event.duration_micros/1e6
+        COMMAND_DURATION.observe(duration, event.command_name, collection)
+        if stats is not None:
+            stats.add_command(event.command_name, collection, duration)
+        return collection, stats
+
+
+_listener = None
+
+
+def register_mongo_listener():
+    """Time the commands of all MongoClients created afterwards."""
+    global _listener
+    if _listener is None:
+        _listener = CommandTimer()
+        monitoring.register(_listener)
+    return _listener
+
+
+def _record_span(name, duration):
+    SPAN_DURATION.observe(duration, name)
+    stats = _request.get()
+    if stats is not None:
+        stats.add_span(name, duration)
+
+
+def timed(name):
+    """Decorator, which records the time spent in the function.
+    For generator functions the time spent producing the items is recorded.
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator(*args, **kwargs):
+                items = function(*args, **kwargs)
+                duration = 0.
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(items)
+                        finally:
+                            duration += time.perf_counter() - start
+                        yield item
+                except StopIteration:
+                    return
+                finally:
+                    _record_span(name, duration)
+            return generator
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record_span(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def init_app(app, slow_request=1.):
+    """Record the metrics of every request of the flask app.
+    Requests taking longer than slow_request seconds are logged with their breakdown.
+    """
+    from flask import request
+
+    @app.before_request
+    def _start_request():
+        start_request()
+
+    @app.after_request
+    def _end_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        end_request(route, request.method, response.status_code, slow_request)
+        return response
@@ -0,0 +1,135 @@
+"""One time migrations of the db of a user.
+
+Usage: python migrations.py <user>
+"""
+import sys
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import MongoClient
+
+import chess
+
+import scheduling
+from explorer import position_hash
+from storage import MongoStorage
+
+
+def _bulk_write(collection, operations, batch_size=1000):
+    for i in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[i:i+batch_size], ordered=False)
+
+
+def merge_duplicate_positions(db, batch_size=1000):
+    """Key all positions by their zobrist hash.
+    Positions with the same hash (i.e. only the move counters of the fen differ)
+    are merged into the one with the lowest BoardId. The moves are rewired to it
+    and moves which became duplicates are merged, the openings are combined.
+    Running workers load the repertoire again, if positions were merged.
+
+    Returns:
+        (int, int): number of removed positions and moves
+    """
+    survivors = dict()
+    rewire = dict()
+    set_hash = []
+    positions = db.positions.find({}, {"fen": 1, "BoardId": 1}).sort("BoardId", pymongo.ASCENDING)
+    for pos in positions:
+        key = position_hash(chess.Board(pos["fen"]))
+        if key in survivors:
+            rewire[pos["BoardId"]] = survivors[key]
+        else:
+            survivors[key] = pos["BoardId"]
+            set_hash.append(pymongo.UpdateOne({"_id": pos["_id"]}, {"$set": {"hash": key}}))
+
+    operations = []
+    for old_id, new_id in rewire.items():
+        operations.append(pymongo.UpdateMany({"board_start": old_id}, {"$set": {"board_start": new_id}}))
+        operations.append(pymongo.UpdateMany({"board_end": old_id}, {"$set": {"board_end": new_id}}))
+    _bulk_write(db.moves, operations, batch_size)
+
+    kept = dict()
+    openings = []
+    duplicates = []
+    moves = db.moves.find({}, {"board_start": 1, "move": 1, "opening": 1}).sort("_id", pymongo.ASCENDING)
+    for move in moves:
+        key = (move["board_start"], move["move"])
+        if key in kept:
+            openings.append(pymongo.UpdateOne({"_id": kept[key]},
+                                              {"$addToSet": {"opening": {"$each": move["opening"]}}}))
+            duplicates.append(move["_id"])
+        else:
+            kept[key] = move["_id"]
+    _bulk_write(db.moves, openings, batch_size)
+    for i in range(0, len(duplicates), batch_size):
+        db.moves.delete_many({"_id": {"$in": duplicates[i:i+batch_size]}})
+
+    removed = list(rewire)
+    for i in range(0, len(removed), batch_size):
+        db.positions.delete_many({"BoardId": {"$in": removed[i:i+batch_size]}})
+    _bulk_write(db.positions, set_hash, batch_size)
+    db.positions.create_index("hash", unique=True, sparse=True)
+    if rewire or duplicates:
+        MongoStorage(db).touch_repertoire()
+    return len(rewire), len(duplicates)
+
+
+def backfill_san(db, batch_size=1000):
+    """Store the SAN of every move, which was inserted before it was stored with the move.
+    Returns the number of updated moves.
+    """
+    updated = 0
+    moves = db.moves.find({"san": {"$exists": False}}, {"board_start": 1, "move": 1})
+    while True:
+        batch = [move for _, move in zip(range(batch_size), moves)]
+        if not batch:
+            return updated
+        board_ids = list(set(move["board_start"] for move in batch))
+        fens = dict((pos["BoardId"], pos["fen"])
+                    for pos in db.positions.find({"BoardId": {"$in": board_ids}}, {"BoardId": 1, "fen": 1}))
+        boards = dict()
+        operations = []
+        for move in batch:
+            if move["board_start"] not in fens:
+                continue
+            if move["board_start"] not in boards:
+                boards[move["board_start"]] = chess.Board(fens[move["board_start"]])
+            san = boards[move["board_start"]].san(chess.Move.from_uci(move["move"]))
+            operations.append(pymongo.UpdateOne({"_id": move["_id"]}, {"$set": {"san": san}}))
+        _bulk_write(db.moves, operations, batch_size)
+        updated += len(operations)
+
+
+def backfill_date_due(db, batch_size=1000):
+    """Store the due date of every reviewed move, which was reviewed before it was
+    stored with the move (date_last_reviewed + days_between_reviews), otherwise the
+    due queries treat the move as never reviewed. Returns the number of updated moves.
+    """
+    updated = 0
+    moves = db.moves.find({"date_last_reviewed": {"$ne": None}, "date_due": {"$exists": False}},
+                          {"date_last_reviewed": 1, "days_between_reviews": 1})
+    while True:
+        batch = [move for _, move in zip(range(batch_size), moves)]
+        if not batch:
+            return updated
+        operations = []
+        for move in batch:
+            date_last_reviewed = move["date_last_reviewed"]
+            if isinstance(date_last_reviewed, int):
+                date_last_reviewed = datetime.fromtimestamp(date_last_reviewed)
+            days = move.get("days_between_reviews", scheduling.DEFAULT_DAYS_BETWEEN_REVIEWS)
+            operations.append(pymongo.UpdateOne({"_id": move["_id"]},
+                                                {"$set": {"date_due": date_last_reviewed + timedelta(days=days)}}))
+        _bulk_write(db.moves, operations, batch_size)
+        updated += len(operations)
+
+
+def migrate(db):
+    positions, moves = merge_duplicate_positions(db)
+    print("Merged {0} positions and {1} moves.".format(positions, moves))
+    print("Stored the SAN of {0} moves.".format(backfill_san(db)))
+    print("Stored the due date of {0} moves.".format(backfill_date_due(db)))
+
+
+if __name__ == "__main__":
+    migrate(MongoClient()[sys.argv[1]])
@@ -0,0 +1,176 @@
+"""Spaced repetition scheduling of moves.
+
+review is the scheduling formula used by the Trainer, it works elementwise
+on scalars aswell as numpy arrays. ReviewSchedule loads the review state
+of every move of an opening into arrays to answer questions about the whole
+repertoire (due moves, overdue ratios, forecast) in one vectorized pass.
+"""
+from datetime import datetime
+
+import numpy as np
+
+DEFAULT_DIFFICULTY = 0.3
+DEFAULT_DAYS_BETWEEN_REVIEWS = 3
+SECONDS_PER_DAY = 24*60*60
+# Shortest review interval (one hour), so intervals grow again after wrong answers
+MIN_DAYS_BETWEEN_REVIEWS = 1/24.
+MAX_OVERDUE = 10
+MIN_PRIORITY = 1e-3
+
+
+def review(difficulty, days_between_reviews, days_since_review, performance):
+    """Update the review state of answered moves.
+
+    Args:
+        difficulty: difficulty of the move between 0 and 1
+        days_between_reviews: current review interval in (fractional) days
+        days_since_review: days since the last review, nan if it was never reviewed
+        performance: True for a correct answer, False for a wrong one
+
+    Returns:
+        (difficulty, days_between_reviews) after the review,
+        the interval is at least MIN_DAYS_BETWEEN_REVIEWS
+    """
+    difficulty = np.asarray(difficulty, dtype=float)
+    days_between_reviews = np.asarray(days_between_reviews, dtype=float)
+    days_since_review = np.asarray(days_since_review, dtype=float)
+    performance = np.asarray(performance, dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overdue = np.minimum(2, days_since_review/days_between_reviews)
+    overdue = np.where(np.isnan(overdue), 2, overdue)
+    percent_overdue = np.where(performance > 0, overdue, 1)
+
+    difficulty = np.clip(difficulty + percent_overdue*1/17.*(8-9*performance), 0, 1)
+    difficulty_weight = 3-1.7*difficulty
+    days_between_reviews = np.where(performance > 0,
+                                    days_between_reviews*(1+(difficulty_weight-1)*percent_overdue),
+                                    np.minimum(1, days_between_reviews*1./(difficulty_weight**2)))
+    return difficulty, np.maximum(days_between_reviews, MIN_DAYS_BETWEEN_REVIEWS)
+
+
+def priority(difficulty, overdue):
+    """Review priority of moves: the overdue ratio (time since the last review
+    relative to the review interval, nan if never reviewed) weighted by the difficulty.
+    Moves which were never reviewed count as twice overdue, the ratio of moves
+    with an interval of 0 days is capped at MAX_OVERDUE and every move keeps
+    at least MIN_PRIORITY, so the priorities can be used as finite weights.
+    """
+    overdue = np.asarray(overdue, dtype=float)
+    overdue = np.nan_to_num(overdue, nan=2, posinf=MAX_OVERDUE, neginf=0)
+    overdue = np.clip(overdue, 0, MAX_OVERDUE)
+    return np.maximum(overdue*(0.5+np.asarray(difficulty, dtype=float)), MIN_PRIORITY)
+
+
+def _to_datetime(date):
+    if isinstance(date, int):
+        return datetime.fromtimestamp(date)
+    return date
+
+
+class ReviewSchedule:
+    """Review state of all moves of an opening as numpy arrays.
+    Dates are datetime64[s], moves which were never reviewed have NaT as last review.
+    """
+    FIELDS = ("color", "difficulty", "date_last_reviewed", "days_between_reviews")
+
+    def __init__(self, moves):
+        moves = list(moves)
+        self.ids = np.array([move["_id"] for move in moves], dtype=object)
+        self.color = np.array([bool(move.get("color")) for move in moves], dtype=bool)
+        self.difficulty = np.array([move.get("difficulty", DEFAULT_DIFFICULTY) for move in moves],
+                                   dtype=float)
+        self.days_between_reviews = np.array([move.get("days_between_reviews", DEFAULT_DAYS_BETWEEN_REVIEWS)
+                                              for move in moves], dtype=float)
+        self.date_last_reviewed = np.array([_to_datetime(move.get("date_last_reviewed")) for move in moves],
+                                           dtype="datetime64[s]")
+
+    @staticmethod
+    def from_db(db, opening):
+        return ReviewSchedule(db.find_moves(opening=opening, fields=ReviewSchedule.FIELDS))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def date_due(self):
+        return self.date_last_reviewed + (self.days_between_reviews*SECONDS_PER_DAY).astype("timedelta64[s]")
+
+    def due(self, now=None, color=None):
+        """Boolean mask of the moves, which need a review."""
+        now = self._now(now)
+        due = np.isnat(self.date_last_reviewed) | (self.date_due < now)
+        return self._of_color(due, color)
+
+    def overdue(self, now=None):
+        """Time since the last review relative to the review interval (nan if never reviewed)."""
+        now = self._now(now)
+        elapsed = (now - self.date_last_reviewed)/np.timedelta64(1, "D")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return elapsed/self.days_between_reviews
+
+    def forecast(self, days=30, now=None, color=None):
+        """Number of reviews for each of the next days.
+        Day 0 contains all moves, which are already due (or never reviewed).
+        """
+        now = self._now(now)
+        today = now.astype("datetime64[D]")
+        day = (self.date_due.astype("datetime64[D]") - today).astype(float)
+        day = np.where(np.isnat(self.date_last_reviewed), 0, np.maximum(day, 0))
+        day = self._of_color(day, color, fill=-1)
+        day = day[(day >= 0) & (day < days)].astype(int)
+        return np.bincount(day, minlength=days)
+
+    def summary(self, days=30, now=None, color=None):
+        """Statistics of the schedule as json serializable dict."""
+        now = self._now(now)
+        overdue = self._of_color(self.overdue(now), color, fill=np.nan)
+        due = self.due(now, color)
+        reviewed = overdue[np.isfinite(overdue)]
+        return {"moves": int(len(self) if color is None else np.count_nonzero(self.color == color)),
+                "due": int(np.count_nonzero(due)),
+                "never_reviewed": int(np.count_nonzero(self._of_color(np.isnat(self.date_last_reviewed), color))),
+                "mean_overdue": float(reviewed.mean()) if len(reviewed) else 0.,
+                "forecast": self.forecast(days, now, color).tolist()}
+
+    def review(self, performance, mask=None, now=None):
+        """Apply the review formula to all moves (or the moves in mask) at once,
+        e.g. to mark a freshly imported opening as known.
+        """
+        now = self._now(now)
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        days_since = (now - self.date_last_reviewed[mask])/np.timedelta64(1, "D")
+        difficulty, days = review(self.difficulty[mask], self.days_between_reviews[mask],
+                                  days_since, performance)
+        self.difficulty[mask] = difficulty
+        self.days_between_reviews[mask] = days
+        self.date_last_reviewed[mask] = now
+
+    def write(self, db, batch_size=1000):
+        """Store the review state and due date of every reviewed move in batches.
+        Used to re-run the schedule, e.g. after the scheduling formula changed.
+        """
+        last_reviewed = self.date_last_reviewed.astype(object)
+        date_due = self.date_due.astype(object)
+        operations = []
+        for i in np.flatnonzero(~np.isnat(self.date_last_reviewed)):
+            operations.append(({"_id": self.ids[i]},
+                               {"difficulty": float(self.difficulty[i]),
+                                "date_last_reviewed": last_reviewed[i],
+                                "days_between_reviews": float(self.days_between_reviews[i]),
+                                "date_due": date_due[i]}))
+        for i in range(0, len(operations), batch_size):
+            db.update_moves(operations[i:i+batch_size])
+        return len(operations)
+
+    def _of_color(self, values, color, fill=False):
+        if color is None:
+            return values
+        return np.where(self.color == color, values, fill)
+
+    @staticmethod
+    def _now(now):
+        if now is None:
+            now = datetime.now()
+        return np.datetime64(now, "s")
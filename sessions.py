@@ -0,0 +1,168 @@
+"""Session scoped Explorer and Trainer instances.
+
+Every browser session gets its own Explorer and Trainer, which are kept in a
+bounded LRU pool and evicted when they were idle too long. The light state of a
+session (history, board, opening, review queue cursor) is stored in the db after
+every request, which changed it, so any worker process can rebuild a session it
+has not seen yet or whose state was changed by another worker.
+Buffered review updates are not part of the state, they are written by the flush
+policy of the Trainer and when the session is evicted, a crashed worker loses them.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pymongo
+
+from explorer import Explorer, PositionCache, Trainer
+
+
+class Session:
+    """The Explorer and Trainer of one session.
+    The lock is held while a request uses the session.
+    """
+    def __init__(self, session_id, explorer, trainer):
+        self.id = session_id
+        self.explorer = explorer
+        self.trainer = trainer
+        self.version = 0
+        # The state as of the last load or save
+        self.saved = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def state(self):
+        return {"explorer": self.explorer.state(),
+                "trainer": self.trainer.state()}
+
+    def restore(self, state):
+        self.explorer.restore(state["explorer"])
+        self.trainer.restore(state["trainer"])
+
+    def close(self):
+        """Write the buffered review updates."""
+        self.trainer.close()
+
+
+class SessionStore:
+    """Session states in a collection, unused sessions expire after max_age seconds."""
+    def __init__(self, collection, max_age=30*24*60*60):
+        self.collection = collection
+        self.max_age = max_age
+
+    def ensure_indexes(self):
+        self.collection.create_index([("updated", pymongo.ASCENDING)], expireAfterSeconds=self.max_age)
+
+    def load(self, session_id):
+        """Return the stored (version, state) of the session, (0, None) if it is unknown."""
+        document = self.collection.find_one({"_id": session_id})
+        if document is None:
+            return 0, None
+        return document["version"], document["state"]
+
+    def save(self, session_id, version, state):
+        self.collection.replace_one({"_id": session_id},
+                                    {"version": version, "state": state, "updated": datetime.now()},
+                                    upsert=True)
+
+
+class SessionPool:
+    """Bounded LRU pool of sessions.
+
+    Args:
+        user: db of the Explorer and Trainer
+        client: shared MongoClient
+        flush_policy: one of explorer.FLUSH_POLICIES
+        maxsize: maximal number of sessions kept in memory
+        max_idle: sessions unused for max_idle seconds are evicted
+        store: SessionStore of the light session states, None to keep sessions only in memory
+        position_cache: explorer.PositionCache shared by all sessions, a new one if None
+    """
+    def __init__(self, user, client, flush_policy="batched", maxsize=64, max_idle=30*60, store=None,
+                 position_cache=None):
+        self.user = user
+        self.client = client
+        self.position_cache = PositionCache() if position_cache is None else position_cache
+        self.flush_policy = flush_policy
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.store = store
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, session_id):
+        """Return the session and hold its lock until release.
+        The repertoire is loaded again if another worker changed it,
+        a session whose state is newer in the store is restored from it.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id,
+                                  Explorer(self.user, self.client, self.position_cache),
+                                  Trainer(self.user, self.flush_policy, self.client, self.position_cache))
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+        session.lock.acquire()
+        try:
+            session.last_used = time.time()
+            session.explorer.refresh()
+            if self.store is not None:
+                version, state = self.store.load(session_id)
+                if state is not None and version != session.version:
+                    session.restore(state)
+                    session.version = version
+                    session.saved = state
+        except Exception:
+            session.lock.release()
+            raise
+        self.evict()
+        return session
+
+    def release(self, session):
+        """Store the state of the session, if it changed, and release its lock."""
+        try:
+            if self.store is not None:
+                state = session.state()
+                if state != session.saved:
+                    self.store.save(session.id, session.version+1, state)
+                    session.version += 1
+                    session.saved = state
+        finally:
+            session.lock.release()
+
+    def evict(self):
+        """Evict idle sessions and the least recently used sessions above maxsize.
+        Sessions in use are skipped, evicted sessions write their buffered updates.
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            excess = len(self._sessions) - self.maxsize
+            for session_id, session in list(self._sessions.items()):
+                idle = self.max_idle is not None and now - session.last_used > self.max_idle
+                if not idle and excess <= 0:
+                    break
+                if not session.lock.acquire(False):
+                    continue
+                del self._sessions[session_id]
+                evicted.append(session)
+                excess -= 1
+        for session in evicted:
+            try:
+                session.close()
+            finally:
+                session.lock.release()
+        return len(evicted)
+
+    def close(self):
+        """Evict all sessions."""
+        maxsize, self.maxsize = self.maxsize, 0
+        try:
+            return self.evict()
+        finally:
+            self.maxsize = maxsize
+
+    def __len__(self):
+        return len(self._sessions)
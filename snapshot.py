@@ -0,0 +1,144 @@
+"""Read only snapshots of a repertoire in the Polyglot opening book format.
+
+export writes the moves of an opening (or of the whole repertoire) sorted by
+the zobrist hash of their position into a .bin file, every entry is 16 bytes.
+The review state of the moves is stored in a numpy sidecar (<path>.review.npy)
+in the same order, the learn field of an entry is its index in the sidecar.
+Snapshot maps both files to memory and answers the candidate moves of a
+position with a binary search, without a db.
+
+Usage: python snapshot.py <user> <path> [--opening ID] [--storage URI]
+"""
+import argparse
+import struct
+import sys
+from datetime import datetime
+
+import numpy as np
+
+import chess
+import chess.polyglot
+
+from explorer import position_hash
+from storage import create_client, open_storage
+
+ENTRY = struct.Struct(">QHHI")
+REVIEW_DTYPE = np.dtype([("board_start", "<i8"),
+                         ("board_end", "<i8"),
+                         ("difficulty", "<f4"),
+                         ("days_between_reviews", "<f4"),
+                         ("date_last_reviewed", "<M8[s]")])
+CASTLING = {"e1g1": "e1h1", "e1c1": "e1a1", "e8g8": "e8h8", "e8c8": "e8a8"}
+
+
+def sidecar_path(path):
+    return path + ".review.npy"
+
+
+def polyglot_key(key):
+    """The unsigned polyglot key of a (signed) position hash."""
+    return key & 0xFFFFFFFFFFFFFFFF
+
+
+def encode_move(uci, fen):
+    """Polyglot encoding of the move played in the position fen.
+    Castling is encoded as the king capturing its rook."""
+    if uci in CASTLING and chess.Board(fen).piece_type_at(chess.parse_square(uci[:2])) == chess.KING:
+        uci = CASTLING[uci]
+    move = chess.Move.from_uci(uci)
+    promotion = move.promotion - 1 if move.promotion else 0
+    return move.to_square | (move.from_square << 6) | (promotion << 12)
+
+
+def export(db, path, opening=None):
+    """Write the moves of the opening (all moves if opening is None) of the Storage db
+    to the Polyglot book path and their review state to the sidecar.
+    Returns the number of written moves.
+    """
+    moves = list(db.find_moves(opening=opening))
+    pos_ids = set(move["board_start"] for move in moves)
+    positions = dict((pos["BoardId"], pos) for pos in db.find_positions(pos_ids))
+
+    entries = []
+    for move in moves:
+        pos = positions.get(move["board_start"])
+        if pos is None:
+            continue
+        key = pos.get("hash")
+        if key is None:
+            key = position_hash(chess.Board(pos["fen"]))
+        entries.append((polyglot_key(key), encode_move(move["move"], pos["fen"]), move))
+    entries.sort(key=lambda entry: entry[:2])
+
+    review = np.zeros(len(entries), dtype=REVIEW_DTYPE)
+    with open(path, "wb") as book:
+        for i, (key, raw_move, move) in enumerate(entries):
+            book.write(ENTRY.pack(key, raw_move, 1, i))
+            review[i] = (move["board_start"], move["board_end"],
+                         move.get("difficulty", 0.3), move.get("days_between_reviews", 3),
+                         np.datetime64(move["date_last_reviewed"], "s")
+                         if move.get("date_last_reviewed") else np.datetime64("NaT"))
+    np.save(sidecar_path(path), review)
+    return len(entries)
+
+
+class Snapshot:
+    """Memory mapped Polyglot book and review sidecar written by export."""
+    def __init__(self, path):
+        self.book = chess.polyglot.MemoryMappedReader(path)
+        self.review = np.load(sidecar_path(path), mmap_mode="r")
+
+    def moves(self, board):
+        """(chess.Move, review record) of every move of the position.
+        board is a chess.Board or a position hash (signed or unsigned).
+        Without a board castling moves are returned as king captures rook.
+        """
+        if not isinstance(board, chess.Board):
+            board = polyglot_key(board)
+        return [(entry.move, self.review[entry.learn]) for entry in self.book.find_all(board)]
+
+    def due(self, board, now=None):
+        """The moves of the position, which need a review."""
+        now = np.datetime64(now or datetime.now(), "s")
+        due = []
+        for move, review in self.moves(board):
+            last = review["date_last_reviewed"]
+            interval = np.timedelta64(int(review["days_between_reviews"]*24*60*60), "s")
+            if np.isnat(last) or last + interval < now:
+                due.append(move)
+        return due
+
+    def __contains__(self, board):
+        if isinstance(board, chess.Board):
+            board = chess.polyglot.zobrist_hash(board)
+        key = polyglot_key(board)
+        index = self.book.bisect_key_left(key)
+        return index < len(self.book) and self.book[index].key == key
+
+    def __len__(self):
+        return len(self.book)
+
+    def close(self):
+        self.book.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("user")
+    parser.add_argument("path")
+    parser.add_argument("--opening", type=int, help="id of the opening (default: whole repertoire)")
+    parser.add_argument("--storage", default="mongodb://localhost:27017",
+                        help="mongodb uri, sqlite:<directory> or memory")
+    args = parser.parse_args(argv)
+    written = export(open_storage(create_client(args.storage), args.user), args.path, args.opening)
+    print("Exported {0} moves to {1}.".format(written, args.path))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
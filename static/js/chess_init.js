@@ -4,6 +4,13 @@ var board,
   fenEl = $('#fen'),
   pgnEl = $('#pgn');
 
+// Prefetched tree of the selected opening, the board is navigated on the client
+// and only writes (new or removed moves) are sent to the server.
+var repertoire = {"opening": null, "children": {}},
+  current = 0,
+  path = [],
+  redoStack = [];
+
 // do not pick up pieces if the game is over
 // only pick up pieces for the side to move
 var onDragStart = function(source, piece, position, orientation) {
@@ -36,7 +43,7 @@ var onSnapEnd = function() {
 };
 
 var sendMove = function(source, target) {
-    var moves = {"new": {"source" : source, "target" : target}};
+    var moves = {"new": {"source" : source, "target" : target}, "board": current};
 
     $.ajax({
       type: "POST",
@@ -45,8 +52,29 @@ var sendMove = function(source, target) {
       dataType: 'json',
       success: function(response) {
           console.log(response);
+          path.push({"from": current, "to": response.board, "uci": source+target, "san": response.move});
+          current = response.board;
+          redoStack = [];
           updateMoveList(response);
           showCandidateMoves(response.candidates);
+          loadTree();
+      },
+      error: function(error) {
+          console.log(error);
+      }
+    });
+};
+
+// Fetch the tree of the selected opening, unchanged trees are answered with 304
+var loadTree = function(callback) {
+    if (repertoire.opening === null) return;
+    $.ajax({
+      type: "GET",
+      url: "/openings/"+repertoire.opening+"/tree",
+      dataType: 'json',
+      success: function(response) {
+          setTree(response);
+          if (callback) callback();
       },
       error: function(error) {
           console.log(error);
@@ -54,6 +82,57 @@ var sendMove = function(source, target) {
     });
 };
 
+var setTree = function(tree) {
+    repertoire.children = {};
+    for (var i=0;i<tree.edges.length;i++) {
+        var edge = tree.edges[i];
+        var children = repertoire.children[edge[0]] || [];
+        children.push({"from": edge[0], "to": edge[1], "uci": edge[2], "san": edge[3], "major": edge[4] === 1});
+        repertoire.children[edge[0]] = children;
+    }
+};
+
+var selectOpening = function(opening, boardId) {
+    repertoire.opening = opening;
+    current = boardId;
+    path = [];
+    redoStack = [];
+    loadTree();
+};
+
+var candidateMoves = function(boardId) {
+    var candidates = {"major": [], "minor": []};
+    var children = repertoire.children[boardId] || [];
+    for (var i=0;i<children.length;i++) {
+        if (children[i].major) {
+            candidates.major.push(children[i].san);
+        }
+        else {
+            candidates.minor.push(children[i].san);
+        }
+    }
+    return candidates;
+};
+
+var findChild = function(boardId, san) {
+    var children = repertoire.children[boardId] || [];
+    for (var i=0;i<children.length;i++) {
+        if (children[i].major && children[i].san === san) return children[i];
+    }
+    return null;
+};
+
+// Play an edge of the tree without asking the server
+var playEdge = function(edge) {
+    game.move(edge.san);
+    board.position(game.fen(), true);
+    path.push(edge);
+    current = edge.to;
+    updateMoveList({"move": edge.san});
+    showCandidateMoves(candidateMoves(current));
+    updateStatus();
+};
+
 var clearMoveList = function(response) {
     $("#pgn-table tbody").empty();
 
@@ -152,12 +231,16 @@ updateStatus();
 // PGN Navigation
 
 var removeMove = function(e) {
+    var edge = path.pop();
+    if (!edge) return;
 
     game.undo();
     board.position(game.fen(), true);
     removeLastMove();
+    current = edge.from;
+    redoStack = [];
 
-    var moves = {"remove": game.fen()};
+    var moves = {"remove": game.fen(), "board": edge.from, "move": edge.uci};
     $.ajax({
       type: "POST",
       url: "/moves",
@@ -166,6 +249,7 @@ var removeMove = function(e) {
       success: function(response) {
           console.log(response);
           showCandidateMoves(response.candidates);
+          loadTree();
       },
       error: function(error) {
           console.log(error);
@@ -180,52 +264,30 @@ $("#remove-move-btn").on("click", removeMove);
 // Board Navigation
 
 var forward = function(e) {
-    var moves = {"next": game.fen()};
-    $.ajax({
-      type: "POST",
-      url: "/moves",
-      data: $.param(moves),
-      dataType: 'json',
-      success: function(response) {
-          console.log(response);
-          game.move(response.move);
-          board.position(game.fen(), true);
-          updateMoveList(response);
-          showCandidateMoves(response.candidates);
-      },
-      error: function(error) {
-          console.log(error);
-      }
-    });
+    var edge = redoStack.pop();
+    if (!edge) return;
+    playEdge(edge);
 };
 
 var backward = function(e) {
+    var edge = path.pop();
+    if (!edge) return;
     game.undo();
     board.position(game.fen(), true);
     removeLastMove();
-
-    var moves = {"previous": game.fen()};
-    $.ajax({
-      type: "POST",
-      url: "/moves",
-      data: $.param(moves),
-      dataType: 'json',
-      success: function(response) {
-          console.log(response);
-          showCandidateMoves(response.candidates);
-      },
-      error: function(error) {
-          console.log(error);
-      }
-    });
-
+    redoStack.push(edge);
+    current = edge.from;
+    showCandidateMoves(candidateMoves(current));
+    updateStatus();
 };
 
 var candidate_onclick = function(e) {
     if($(this).hasClass("major_candidate")){
-        var move = game.move($(this).text());
-        board.position(game.fen(), true);
-        sendMove(move.from, move.to);
+        var edge = findChild(current, $(this).text());
+        if (edge) {
+            redoStack = [];
+            playEdge(edge);
+        }
     }
 };
 
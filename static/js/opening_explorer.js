@@ -27,22 +27,32 @@ $.ajax({
     });
 
 
+// Badges with the due and total number of moves of the opening
+var opening_tags = function(statistics) {
+    if (!statistics) {
+        return [];
+    }
+    return [statistics["due"] + " due", statistics["moves"] + " moves"];
+};
+
 var init_tree = function(openings) {
     var white = openings["white"];
     var black = openings["black"];
+    var statistics = openings["statistics"] || {"White": {}, "Black": {}};
 
     defaultData[0]["nodes"] = [];
     defaultData[1]["nodes"] = [];
     for(var i=0;i<white.length;i++){
-        var node = {"text": white[i]};
+        var node = {"text": white[i], "tags": opening_tags(statistics["White"][white[i]])};
         defaultData[0]["nodes"].push(node);
     }
     for(var i=0;i<black.length;i++){
-        var node = {"text": black[i]};
+        var node = {"text": black[i], "tags": opening_tags(statistics["Black"][black[i]])};
         defaultData[1]["nodes"].push(node);
     }
     $('#Opening_Explorer').treeview({
         data: defaultData,
+        showTags: true,
         'onNodeSelected': node_selected,
     });
 };
@@ -64,6 +74,9 @@ var node_selected =  function(event, data) {
           board.position("start");
           game.reset();
           clearMoveList();
+          if (typeof selectOpening === "function") {
+              selectOpening(response.opening, response.board);
+          }
           $('#opening_dropdown_icon').parent().click();
       },
       error: function(error) {
@@ -1,5 +1,8 @@
 var board,
     correct_move,
+    // legal moves (uci: san) and other accepted answers of the position, sent by the server
+    legal_moves = {},
+    answers = [],
     full_training = false,
   game = new Chess();
 
@@ -15,22 +18,23 @@ var onDragStart = function(source, piece, position, orientation) {
 
 var onDrop = function(source, target) {
   // see if the move is legal
-  var move = game.move({
-    from: source,
-    to: target,
-    promotion: 'q' // NOTE: always promote to a queen for example simplicity
-  });
-
-  if (move === null) return 'snapback';
-  // illegal move
-  var san = move.from+move.to;
-
-  if (san !== correct_move){
-    wrongMove(san);
+  var uci = source+target;
+  if (!(uci in legal_moves)) {
+    uci = uci+'q'; // NOTE: always promote to a queen for example simplicity
+    if (!(uci in legal_moves)) return 'snapback';
+  }
+
+  if (uci !== correct_move){
+    if (answers.indexOf(uci) !== -1) {
+      $("#status").text(legal_moves[uci]+" is in the repertoire, but another move is asked");
+      return 'snapback';
+    }
+    wrongMove(uci);
     return 'snapback';
   }
 
-  correctMove(san);
+  game.move({from: source, to: target, promotion: 'q'});
+  correctMove(uci);
   //sendMove(source, target);
 };
 
@@ -59,13 +63,12 @@ var sendMove = function(source, target) {
 };
 
 var wrongMove = function(move) {
-    game.undo();
     send_performance("wrong", move);
     $("#status").text("Wrong");
 };
 
 var correctMove = function(move) {
-    $("#status").text("Correct");
+    $("#status").text("Correct: "+legal_moves[move]);
     //$("#training_load_position").click();
     send_performance("correct", move);
     next_position();
@@ -103,20 +106,27 @@ var cfg = {
 board = ChessBoard('board', cfg);
 
 
+var show_position = function(response){
+    var fen = response[0];
+    correct_move = response[1];
+    legal_moves = response[2].legal;
+    answers = response[2].answers;
+    if(game.load(fen)){
+      board.position(fen);
+    }
+};
+
 var load_position = function(event){
-    var send = {"load": "random"};
+    var send = {"load": event.data.load};
     $.ajax({
       type: "POST",
       url: "/positions",
       dataType: 'json',
       data: $.param(send),
       success: function(response) {
-          var fen = response[0];
-          correct_move = response[1];
-          if(game.load(fen)){
-            board.position(fen);
+          if(response !== "finished"){
+              show_position(response);
           }
-          console.log(response);
       },
       error: function(error) {
           console.log(error);
@@ -125,7 +135,7 @@ var load_position = function(event){
 };
 
 var train_opening = function(event){
-    var send = {"load": "full"};
+    var send = {"load": event.data.load};
     $.ajax({
       type: "POST",
       url: "/positions",
@@ -137,11 +147,7 @@ var train_opening = function(event){
           }
           else {
               full_training = true;
-              var fen = response[0];
-              correct_move = response[1];
-              if(game.load(fen)){
-                board.position(fen);
-              }
+              show_position(response);
           }
       },
       error: function(error) {
@@ -165,11 +171,7 @@ var next_position = function(){
               }
               else {
                   full_training = true;
-                  var fen = response[0];
-                  correct_move = response[1];
-                  if(game.load(fen)){
-                    board.position(fen);
-                  }
+                  show_position(response);
               }
           },
           error: function(error) {
@@ -198,5 +200,7 @@ var send_performance = function(performance, move){
 };
 
 
-$("#training_load_position").on("click", load_position);
-$("#training_full_opening").on("click", train_opening);
+$("#training_load_position").on("click", {"load": "random"}, load_position);
+$("#training_load_weighted").on("click", {"load": "weighted"}, load_position);
+$("#training_full_opening").on("click", {"load": "full"}, train_opening);
+$("#training_due").on("click", {"load": "due"}, train_opening);
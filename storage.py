@@ -0,0 +1,1036 @@
+"""Storage backends of a repertoire.
+
+Explorer and Trainer only talk to a Storage, which holds the positions, moves,
+openings and review state of one user. Documents are plain dicts shaped like
+the mongodb documents:
+
+    position: {"BoardId", "fen", "hash"}
+    move:     {"_id", "board_start", "board_end", "move", "san", "color", "opening": [ids],
+               "difficulty", "date_last_reviewed", "days_between_reviews", "date_due"}
+    opening:  {"id", "name", "color", "revision"}
+
+MongoStorage stores them in mongodb, SQLiteStorage in an embedded sqlite file
+and MemoryStorage only in memory. A client returns the storage of a user
+with client[user], like a MongoClient returns the database.
+"""
+import asyncio
+import contextvars
+import functools
+import itertools
+import os
+import random
+import sqlite3
+import threading
+from datetime import datetime
+
+import pymongo
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+REVIEW_FIELDS = ("difficulty", "date_last_reviewed", "days_between_reviews", "date_due")
+
+
+class DuplicatePositionError(Exception):
+    """A position with the hash of an inserted position already exists,
+    e.g. because another process inserted it. The other positions are inserted."""
+    def __init__(self, hashes):
+        super().__init__("Positions already exist: {0}".format(hashes))
+        self.hashes = hashes
+
+
+class Storage:
+    """Interface of the storage backends.
+    Moves are identified for updates by a filter, either {"_id": id} or
+    {"board_start": from_id, "board_end": to_id}.
+    """
+    name = None
+
+    def ensure_indexes(self):
+        """Create the indexes of the hot path queries."""
+
+    def find_positions(self, board_ids=None):
+        """Position documents with the BoardIds, all positions if board_ids is None."""
+        raise NotImplementedError
+
+    def insert_positions(self, documents):
+        """Insert the position documents, raises DuplicatePositionError
+        if the hash of a position is already in use."""
+        raise NotImplementedError
+
+    def delete_positions(self, board_ids):
+        raise NotImplementedError
+
+    def find_moves(self, opening=None, board_start=None, board_end=None, fields=None):
+        """Move documents matching all given arguments. With fields only these fields
+        (and "_id") are returned."""
+        raise NotImplementedError
+
+    def variation(self, opening, root=0, fields=None):
+        """Move documents of the opening, which are reachable from root with moves of the opening.
+        With fields only these fields (and "_id") are returned."""
+        raise NotImplementedError
+
+    def sample_moves(self, opening, color, size):
+        """Up to size random move documents of the opening with the side to move color,
+        the position the move is played from is joined as list under "position"."""
+        raise NotImplementedError
+
+    def due_moves(self, openings, color, now, after=None, limit=100):
+        """Up to limit move documents of any of the openings (ids) with the side to move color,
+        which are due at now, in the order they became due: never reviewed moves first
+        (by "_id"), then by "date_due" and "_id".
+        after is the (date_due, _id) of the last move of the previous page.
+        """
+        raise NotImplementedError
+
+    def insert_moves(self, documents):
+        """Insert the move documents, their "_id" is set."""
+        raise NotImplementedError
+
+    def add_opening(self, moves, opening):
+        """Add the opening to the moves given as (board_start, uci) pairs."""
+        raise NotImplementedError
+
+    def pull_opening(self, opening):
+        """Remove the opening from every move."""
+        raise NotImplementedError
+
+    def delete_moves(self, ids):
+        raise NotImplementedError
+
+    def update_moves(self, updates):
+        """Set the fields of the moves, updates are (filter, fields) pairs."""
+        raise NotImplementedError
+
+    def find_opening(self, name=None, color=None, id=None):
+        """The opening document matching all given arguments, None if it does not exist."""
+        raise NotImplementedError
+
+    def find_openings(self, color=None):
+        raise NotImplementedError
+
+    def insert_opening(self, document):
+        raise NotImplementedError
+
+    def delete_opening(self, name, color):
+        raise NotImplementedError
+
+    def touch_openings(self, ids=None):
+        """Increase the revision of the openings, of all openings if ids is None."""
+        raise NotImplementedError
+
+    def repertoire_revision(self):
+        """Revision of the positions and moves (0 if they were never changed)."""
+        raise NotImplementedError
+
+    def touch_repertoire(self):
+        """Increase the revision of the positions and moves, returns the new revision."""
+        raise NotImplementedError
+
+    def moves_from(self, board_ids, openings=None):
+        """Move documents (board_start, board_end and opening) played from any
+        of the positions, only moves of the openings (ids) if they are given."""
+        raise NotImplementedError
+
+    def opening_statistics(self, openings, now):
+        """Statistics of the moves of every opening as dict keyed by the id:
+        number of moves and positions, moves of the trainee due at now (or never reviewed),
+        mean difficulty and depth (moves from the starting position to the farthest position).
+        openings maps the opening ids to the color of the moves of the trainee
+        (False for the moves of White). Openings without moves are missing.
+        """
+        statistics = dict()
+        for (opening, color), (moves, due, difficulty) in self._review_statistics(openings, now).items():
+            current = statistics.setdefault(opening, {"moves": 0, "due": 0, "difficulty": 0.})
+            current["moves"] += moves
+            current["difficulty"] += difficulty*moves
+            if color == openings[opening]:
+                current["due"] += due
+        for opening, (positions, depth) in self._trees(list(statistics)).items():
+            current = statistics[opening]
+            current["difficulty"] /= current["moves"]
+            current["positions"] = positions
+            current["depth"] = depth
+        return statistics
+
+    def _review_statistics(self, openings, now):
+        """(moves, moves due at now, mean difficulty) of the openings (ids)
+        keyed by (opening, color of the moves)."""
+        raise NotImplementedError
+
+    def _trees(self, openings, root=0):
+        """Number of positions and depth of the openings (ids) reachable from root.
+        The trees are walked level by level with one moves_from query per level,
+        so the moves of the openings are never read at once.
+        """
+        visited = dict((opening, set([root])) for opening in openings)
+        depth = dict((opening, 0) for opening in openings)
+        level = dict((opening, set([root])) for opening in openings)
+        while level:
+            board_ids = set().union(*level.values())
+            following = dict()
+            for move in self.moves_from(board_ids, list(level)):
+                for opening in move["opening"]:
+                    if (opening in level and move["board_start"] in level[opening] and
+                            move["board_end"] not in visited[opening]):
+                        visited[opening].add(move["board_end"])
+                        following.setdefault(opening, set()).add(move["board_end"])
+            for opening in following:
+                depth[opening] += 1
+            level = following
+        return dict((opening, (len(visited[opening]), depth[opening])) for opening in openings)
+
+    def reserve_ids(self, collection, field, count, first=0):
+        """Atomically reserve count ids for the field of the collection.
+        The counter starts after the highest id in use, but not below first.
+        Returns the end (exclusive) of the reserved block.
+        """
+        raise NotImplementedError
+
+
+def _reachable(moves, root):
+    """Filter the move documents to the ones reachable from root."""
+    children = dict()
+    for move in moves:
+        children.setdefault(move["board_start"], []).append(move)
+    reachable = []
+    visited = set([root])
+    stack = [root]
+    while stack:
+        for move in children.get(stack.pop(), []):
+            reachable.append(move)
+            if move["board_end"] not in visited:
+                visited.add(move["board_end"])
+                stack.append(move["board_end"])
+    return reachable
+
+
+class MongoStorage(Storage):
+    """Storage in the mongodb database db."""
+    def __init__(self, db):
+        self.db = db
+        self.name = db.name
+        self._seeded = set()
+
+    def ensure_indexes(self):
+        self.db.moves.create_index([("board_start", pymongo.ASCENDING), ("opening", pymongo.ASCENDING)])
+        self.db.moves.create_index("board_end")
+        self.db.moves.create_index([("opening", pymongo.ASCENDING),
+                                    ("color", pymongo.ASCENDING),
+                                    ("date_due", pymongo.ASCENDING)])
+        self.db.positions.create_index("BoardId")
+        self.db.positions.create_index("hash", unique=True, sparse=True)
+        self.db.opening.create_index("id")
+
+    def find_positions(self, board_ids=None):
+        if board_ids is None:
+            return self.db.positions.find()
+        return self.db.positions.find({"BoardId": {"$in": list(board_ids)}})
+
+    def insert_positions(self, documents):
+        if not documents:
+            return
+        try:
+            self.db.positions.insert_many(documents, ordered=False)
+        except BulkWriteError as err:
+            errors = err.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            raise DuplicatePositionError([documents[error["index"]].get("hash") for error in errors])
+
+    def delete_positions(self, board_ids):
+        self.db.positions.delete_many({"BoardId": {"$in": list(board_ids)}})
+
+    def find_moves(self, opening=None, board_start=None, board_end=None, fields=None):
+        query = dict()
+        for key, value in (("opening", opening), ("board_start", board_start), ("board_end", board_end)):
+            if value is not None:
+                query[key] = value
+        projection = None if fields is None else dict((field, 1) for field in fields)
+        return self.db.moves.find(query, projection)
+
+    def variation(self, opening, root=0, fields=None):
+        projection = None
+        if fields is not None:
+            projection = dict((field, 1) for field in set(fields) | set(["board_start", "board_end"]))
+        return _reachable(list(self.db.moves.find({"opening": opening}, projection)), root)
+
+    def sample_moves(self, opening, color, size):
+        return self.db.moves.aggregate([
+            {"$match": {"opening": opening, "color": color}},
+            {"$sample": {"size": size}},
+            {"$lookup": {"from": "positions", "localField": "board_start",
+                         "foreignField": "BoardId", "as": "position"}}])
+
+    def due_moves(self, openings, color, now, after=None, limit=100):
+        # Both queries use the (opening, color, date_due) index
+        query = {"opening": {"$in": list(openings)}, "color": color}
+        moves = []
+        if after is None or after[0] is None:
+            never_reviewed = dict(query, date_due=None)
+            if after is not None:
+                never_reviewed["_id"] = {"$gt": after[1]}
+            moves = list(self.db.moves.find(never_reviewed).sort("_id", pymongo.ASCENDING).limit(limit))
+            after = None
+        if len(moves) < limit:
+            reviewed = dict(query, date_due={"$lt": now})
+            if after is not None:
+                reviewed["$or"] = [{"date_due": {"$gt": after[0]}},
+                                   {"date_due": after[0], "_id": {"$gt": after[1]}}]
+            moves += self.db.moves.find(reviewed).sort([("date_due", pymongo.ASCENDING),
+                                                         ("_id", pymongo.ASCENDING)]).limit(limit-len(moves))
+        return moves
+
+    def insert_moves(self, documents):
+        if documents:
+            self.db.moves.insert_many(documents, ordered=False)
+
+    def add_opening(self, moves, opening):
+        if moves:
+            self.db.moves.bulk_write([pymongo.UpdateOne({"board_start": board_start, "move": uci},
+                                                        {"$addToSet": {"opening": opening}})
+                                      for board_start, uci in moves], ordered=False)
+
+    def pull_opening(self, opening):
+        self.db.moves.update_many({"opening": opening}, {"$pull": {"opening": opening}})
+
+    def delete_moves(self, ids):
+        self.db.moves.delete_many({"_id": {"$in": list(ids)}})
+
+    def update_moves(self, updates):
+        if updates:
+            self.db.moves.bulk_write([pymongo.UpdateOne(find, {"$set": fields}) for find, fields in updates],
+                                     ordered=False)
+
+    def find_opening(self, name=None, color=None, id=None):
+        query = dict()
+        for key, value in (("name", name), ("color", color), ("id", id)):
+            if value is not None:
+                query[key] = value
+        return self.db.opening.find_one(query)
+
+    def find_openings(self, color=None):
+        return self.db.opening.find({} if color is None else {"color": color})
+
+    def insert_opening(self, document):
+        self.db.opening.insert_one(document)
+
+    def delete_opening(self, name, color):
+        self.db.opening.delete_one({"name": name, "color": color})
+
+    def touch_openings(self, ids=None):
+        query = {} if ids is None else {"id": {"$in": list(ids)}}
+        self.db.opening.update_many(query, {"$inc": {"revision": 1}})
+
+    def repertoire_revision(self):
+        counter = self.db.counters.find_one({"_id": "repertoire"})
+        return counter["revision"] if counter else 0
+
+    def touch_repertoire(self):
+        counter = self.db.counters.find_one_and_update({"_id": "repertoire"}, {"$inc": {"revision": 1}},
+                                                       upsert=True, return_document=ReturnDocument.AFTER)
+        return counter["revision"]
+
+    def moves_from(self, board_ids, openings=None):
+        query = {"board_start": {"$in": list(board_ids)}}
+        if openings is not None:
+            query["opening"] = {"$in": list(openings)}
+        return self.db.moves.find(query, {"board_start": 1, "board_end": 1, "opening": 1})
+
+    def _review_statistics(self, openings, now):
+        openings = list(openings)
+        groups = self.db.moves.aggregate([
+            {"$match": {"opening": {"$in": openings}}},
+            {"$unwind": "$opening"},
+            {"$match": {"opening": {"$in": openings}}},
+            {"$group": {"_id": {"opening": "$opening", "color": "$color"},
+                        "moves": {"$sum": 1},
+                        "due": {"$sum": {"$cond": [{"$lt": [{"$ifNull": ["$date_due", None]}, now]}, 1, 0]}},
+                        "difficulty": {"$avg": {"$ifNull": ["$difficulty", 0.3]}}}}],
+            allowDiskUse=True)
+        return dict(((group["_id"]["opening"], group["_id"]["color"]),
+                     (group["moves"], group["due"], group["difficulty"]))
+                    for group in groups)
+
+    def reserve_ids(self, collection, field, count, first=0):
+        key = collection+"."+field
+        if key not in self._seeded:
+            self._seed(collection, field, first)
+        counter = self.db.counters.find_one_and_update({"_id": key},
+                                                       {"$inc": {"next": count}},
+                                                       return_document=ReturnDocument.AFTER)
+        return counter["next"]
+
+    def _seed(self, collection, field, first):
+        """Start the counter after the highest id in use (no-op if it is already ahead)."""
+        key = collection+"."+field
+        current = self.db[collection].find_one(sort=[(field, pymongo.DESCENDING)])
+        start = first
+        if current:
+            start = max(start, current[field]+1)
+        try:
+            self.db.counters.update_one({"_id": key}, {"$max": {"next": start}}, upsert=True)
+        except DuplicateKeyError:
+            # Another writer created the counter at the same time, retry the $max
+            self.db.counters.update_one({"_id": key}, {"$max": {"next": start}})
+        self._seeded.add(key)
+
+
+class MemoryStorage(Storage):
+    """Storage in process memory, e.g. for tests and benchmarks.
+    Documents are copied on the way in and out.
+    """
+    def __init__(self, name="memory"):
+        self.name = name
+        self._positions = dict()
+        self._hashes = dict()
+        self._moves = dict()
+        self._by_start = dict()
+        self._by_end = dict()
+        self._by_opening = dict()
+        self._openings = []
+        self._counters = dict()
+        self._next_move_id = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def find_positions(self, board_ids=None):
+        with self._lock:
+            if board_ids is None:
+                return [dict(pos) for pos in self._positions.values()]
+            return [dict(self._positions[board_id]) for board_id in board_ids if board_id in self._positions]
+
+    def insert_positions(self, documents):
+        duplicates = []
+        with self._lock:
+            for document in documents:
+                key = document.get("hash")
+                if key is not None and key in self._hashes:
+                    duplicates.append(key)
+                    continue
+                self._positions[document["BoardId"]] = dict(document)
+                if key is not None:
+                    self._hashes[key] = document["BoardId"]
+        if duplicates:
+            raise DuplicatePositionError(duplicates)
+
+    def delete_positions(self, board_ids):
+        with self._lock:
+            for board_id in board_ids:
+                position = self._positions.pop(board_id, None)
+                if position is not None:
+                    self._hashes.pop(position.get("hash"), None)
+
+    def find_moves(self, opening=None, board_start=None, board_end=None, fields=None):
+        with self._lock:
+            candidates = None
+            for index, value in ((self._by_opening, opening), (self._by_start, board_start),
+                                 (self._by_end, board_end)):
+                if value is not None:
+                    ids = index.get(value, set())
+                    candidates = ids if candidates is None else candidates & ids
+            if candidates is None:
+                candidates = self._moves.keys()
+            return [self._copy(self._moves[move_id], fields) for move_id in sorted(candidates)]
+
+    def variation(self, opening, root=0, fields=None):
+        if fields is not None:
+            fields = set(fields) | set(["board_start", "board_end"])
+        return _reachable(self.find_moves(opening=opening, fields=fields), root)
+
+    def sample_moves(self, opening, color, size):
+        with self._lock:
+            moves = [move for move in self.find_moves(opening=opening) if move["color"] == color]
+            sample = random.sample(moves, min(size, len(moves)))
+            for move in sample:
+                move["position"] = self.find_positions([move["board_start"]])
+            return sample
+
+    def due_moves(self, openings, color, now, after=None, limit=100):
+        def order(move):
+            due = move.get("date_due")
+            return (due is not None, due or datetime.min, move["_id"])
+
+        with self._lock:
+            ids = set()
+            for opening in openings:
+                ids.update(self._by_opening.get(opening, ()))
+            moves = [move for move in (self._moves[move_id] for move_id in ids)
+                     if move["color"] == color and (move.get("date_due") is None or move["date_due"] < now)]
+            if after is not None:
+                last = (after[0] is not None, after[0] or datetime.min, after[1])
+                moves = [move for move in moves if order(move) > last]
+            return [self._copy(move) for move in sorted(moves, key=order)[:limit]]
+
+    def insert_moves(self, documents):
+        with self._lock:
+            for document in documents:
+                document["_id"] = next(self._next_move_id)
+                move = self._copy(document)
+                self._moves[move["_id"]] = move
+                self._by_start.setdefault(move["board_start"], set()).add(move["_id"])
+                self._by_end.setdefault(move["board_end"], set()).add(move["_id"])
+                for opening in move["opening"]:
+                    self._by_opening.setdefault(opening, set()).add(move["_id"])
+
+    def add_opening(self, moves, opening):
+        with self._lock:
+            for board_start, uci in moves:
+                for move_id in self._by_start.get(board_start, ()):
+                    move = self._moves[move_id]
+                    if move["move"] == uci and opening not in move["opening"]:
+                        move["opening"].append(opening)
+                        self._by_opening.setdefault(opening, set()).add(move_id)
+
+    def pull_opening(self, opening):
+        with self._lock:
+            for move_id in self._by_opening.pop(opening, ()):
+                self._moves[move_id]["opening"].remove(opening)
+
+    def delete_moves(self, ids):
+        with self._lock:
+            for move_id in ids:
+                move = self._moves.pop(move_id, None)
+                if move is None:
+                    continue
+                self._by_start[move["board_start"]].discard(move_id)
+                self._by_end[move["board_end"]].discard(move_id)
+                for opening in move["opening"]:
+                    self._by_opening[opening].discard(move_id)
+
+    def update_moves(self, updates):
+        with self._lock:
+            for find, fields in updates:
+                if "_id" in find:
+                    ids = [find["_id"]] if find["_id"] in self._moves else []
+                else:
+                    ids = self._by_start.get(find["board_start"], set()) & self._by_end.get(find["board_end"], set())
+                for move_id in ids:
+                    self._moves[move_id].update(fields)
+
+    def find_opening(self, name=None, color=None, id=None):
+        with self._lock:
+            for opening in self._openings:
+                if ((name is None or opening["name"] == name) and
+                        (color is None or opening["color"] == color) and
+                        (id is None or opening["id"] == id)):
+                    return dict(opening)
+        return None
+
+    def find_openings(self, color=None):
+        with self._lock:
+            return [dict(opening) for opening in self._openings if color is None or opening["color"] == color]
+
+    def insert_opening(self, document):
+        with self._lock:
+            self._openings.append(dict(document))
+
+    def delete_opening(self, name, color):
+        with self._lock:
+            self._openings = [opening for opening in self._openings
+                              if opening["name"] != name or opening["color"] != color]
+
+    def touch_openings(self, ids=None):
+        with self._lock:
+            for opening in self._openings:
+                if ids is None or opening["id"] in ids:
+                    opening["revision"] = opening.get("revision", 0) + 1
+
+    def repertoire_revision(self):
+        with self._lock:
+            return self._counters.get("repertoire", 0)
+
+    def touch_repertoire(self):
+        with self._lock:
+            self._counters["repertoire"] = self._counters.get("repertoire", 0) + 1
+            return self._counters["repertoire"]
+
+    def moves_from(self, board_ids, openings=None):
+        with self._lock:
+            ids = set().union(*(self._by_start.get(board_id, ()) for board_id in board_ids))
+            if openings is not None:
+                ids &= set().union(*(self._by_opening.get(opening, ()) for opening in openings))
+            return [self._copy(self._moves[move_id], ("board_start", "board_end", "opening"))
+                    for move_id in sorted(ids)]
+
+    def _review_statistics(self, openings, now):
+        groups = dict()
+        with self._lock:
+            for opening in openings:
+                for move_id in self._by_opening.get(opening, ()):
+                    move = self._moves[move_id]
+                    group = groups.setdefault((opening, move["color"]), [0, 0, 0.])
+                    group[0] += 1
+                    group[1] += move.get("date_due") is None or move["date_due"] < now
+                    group[2] += move.get("difficulty", 0.3)
+        return dict((key, (moves, due, difficulty/moves)) for key, (moves, due, difficulty) in groups.items())
+
+    def reserve_ids(self, collection, field, count, first=0):
+        with self._lock:
+            key = collection+"."+field
+            if key not in self._counters:
+                if collection == "positions":
+                    used = self._positions.keys()
+                else:
+                    used = [opening[field] for opening in self._openings]
+                self._counters[key] = max([first] + [value+1 for value in used])
+            self._counters[key] += count
+            return self._counters[key]
+
+    @staticmethod
+    def _copy(document, fields=None):
+        if fields is not None:
+            document = dict((key, value) for key, value in document.items() if key in fields or key == "_id")
+        else:
+            document = dict(document)
+        if "opening" in document:
+            document["opening"] = list(document["opening"])
+        return document
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    BoardId INTEGER PRIMARY KEY,
+    fen TEXT NOT NULL,
+    hash INTEGER UNIQUE
+);
+CREATE TABLE IF NOT EXISTS moves (
+    _id INTEGER PRIMARY KEY,
+    board_start INTEGER NOT NULL,
+    board_end INTEGER NOT NULL,
+    move TEXT NOT NULL,
+    san TEXT,
+    color INTEGER,
+    difficulty REAL,
+    date_last_reviewed REAL,
+    days_between_reviews REAL,
+    date_due REAL
+);
+CREATE TABLE IF NOT EXISTS move_openings (
+    opening INTEGER NOT NULL,
+    move_id INTEGER NOT NULL REFERENCES moves(_id) ON DELETE CASCADE,
+    PRIMARY KEY (opening, move_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS openings (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    color TEXT NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS moves_board_start ON moves (board_start, move);
+CREATE INDEX IF NOT EXISTS moves_board_end ON moves (board_end);
+CREATE INDEX IF NOT EXISTS moves_due ON moves (color, date_due);
+CREATE INDEX IF NOT EXISTS move_openings_move ON move_openings (move_id);
+CREATE INDEX IF NOT EXISTS openings_name ON openings (name, color);
+"""
+
+MOVE_COLUMNS = ("_id", "board_start", "board_end", "move", "san", "color") + REVIEW_FIELDS
+_SELECT_MOVES = ("SELECT " + ", ".join("m."+column for column in MOVE_COLUMNS) +
+                 ", (SELECT group_concat(opening) FROM move_openings WHERE move_id = m._id) FROM moves m")
+
+# Every move of the opening played from a position reachable from root with moves of the opening
+_VARIATION = """
+WITH RECURSIVE reachable(board_id) AS (
+    SELECT ?
+    UNION
+    SELECT m.board_end FROM reachable r
+    CROSS JOIN moves m ON m.board_start = r.board_id
+    WHERE EXISTS (SELECT 1 FROM move_openings WHERE opening = ? AND move_id = m._id)
+)
+""" + _SELECT_MOVES + """
+JOIN move_openings o ON o.move_id = m._id AND o.opening = ?
+WHERE m.board_start IN (SELECT board_id FROM reachable)
+ORDER BY m._id"""
+
+
+def _timestamp(date):
+    return None if date is None else date.timestamp()
+
+
+def _datetime(timestamp):
+    return None if timestamp is None else datetime.fromtimestamp(timestamp)
+
+
+class SQLiteStorage(Storage):
+    """Storage in an embedded sqlite database (write ahead log, one shared connection).
+    All statements are constant parametrized sql, which sqlite3 keeps prepared.
+    """
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or "sqlite:"+path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+
+    def ensure_indexes(self):
+        with self._lock:
+            self._connection.executescript(INDEXES)
+
+    def close(self):
+        self._connection.close()
+
+    def find_positions(self, board_ids=None):
+        if board_ids is None:
+            rows = self._query("SELECT BoardId, fen, hash FROM positions")
+        else:
+            rows = self._query_in("SELECT BoardId, fen, hash FROM positions WHERE BoardId IN ({0})",
+                                  list(board_ids))
+        return [{"BoardId": board_id, "fen": fen, "hash": key} for board_id, fen, key in rows]
+
+    def insert_positions(self, documents):
+        duplicates = []
+        with self._lock, self._transaction():
+            for document in documents:
+                try:
+                    self._connection.execute("INSERT INTO positions (BoardId, fen, hash) VALUES (?, ?, ?)",
+                                             (document["BoardId"], document["fen"], document.get("hash")))
+                except sqlite3.IntegrityError as err:
+                    if "positions.hash" not in str(err):
+                        raise
+                    duplicates.append(document.get("hash"))
+        if duplicates:
+            raise DuplicatePositionError(duplicates)
+
+    def delete_positions(self, board_ids):
+        self._write("DELETE FROM positions WHERE BoardId = ?", [(board_id,) for board_id in board_ids])
+
+    def find_moves(self, opening=None, board_start=None, board_end=None, fields=None):
+        conditions = []
+        parameters = []
+        if opening is not None:
+            conditions.append("m._id IN (SELECT move_id FROM move_openings WHERE opening = ?)")
+            parameters.append(opening)
+        for column, value in (("board_start", board_start), ("board_end", board_end)):
+            if value is not None:
+                conditions.append("m.{0} = ?".format(column))
+                parameters.append(value)
+        sql = _SELECT_MOVES
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        moves = [self._move(row) for row in self._query(sql + " ORDER BY m._id", parameters)]
+        if fields is not None:
+            moves = [dict((key, value) for key, value in move.items() if key in fields or key == "_id")
+                     for move in moves]
+        return moves
+
+    def variation(self, opening, root=0, fields=None):
+        moves = [self._move(row) for row in self._query(_VARIATION, (root, opening, opening))]
+        if fields is not None:
+            moves = [dict((key, value) for key, value in move.items() if key in fields or key == "_id")
+                     for move in moves]
+        return moves
+
+    def sample_moves(self, opening, color, size):
+        sql = (_SELECT_MOVES + " WHERE m.color = ? AND m._id IN "
+               "(SELECT move_id FROM move_openings WHERE opening = ?) ORDER BY random() LIMIT ?")
+        moves = [self._move(row) for row in self._query(sql, (int(color), opening, size))]
+        positions = dict((pos["BoardId"], pos)
+                         for pos in self.find_positions(set(move["board_start"] for move in moves)))
+        for move in moves:
+            move["position"] = [positions[move["board_start"]]] if move["board_start"] in positions else []
+        return moves
+
+    def due_moves(self, openings, color, now, after=None, limit=100):
+        openings = list(openings)
+        sql = (_SELECT_MOVES + " WHERE m.color = ? AND m._id IN "
+               "(SELECT move_id FROM move_openings WHERE opening IN ({0})) AND ".format(", ".join("?"*len(openings))))
+        parameters = [int(color)] + openings
+        if after is None:
+            sql += "(m.date_due IS NULL OR m.date_due < ?)"
+            parameters.append(now.timestamp())
+        elif after[0] is None:
+            sql += "((m.date_due IS NULL AND m._id > ?) OR m.date_due < ?)"
+            parameters += [after[1], now.timestamp()]
+        else:
+            sql += "m.date_due < ? AND (m.date_due > ? OR (m.date_due = ? AND m._id > ?))"
+            parameters += [now.timestamp(), _timestamp(after[0]), _timestamp(after[0]), after[1]]
+        sql += " ORDER BY m.date_due IS NOT NULL, m.date_due, m._id LIMIT ?"
+        return [self._move(row) for row in self._query(sql, parameters + [limit])]
+
+    def insert_moves(self, documents):
+        with self._lock, self._transaction():
+            for document in documents:
+                cursor = self._connection.execute(
+                    "INSERT INTO moves (board_start, board_end, move, san, color, difficulty, "
+                    "date_last_reviewed, days_between_reviews, date_due) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (document["board_start"], document["board_end"], document["move"], document.get("san"),
+                     int(document["color"]), document.get("difficulty"),
+                     _timestamp(document.get("date_last_reviewed")), document.get("days_between_reviews"),
+                     _timestamp(document.get("date_due"))))
+                document["_id"] = cursor.lastrowid
+                self._connection.executemany("INSERT OR IGNORE INTO move_openings (opening, move_id) VALUES (?, ?)",
+                                             [(opening, document["_id"]) for opening in document["opening"]])
+
+    def add_opening(self, moves, opening):
+        self._write("INSERT OR IGNORE INTO move_openings (opening, move_id) "
+                    "SELECT ?, _id FROM moves WHERE board_start = ? AND move = ?",
+                    [(opening, board_start, uci) for board_start, uci in moves])
+
+    def pull_opening(self, opening):
+        self._write("DELETE FROM move_openings WHERE opening = ?", [(opening,)])
+
+    def delete_moves(self, ids):
+        self._write("DELETE FROM moves WHERE _id = ?", [(move_id,) for move_id in ids])
+
+    def update_moves(self, updates):
+        with self._lock, self._transaction():
+            for find, fields in updates:
+                columns = [column for column in REVIEW_FIELDS if column in fields]
+                values = [_timestamp(fields[column]) if column.startswith("date") else fields[column]
+                          for column in columns]
+                sql = "UPDATE moves SET " + ", ".join(column+" = ?" for column in columns)
+                if "_id" in find:
+                    sql += " WHERE _id = ?"
+                    values.append(find["_id"])
+                else:
+                    sql += " WHERE board_start = ? AND board_end = ?"
+                    values += [find["board_start"], find["board_end"]]
+                self._connection.execute(sql, values)
+
+    def find_opening(self, name=None, color=None, id=None):
+        conditions = []
+        parameters = []
+        for column, value in (("name", name), ("color", color), ("id", id)):
+            if value is not None:
+                conditions.append(column+" = ?")
+                parameters.append(value)
+        sql = "SELECT id, name, color, revision FROM openings"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        rows = self._query(sql + " LIMIT 1", parameters)
+        return self._opening(rows[0]) if rows else None
+
+    def find_openings(self, color=None):
+        if color is None:
+            rows = self._query("SELECT id, name, color, revision FROM openings ORDER BY id")
+        else:
+            rows = self._query("SELECT id, name, color, revision FROM openings WHERE color = ? ORDER BY id",
+                               (color,))
+        return [self._opening(row) for row in rows]
+
+    def insert_opening(self, document):
+        self._write("INSERT INTO openings (id, name, color, revision) VALUES (?, ?, ?, ?)",
+                    [(document["id"], document["name"], document["color"], document.get("revision", 0))])
+
+    def delete_opening(self, name, color):
+        self._write("DELETE FROM openings WHERE name = ? AND color = ?", [(name, color)])
+
+    def touch_openings(self, ids=None):
+        if ids is None:
+            self._write("UPDATE openings SET revision = revision + 1", [()])
+        else:
+            self._write("UPDATE openings SET revision = revision + 1 WHERE id = ?", [(i,) for i in ids])
+
+    def repertoire_revision(self):
+        row = self._query("SELECT next FROM counters WHERE name = 'repertoire'")
+        return row[0][0] if row else 0
+
+    def touch_repertoire(self):
+        with self._lock, self._transaction():
+            self._connection.execute("INSERT INTO counters (name, next) VALUES ('repertoire', 1) "
+                                     "ON CONFLICT (name) DO UPDATE SET next = next + 1")
+            return self._connection.execute("SELECT next FROM counters WHERE name = 'repertoire'").fetchone()[0]
+
+    def moves_from(self, board_ids, openings=None):
+        moves = [self._move(row) for row in self._query_in(_SELECT_MOVES + " WHERE m.board_start IN ({0})",
+                                                           list(board_ids))]
+        if openings is not None:
+            openings = set(openings)
+            moves = [move for move in moves if openings.intersection(move["opening"])]
+        return moves
+
+    def _review_statistics(self, openings, now):
+        groups = self._query_in("SELECT o.opening, m.color, count(*), "
+                                "sum(m.date_due IS NULL OR m.date_due < ?), "
+                                "avg(coalesce(m.difficulty, 0.3)) "
+                                "FROM move_openings o JOIN moves m ON m._id = o.move_id "
+                                "WHERE o.opening IN ({0}) GROUP BY o.opening, m.color",
+                                list(openings), (now.timestamp(),))
+        return dict(((opening, bool(color)), (moves, due, difficulty))
+                    for opening, color, moves, due, difficulty in groups)
+
+    def reserve_ids(self, collection, field, count, first=0):
+        table, column = {"positions.BoardId": ("positions", "BoardId"),
+                         "opening.id": ("openings", "id")}[collection+"."+field]
+        with self._lock, self._transaction():
+            row = self._connection.execute("SELECT next FROM counters WHERE name = ?",
+                                           (collection+"."+field,)).fetchone()
+            if row is None:
+                used = self._connection.execute("SELECT max({0}) FROM {1}".format(column, table)).fetchone()[0]
+                start = first if used is None else max(first, used+1)
+            else:
+                start = row[0]
+            self._connection.execute("INSERT OR REPLACE INTO counters (name, next) VALUES (?, ?)",
+                                     (collection+"."+field, start+count))
+            return start+count
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _query_in(self, sql, values, parameters=(), batch_size=500):
+        """Run the query for batches of the values, sql contains {0} for the placeholders
+        of a batch, which follow the parameters."""
+        rows = []
+        for i in range(0, len(values), batch_size):
+            batch = values[i:i+batch_size]
+            rows += self._query(sql.format(", ".join("?"*len(batch))), list(parameters) + batch)
+        return rows
+
+    def _write(self, sql, parameters):
+        with self._lock, self._transaction():
+            self._connection.executemany(sql, parameters)
+
+    def _transaction(self):
+        return _Transaction(self._connection)
+
+    @staticmethod
+    def _move(row):
+        move = dict(zip(MOVE_COLUMNS, row[:-1]))
+        move["color"] = bool(move["color"])
+        move["opening"] = [int(opening) for opening in row[-1].split(",")] if row[-1] else []
+        for field in REVIEW_FIELDS:
+            if move[field] is None:
+                del move[field]
+        for field in ("date_last_reviewed", "date_due"):
+            if field in move:
+                move[field] = _datetime(move[field])
+        return move
+
+    @staticmethod
+    def _opening(row):
+        return dict(zip(("id", "name", "color", "revision"), row))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, nested use joins the outer transaction."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.outer = False
+
+    def __enter__(self):
+        self.outer = not self.connection.in_transaction
+        if self.outer:
+            self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.outer:
+            self.connection.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+class StorageClient:
+    """Returns the storage of a user with client[user]."""
+    def __init__(self):
+        self._storages = dict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, user):
+        with self._lock:
+            if user not in self._storages:
+                self._storages[user] = self._open(user)
+            return self._storages[user]
+
+    def drop_database(self, user):
+        with self._lock:
+            self._storages.pop(user, None)
+
+    def _open(self, user):
+        raise NotImplementedError
+
+
+_clients = itertools.count()
+
+
+class MemoryClient(StorageClient):
+    def __init__(self):
+        super().__init__()
+        self._prefix = "memory{0}".format(next(_clients))
+
+    def _open(self, user):
+        return MemoryStorage(self._prefix+"/"+user)
+
+
+class SQLiteClient(StorageClient):
+    """The sqlite database of a user is the file <directory>/<user>.sqlite3,
+    with directory ":memory:" every user gets an in memory database."""
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self._prefix = "sqlite{0}".format(next(_clients))
+
+    def _open(self, user):
+        if self.directory == ":memory:":
+            return SQLiteStorage(":memory:", self._prefix+"/"+user)
+        return SQLiteStorage(os.path.join(self.directory, user+".sqlite3"))
+
+    def drop_database(self, user):
+        with self._lock:
+            storage = self._storages.pop(user, None)
+        if storage is not None:
+            storage.close()
+            if storage.path != ":memory:":
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(storage.path+suffix):
+                        os.remove(storage.path+suffix)
+
+
+def offload(executor, function, *args, **kwargs):
+    """Run the blocking function in the executor, returns an awaitable of its result.
+    The context (e.g. the metrics of the request) is passed to the thread.
+    """
+    call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+class AsyncStorage:
+    """Awaitable view of a Storage for an event loop.
+    Every call runs in the executor (None for the default one),
+    cursors are read completely before they are returned.
+    """
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+        self.name = storage.name
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        if not callable(method):
+            return method
+
+        def read(*args, **kwargs):
+            result = method(*args, **kwargs)
+            if hasattr(result, "__next__"):
+                result = list(result)
+            return result
+
+        async def call(*args, **kwargs):
+            return await offload(self.executor, read, *args, **kwargs)
+        return call
+
+
+def open_storage(client, user):
+    """The storage of the user, client is a StorageClient, a MongoClient or None for a local mongod."""
+    if client is None:
+        client = MongoClient()
+    if isinstance(client, StorageClient):
+        return client[user]
+    return MongoStorage(client[user])
+
+
+def create_client(uri, **options):
+    """Client for the uri: "memory", "sqlite:<directory>" or a mongodb uri,
+    options are passed to the MongoClient."""
+    if uri == "memory":
+        return MemoryClient()
+    if uri.startswith("sqlite:"):
+        return SQLiteClient(uri[len("sqlite:"):])
+    return MongoClient(uri, **options)
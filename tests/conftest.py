@@ -0,0 +1,47 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import explorer as explorer_module  # noqa: E402
+from explorer import Explorer  # noqa: E402
+from storage import MemoryClient  # noqa: E402
+
+ITALIAN = "1. e4 e5 2. Nf3 Nc6 3. Bc4 (3. Bb5 a6 4. Ba4) 3... Bc5 4. c3 *"
+CARO_KANN = "1. e4 c6 2. d4 d5 3. Nc3 (3. e5 Bf5) 3... dxe4 *"
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    """The module level caches are keyed by the db name, which is "test" in every test."""
+    yield
+    explorer_module.Repertoire._loaded.clear()
+    explorer_module.variation_trees._trees.clear()
+    explorer_module.opening_statistics._statistics.clear()
+
+
+@pytest.fixture
+def client():
+    return MemoryClient()
+
+
+@pytest.fixture
+def app():
+    """Flask app with a memory storage, tests of the app use its storage as client."""
+    from app import create_app
+    return create_app({"STORAGE": "memory", "USER": "test", "SECRET_KEY": "test"})
+
+
+@pytest.fixture
+def explorer(client):
+    """Explorer of the user "test" with the White opening "Italian" (id 0)
+    and the Black opening "Caro-Kann" (id 1)."""
+    explorer = Explorer("test", client=client)
+    for name, color, pgn in (("Italian", "White", ITALIAN), ("Caro-Kann", "Black", CARO_KANN)):
+        explorer.add_opening(name, color)
+        explorer.opening = {"name": name, "color": color}
+        explorer.import_pgn(io.StringIO(pgn))
+    return explorer
@@ -0,0 +1,75 @@
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def client(app):
+    return app.extensions["storage"]
+
+
+@pytest.fixture
+def http(app, explorer):
+    return app.test_client()
+
+
+def test_opening_tree(http):
+    response = http.get("/openings/0/tree?root=4&depth=2")
+    tree = response.get_json()
+    assert (tree["opening"], tree["root"]) == (0, 4)
+    assert sorted(tree["positions"]) == ["4", "5", "6", "7", "9"]
+    assert [4, 6, "f1c4", "Bc4", 1] in tree["edges"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_opening_tree_is_revalidated_with_the_revision(http):
+    etag = http.get("/openings/0/tree").headers["ETag"]
+    assert http.get("/openings/0/tree", headers={"If-None-Match": etag}).status_code == 304
+    http.post("/opening", data={"opening": "Italian", "color": "White"})
+    http.post("/opening", data={"remove": "Caro-Kann", "color": "Black"})
+    response = http.get("/openings/0/tree", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+def test_opening_listing(http):
+    openings = json.loads(http.post("/opening", data={}).get_data(as_text=True))
+    assert (openings["white"], openings["black"]) == (["Italian"], ["Caro-Kann"])
+    assert openings["statistics"]["White"]["Italian"]["moves"] == 10
+
+
+def test_app_factory_does_not_connect():
+    from pymongo import MongoClient
+
+    from app import create_app
+    app = create_app({"MONGO_URI": "mongodb://localhost:1", "MONGO_SERVER_SELECTION_TIMEOUT_MS": 1})
+    client = app.extensions["storage"]
+    assert isinstance(client, MongoClient)
+    assert app.extensions["sessions"].client is client
+    assert app.extensions["sessions"].store is not None
+
+
+def test_indexes_are_created_once(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr("storage.MemoryStorage.ensure_indexes", lambda self: calls.append(self.name))
+    http = app.test_client()
+    http.get("/repertoire")
+    http.get("/repertoire")
+    assert len(calls) == 1
+
+
+def test_sessions_share_the_client(http, app):
+    other = app.test_client()
+    http.post("/opening", data={"opening": "Italian", "color": "White"})
+    other.post("/opening", data={"opening": "Caro-Kann", "color": "Black"})
+    pool = app.extensions["sessions"]
+    sessions = list(pool._sessions.values())
+    assert len(sessions) == 2
+    assert sessions[0].explorer.db is sessions[1].trainer.db
+
+
+@pytest.mark.parametrize("batch_size", ["0", "-5", "many"])
+def test_import_rejects_invalid_batch_sizes(http, batch_size):
+    response = http.post("/import", data={"opening": "Italian", "color": "White", "batch_size": batch_size,
+                                          "pgn": (io.BytesIO(b"1. e4 e5 2. Nf3 *"), "games.pgn")})
+    assert response.status_code == 400
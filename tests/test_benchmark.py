@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+import benchmark
+from storage import MemoryStorage
+
+
+def test_generated_repertoire_is_reproducible():
+    first, second = MemoryStorage(), MemoryStorage()
+    stats = benchmark.generate_repertoire(first, positions=200, seed=3, batch_size=50)
+    assert benchmark.generate_repertoire(second, positions=200, seed=3, batch_size=50) == stats
+    assert stats["positions"] >= 200 and stats["transpositions"] > 0
+    assert len(first.find_positions()) == stats["positions"]
+    assert ([(move["board_start"], move["move"]) for move in first.find_moves()] ==
+            [(move["board_start"], move["move"]) for move in second.find_moves()])
+
+
+def test_run_on_memory_storage(capsys):
+    benchmark.main(["--storage", "memory", "--positions", "150", "--repeat", "2"])
+    results = json.loads(capsys.readouterr().out)
+    assert results["backend"] == "memory"
+    assert results["timings"]["Trainer.next"]["runs"] == 2
+    assert results["generated"]["positions"] >= 150
+
+
+def test_unreachable_number_of_positions():
+    with pytest.raises(ValueError):
+        benchmark.generate_repertoire(MemoryStorage(), positions=100, depth=2, branching=2)
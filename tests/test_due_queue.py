@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from explorer import DueQueue, Trainer
+
+
+@pytest.fixture
+def trainer(explorer, client):
+    trainer = Trainer("test", "session", client=client)
+    yield trainer
+    trainer.close()
+
+
+def test_due_moves_of_both_colors_are_interleaved(explorer):
+    queue = DueQueue(explorer.db, {False: [0], True: [1]}, page_size=2, lookahead=1)
+    moves = []
+    while True:
+        board, move = queue.pop()
+        if move is None:
+            break
+        moves.append(move)
+        assert board.board_id == move.from_id
+    # The White moves of the Italian and the Black moves of the Caro-Kann
+    assert len(moves) == 6 + 4
+    assert set(move.opening[0] for move in moves) == {0, 1}
+    assert len(set((move.from_id, move.to_id) for move in moves)) == 10
+
+
+def test_higher_priority_first(explorer):
+    now = datetime.now()
+    db = explorer.db
+    overdue, recent = db.find_moves(board_start=4)
+    db.update_moves([({"_id": overdue["_id"]}, {"date_last_reviewed": now - timedelta(days=30),
+                                                "days_between_reviews": 3, "date_due": now - timedelta(days=27)}),
+                     ({"_id": recent["_id"]}, {"date_last_reviewed": now - timedelta(days=4),
+                                               "days_between_reviews": 3, "date_due": now - timedelta(days=1)})])
+    queue = DueQueue(db, {False: [0], True: []}, now)
+    moves = [queue.pop()[1] for _ in range(6)]
+    assert moves[0].to_id == overdue["board_end"]
+    assert moves[-1].to_id == recent["board_end"]
+    assert queue.pop() == (None, None)
+
+
+def test_review_due_of_selected_openings(trainer):
+    trainer.review_due([1])
+    assert trainer.openings == [1]
+    colors = set()
+    while True:
+        board, move = trainer.next()
+        if move is None:
+            break
+        colors.add(board.color)
+        trainer.update_move_performance(True)
+    assert colors == {"b"}
+    # The end of the review writes the buffered answers
+    assert len(trainer.performance) == 0
+    assert len([move for move in trainer.db.find_moves(opening=1) if "date_due" in move]) == 4
+
+
+def test_interleaved_review_is_restored(trainer, explorer, client):
+    trainer.review_due()
+    popped = [trainer.next()[1] for _ in range(3)]
+    state = trainer.state()
+    other = Trainer("test", client=client)
+    other.restore(state)
+    assert other.openings == trainer.openings
+    assert (other.last_move.from_id, other.last_move.to_id) == (popped[-1].from_id, popped[-1].to_id)
+    rest = []
+    while True:
+        move = other.next()[1]
+        if move is None:
+            break
+        rest.append((move.from_id, move.to_id))
+    assert len(rest) == 10 - 3
+    assert not set(rest) & set((move.from_id, move.to_id) for move in popped)
+    other.close()
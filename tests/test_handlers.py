@@ -0,0 +1,171 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import handlers
+from asgi import MAX_FORM_SIZE, AsgiApp
+from explorer import ReviewQueue, Trainer, VariationTree
+
+
+@pytest.fixture
+def client(app):
+    return app.extensions["storage"]
+
+
+@pytest.fixture
+def http(app, explorer):
+    http = app.test_client()
+    http.post("/opening", data={"opening": "Italian", "color": "White"})
+    return http
+
+
+def test_parse_openings():
+    assert handlers.parse_openings("") is None
+    assert handlers.parse_openings("0,3") == [0, 3]
+
+
+def test_full_training_of_an_opening(http):
+    fen, uci, prompt = json.loads(http.post("/positions", data={"load": "full"}).get_data(as_text=True))
+    assert (fen.split()[1], uci) == ("w", "e2e4")
+    assert prompt["san"] == "e4" and prompt["legal"][uci] == "e4"
+    assert prompt["answers"] == []
+    answered = 1
+    while True:
+        assert http.post("/positions", data={"performance": "correct"}).get_data(as_text=True) == ""
+        result = json.loads(http.post("/positions", data={"load": "next"}).get_data(as_text=True))
+        if result == "finished":
+            break
+        answered += 1
+    assert answered == 6
+
+
+def test_prompt_accepts_the_alternatives_of_the_opening(http):
+    answers = dict()
+    result = json.loads(http.post("/positions", data={"load": "full"}).get_data(as_text=True))
+    while result != "finished":
+        _, uci, prompt = result
+        answers[uci] = prompt["answers"]
+        result = json.loads(http.post("/positions", data={"load": "next"}).get_data(as_text=True))
+    assert answers["f1c4"] == ["f1b5"] and answers["f1b5"] == ["f1c4"]
+    assert answers["g1f3"] == []
+
+
+def test_forecast(http):
+    forecast = json.loads(http.post("/forecast", data={"days": 7}).get_data(as_text=True))
+    assert forecast["due"] == 6 and len(forecast["forecast"]) == 7
+
+
+def test_asgi_handlers_answer_like_the_flask_routes(app, explorer):
+    asgi = AsgiApp(app, workers=2)
+    pool = app.extensions["sessions"]
+    session = pool.acquire("a")
+    try:
+        session.trainer.change_opening(0)
+        fen, uci, prompt = json.loads(asyncio.run(asgi.positions(session, {"load": "full"})))
+        assert uci == "e2e4" and prompt["san"] == "e4"
+        assert asyncio.run(asgi.positions(session, {"performance": "correct"})) == ""
+        assert json.loads(asyncio.run(asgi.forecast(session, {"days": "3"})))["due"] == 5
+    finally:
+        pool.release(session)
+        asgi.executor.shutdown()
+
+
+def call(asgi, method, path, body=b"", headers=()):
+    """Run one http request through the asgi app, returns (status, headers, body)."""
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+             "headers": [(b"content-type", b"application/x-www-form-urlencoded")] + list(headers)}
+    asyncio.run(asgi(scope, receive, send))
+    return (sent[0]["status"], dict(sent[0]["headers"]),
+            b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+def test_asgi_app_serves_flask_and_training_routes(app, explorer):
+    asgi = AsgiApp(app, workers=2)
+    status, headers, body = call(asgi, "POST", "/opening", b"opening=Italian&color=White")
+    assert status == 200 and json.loads(body)["major"] == ["e4"]
+    cookie = headers[b"set-cookie"].split(b";")[0]
+    status, _, body = call(asgi, "POST", "/positions", b"load=full", [(b"cookie", cookie)])
+    assert status == 200 and json.loads(body)[1] == "e2e4"
+    assert len(app.extensions["sessions"]) == 1
+    asgi.executor.shutdown()
+
+
+def test_complete_opening_async(explorer, client):
+    trainer = Trainer("test", client=client)
+    trainer.change_opening(0)
+    asyncio.run(trainer.complete_opening_async())
+    assert trainer.next()[1].uci == "e2e4"
+    trainer.close()
+
+
+def test_complete_opening_async_builds_in_the_executor(explorer, client, monkeypatch):
+    threads = []
+    for cls, name in ((VariationTree, "_build_graph"), (ReviewQueue, "fill")):
+        method = getattr(cls, name)
+
+        def record(self, *args, method=method):
+            threads.append(threading.current_thread())
+            return method(self, *args)
+        monkeypatch.setattr(cls, name, record)
+    trainer = Trainer("test", client=client)
+    trainer.change_opening(0)
+    with ThreadPoolExecutor(1) as executor:
+        asyncio.run(trainer.complete_opening_async(executor))
+    assert len(threads) == 2 and threading.main_thread() not in threads
+    assert trainer.next()[1].uci == "e2e4"
+    trainer.close()
+
+
+def test_asgi_upload_is_streamed_to_flask(app, explorer):
+    asgi = AsgiApp(app, workers=2)
+    parts = [b"--b\r\nContent-Disposition: form-data; name=\"opening\"\r\n\r\nItalian\r\n",
+             b"--b\r\nContent-Disposition: form-data; name=\"color\"\r\n\r\nWhite\r\n",
+             b"--b\r\nContent-Disposition: form-data; name=\"pgn\"; filename=\"a.pgn\"\r\n\r\n",
+             b"1. e4 e5 2. d4 exd4 *\r\n", b"--b--\r\n"]
+    messages = [{"type": "http.request", "body": part, "more_body": True} for part in parts]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(messages[0])
+        return messages.pop(0)
+
+    wsgi_app = app.wsgi_app
+    started = []
+
+    def record(environ, start_response):
+        started.append(len(received))
+        return wsgi_app(environ, start_response)
+    app.wsgi_app = record
+
+    async def send(message):
+        sent.append(message)
+    scope = {"type": "http", "method": "POST", "path": "/import", "query_string": b"",
+             "headers": [(b"content-type", b"multipart/form-data; boundary=b")]}
+    asyncio.run(asgi(scope, receive, send))
+    assert sent[0]["status"] == 200
+    assert json.loads(b"".join(message.get("body", b"") for message in sent[1:]))["moves"] == 2
+    # flask was called before any part of the body was received
+    assert started == [0] and messages == []
+    asgi.executor.shutdown()
+
+
+def test_asgi_training_requests_have_a_size_limit(app, explorer):
+    asgi = AsgiApp(app, workers=2)
+    _, headers, _ = call(asgi, "POST", "/opening", b"opening=Italian&color=White")
+    cookie = headers[b"set-cookie"].split(b";")[0]
+    status, _, _ = call(asgi, "POST", "/positions", b"load=next&x=" + b"0"*MAX_FORM_SIZE, [(b"cookie", cookie)])
+    assert status == 413
+    asgi.executor.shutdown()
@@ -0,0 +1,70 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+    lines = histogram.render().split("\n")
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/a"} 3' in lines
+
+
+def test_counter_render():
+    counter = metrics.Counter("test_total", "Test.", ("result",))
+    counter.inc("hit")
+    counter.inc("hit", amount=2)
+    assert 'test_total{result="hit"} 3' in counter.render().split("\n")
+
+
+def test_timed_records_spans_of_the_request():
+    @metrics.timed("test.function")
+    def function():
+        return 1
+
+    @metrics.timed("test.generator")
+    def generator():
+        yield 1
+        yield 2
+
+    stats = metrics.start_request()
+    assert function() == 1
+    assert list(generator()) == [1, 2]
+    assert stats.spans["test.function"][0] == 1
+    assert stats.spans["test.generator"][0] == 1
+    metrics.end_request("/test", "GET", 200, slow_request=None)
+    assert 'function_duration_seconds_count{function="test.function"}' in metrics.render()
+
+
+def test_commands_are_added_to_the_request():
+    timer = metrics.CommandTimer()
+    stats = metrics.start_request()
+    timer.started(SimpleNamespace(command={"find": "moves"}, command_name="find", request_id=1))
+    timer.succeeded(SimpleNamespace(command_name="find", request_id=1, duration_micros=1500))
+    assert stats.command_count == 1
+    assert stats.command_duration == pytest.approx(0.0015)
+    assert stats.breakdown() == "find moves: 1x 1.5ms"
+    metrics.end_request("/test", "GET", 200, slow_request=None)
+
+
+def test_slow_requests_are_logged(caplog):
+    metrics.start_request()
+    with caplog.at_level(logging.WARNING, logger="metrics"):
+        metrics.end_request("/slow", "POST", 200, slow_request=0.)
+    assert "Slow request POST /slow" in caplog.text
+
+
+def test_metrics_endpoint(app):
+    http = app.test_client()
+    http.get("/repertoire")
+    response = http.get("/metrics")
+    assert response.content_type == metrics.CONTENT_TYPE
+    assert 'http_requests_total{route="/repertoire",method="GET",status="200"}' in response.get_data(as_text=True)
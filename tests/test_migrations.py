@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+
+import migrations
+from storage import MongoStorage
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().test
+
+
+def test_backfill_date_due(db):
+    reviewed = datetime(2024, 3, 1, 12)
+    db.moves.insert_many([
+        {"_id": 1, "board_start": 0, "board_end": 1, "opening": [0], "color": False,
+         "date_last_reviewed": reviewed, "days_between_reviews": 4},
+        {"_id": 2, "board_start": 1, "board_end": 2, "opening": [0], "color": False,
+         "date_last_reviewed": int(reviewed.timestamp())},
+        {"_id": 3, "board_start": 2, "board_end": 3, "opening": [0], "color": False},
+        {"_id": 4, "board_start": 3, "board_end": 4, "opening": [0], "color": False,
+         "date_last_reviewed": reviewed, "days_between_reviews": 1, "date_due": reviewed}])
+    assert migrations.backfill_date_due(db, batch_size=1) == 2
+    due = dict((move["_id"], move.get("date_due")) for move in db.moves.find())
+    assert due == {1: reviewed + timedelta(days=4), 2: reviewed + timedelta(days=3), 3: None, 4: reviewed}
+    assert migrations.backfill_date_due(db) == 0
+
+
+def test_backfilled_moves_are_not_served_as_never_reviewed(db):
+    now = datetime(2024, 3, 10)
+    db.moves.insert_many([
+        {"_id": 1, "board_start": 0, "board_end": 1, "opening": [0], "color": False,
+         "date_last_reviewed": now - timedelta(days=1), "days_between_reviews": 5},
+        {"_id": 2, "board_start": 1, "board_end": 2, "opening": [0], "color": False,
+         "date_last_reviewed": now - timedelta(days=6), "days_between_reviews": 2}])
+    migrations.backfill_date_due(db)
+    assert [move["_id"] for move in MongoStorage(db).due_moves([0], False, now)] == [2]
+
+
+
+def test_backfill_san(db):
+    db.positions.insert_one({"BoardId": 0, "fen": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"})
+    db.moves.insert_one({"_id": 1, "board_start": 0, "board_end": 1, "move": "g1f3", "opening": [0]})
+    assert migrations.backfill_san(db) == 1
+    assert db.moves.find_one({"_id": 1})["san"] == "Nf3"
+
+
+def test_merged_positions_change_the_repertoire_revision(db):
+    fen = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+    db.positions.insert_many([{"BoardId": 0, "fen": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"},
+                              {"BoardId": 1, "fen": fen}, {"BoardId": 2, "fen": fen.replace("0 1", "4 3")}])
+    db.moves.insert_many([{"board_start": 0, "board_end": 1, "move": "e2e4", "opening": [0]},
+                          {"board_start": 0, "board_end": 2, "move": "e2e4", "opening": [1]}])
+    assert migrations.merge_duplicate_positions(db) == (1, 1)
+    assert MongoStorage(db).repertoire_revision() == 1
+    assert migrations.merge_duplicate_positions(db) == (0, 0)
+    assert MongoStorage(db).repertoire_revision() == 1
@@ -0,0 +1,56 @@
+import chess
+
+from explorer import OpeningStatisticsCache, Trainer
+
+
+def count_queries(db, monkeypatch):
+    queries = []
+    statistics = db.opening_statistics
+
+    def counted(openings, now):
+        queries.append(sorted(openings))
+        return statistics(openings, now)
+    monkeypatch.setattr(db, "opening_statistics", counted)
+    return queries
+
+
+def test_statistics_are_cached_until_the_revision_changes(explorer, monkeypatch):
+    cache = OpeningStatisticsCache()
+    queries = count_queries(explorer.db, monkeypatch)
+    openings = list(explorer.db.find_openings())
+    first = cache.get(explorer.db, openings)
+    assert cache.get(explorer.db, openings) == first
+    assert queries == [[0, 1]]
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(8)
+    explorer.push(chess.Move.from_uci("g8f6"))
+    statistics = cache.get(explorer.db, list(explorer.db.find_openings()))
+    assert queries == [[0, 1], [0]]
+    assert statistics[0]["moves"] == 11 and statistics[1] == first[1]
+
+
+def test_old_statistics_are_recomputed(explorer, monkeypatch):
+    cache = OpeningStatisticsCache(max_age=0)
+    queries = count_queries(explorer.db, monkeypatch)
+    openings = list(explorer.db.find_openings())
+    cache.get(explorer.db, openings)
+    cache.get(explorer.db, openings)
+    assert len(queries) == 2
+
+
+def test_empty_opening(explorer):
+    explorer.add_opening("Empty", "White")
+    statistics = OpeningStatisticsCache().get(explorer.db, [explorer.db.find_opening("Empty", "White")])
+    assert list(statistics.values()) == [OpeningStatisticsCache.EMPTY]
+
+
+def test_reviews_invalidate_the_statistics(explorer, client):
+    trainer = Trainer("test", "session", client=client)
+    trainer.change_opening(0)
+    assert explorer.openings()["statistics"]["White"]["Italian"]["due"] == 6
+    trainer.complete_opening()
+    trainer.next()
+    trainer.update_move_performance(True)
+    trainer.end_session()
+    assert explorer.openings()["statistics"]["White"]["Italian"]["due"] == 5
+    trainer.close()
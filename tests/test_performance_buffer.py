@@ -0,0 +1,102 @@
+import gc
+import time
+import weakref
+from datetime import datetime, timedelta
+
+import pytest
+
+import explorer
+from explorer import Move, PerformanceBuffer, Trainer
+from storage import MemoryStorage
+
+
+def reviewed_move(db, from_id, to_id):
+    db.insert_moves([{"_id": from_id, "move": "e2e4", "board_start": from_id, "board_end": to_id,
+                      "opening": [1], "color": False}])
+    move = Move("e2e4", from_id, to_id, [1], doc_id=from_id)
+    move.update_performance(0.2, datetime.now(), timedelta(days=4))
+    return move
+
+
+def test_flush_when_full():
+    db = MemoryStorage()
+    buffer = PerformanceBuffer(db, max_pending=2, max_delay=None)
+    buffer.add(reviewed_move(db, 1, 2))
+    assert len(buffer) == 1
+    assert "date_due" not in db.find_moves(board_start=1)[0]
+    buffer.add(reviewed_move(db, 2, 3))
+    assert len(buffer) == 0
+    assert db.find_moves(board_start=1)[0]["days_between_reviews"] == 4
+    buffer.close()
+
+
+def test_updates_of_the_same_move_are_merged():
+    db = MemoryStorage()
+    buffer = PerformanceBuffer(db, max_pending=None, max_delay=None)
+    move = reviewed_move(db, 1, 2)
+    buffer.add(move)
+    buffer.add(move)
+    assert len(buffer) == 1
+    assert buffer.close() == 1
+
+
+def test_exit_hook_flushes_open_buffers():
+    db = MemoryStorage()
+    buffer = PerformanceBuffer(db, max_pending=None, max_delay=None)
+    buffer.add(reviewed_move(db, 1, 2))
+    explorer._flush_buffers()
+    assert len(buffer) == 0
+    assert db.find_moves(board_start=1)[0]["difficulty"] == 0.2
+
+
+def test_closed_and_dropped_buffers_are_not_kept_alive():
+    closed = PerformanceBuffer(MemoryStorage(), max_delay=None)
+    closed.close()
+    assert closed not in PerformanceBuffer.open_buffers
+    dropped = PerformanceBuffer(MemoryStorage(), max_delay=None)
+    assert dropped in PerformanceBuffer.open_buffers
+    dropped = weakref.ref(dropped)
+    gc.collect()
+    assert dropped() is None
+
+
+def test_flush_after_max_delay():
+    db = MemoryStorage()
+    buffer = PerformanceBuffer(db, max_pending=None, max_delay=0.01)
+    buffer.add(reviewed_move(db, 1, 2))
+    deadline = time.time() + 5
+    while len(buffer) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(buffer) == 0
+    assert db.find_moves(board_start=1)[0]["difficulty"] == 0.2
+    buffer.close()
+
+
+def test_failed_flush_keeps_the_updates():
+    db = MemoryStorage()
+    buffer = PerformanceBuffer(db, max_pending=None, max_delay=None)
+    buffer.add(reviewed_move(db, 1, 2))
+    update_moves = db.update_moves
+
+    def fail(updates):
+        raise IOError("db unavailable")
+    db.update_moves = fail
+    with pytest.raises(IOError):
+        buffer.flush()
+    assert len(buffer) == 1
+    db.update_moves = update_moves
+    assert buffer.close() == 1
+
+
+@pytest.mark.parametrize("policy, pending", [("immediate", 0), ("batched", 1), ("session", 1)])
+def test_flush_policies_of_the_trainer(explorer, client, policy, pending):
+    trainer = Trainer("test", policy, client=client)
+    trainer.change_opening(0)
+    trainer.complete_opening()
+    trainer.next()
+    trainer.update_move_performance(False)
+    assert len(trainer.performance) == pending
+    trainer.end_session()
+    assert len(trainer.performance) == 0
+    assert len([move for move in trainer.db.find_moves() if "date_due" in move]) == 1
+    trainer.close()
@@ -0,0 +1,60 @@
+import io
+
+import chess.pgn
+import pytest
+
+from explorer import PgnExporter, VariationTree
+
+
+@pytest.fixture
+def italian(explorer):
+    return explorer.db.find_opening("Italian", "White")
+
+
+def test_export_contains_every_move(explorer, italian):
+    text = "".join(PgnExporter(explorer.db, italian).chunks())
+    game = chess.pgn.read_game(io.StringIO(text))
+    assert game.headers["Event"] == "Italian"
+    moves = set()
+    stack = [game]
+    while stack:
+        node = stack.pop()
+        for variation in node.variations:
+            moves.add((node.board().fen(), variation.move.uci()))
+            stack.append(variation)
+    assert len(moves) == 10
+    assert "1. e4 {difficulty 0.30, never reviewed}" in text
+
+
+def test_exported_opening_can_be_imported_again(explorer, italian):
+    text = "".join(PgnExporter(explorer.db, italian).chunks())
+    explorer.add_opening("Copy", "White")
+    explorer.opening = {"name": "Copy", "color": "White"}
+    stats = explorer.import_pgn(io.StringIO(text))
+    assert (stats["moves"], stats["positions"]) == (0, 0)
+    copy = VariationTree.from_db(explorer.db, explorer.opening)
+    assert set(copy.moves) == set(VariationTree.from_db(explorer.db, 0).moves)
+
+
+def test_lines_and_chunks(explorer, italian):
+    exporter = PgnExporter(explorer.db, italian, line_length=40)
+    lines = list(exporter.lines())
+    assert max(len(line) for line in lines) <= 40
+    assert len(lines) > len(list(PgnExporter(explorer.db, italian).lines()))
+    chunks = list(exporter.chunks(chunk_size=50))
+    assert len(chunks) > 1 and "".join(chunks) == "".join(line + "\n" for line in lines)
+
+
+def test_export_route(app):
+    from explorer import Explorer
+    explorer = Explorer("test", client=app.extensions["storage"])
+    explorer.add_opening("Italian", "White")
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.import_pgn(io.StringIO("1. e4 e5 2. Nf3 *"))
+    http = app.test_client()
+    response = http.get("/openings/0/pgn")
+    assert response.mimetype == "application/x-chess-pgn"
+    assert response.headers["Content-Disposition"] == 'attachment; filename="Italian.pgn"'
+    assert response.is_streamed
+    assert "1. e4" in response.get_data(as_text=True)
+    assert http.get("/openings/7/pgn").status_code == 404
@@ -0,0 +1,42 @@
+import io
+
+import pytest
+
+from conftest import ITALIAN
+from explorer import IdAllocator, PgnImporter, VariationTree
+
+GAMES = ITALIAN + "\n\n1. e4 e5 2. Nf3 Nc6 3. d4 exd4 *\n\n1. d4 d5 *\n"
+
+
+def test_import_of_several_games(explorer):
+    explorer.add_opening("Mixed", "White")
+    explorer.opening = {"name": "Mixed", "color": "White"}
+    stats = explorer.import_pgn(io.StringIO(GAMES))
+    assert (stats["games"], stats["moves"], stats["positions"]) == (3, 4, 4)
+    tree = VariationTree.from_db(explorer.db, explorer.opening)
+    assert len(list(tree.traverse())) == 10 + 2 + 2
+    # The moves of the Italian were joined to the opening instead of inserted again
+    assert len(explorer.db.find_moves()) == 17 + 4
+
+
+def test_small_batches(explorer):
+    importer = PgnImporter(explorer.repertoire, 2, batch_size=3)
+    writes = []
+    insert_moves = explorer.db.insert_moves
+    explorer.db.insert_moves = lambda documents: writes.append(len(documents)) or insert_moves(documents)
+    stats = importer.read(io.StringIO("1. d4 d5 2. c4 e6 3. Nc3 Nf6 *"))
+    assert stats["moves"] == 6 and len(writes) > 1
+    assert len(explorer.db.find_moves(opening=2)) == 6
+
+
+def test_import_is_idempotent(explorer):
+    stats = explorer.import_pgn(io.StringIO(ITALIAN), opening=0)
+    assert (stats["moves"], stats["positions"]) == (0, 0)
+    assert len(explorer.db.find_moves(opening=0)) == 10
+
+
+def test_id_blocks_must_not_be_empty(explorer):
+    with pytest.raises(ValueError):
+        IdAllocator(explorer.db, "positions", "BoardId", block_size=0)
+    with pytest.raises(ValueError):
+        PgnImporter(explorer.repertoire, 0, batch_size=0)
@@ -0,0 +1,109 @@
+import threading
+
+import chess
+
+import metrics
+from explorer import WARM_POSITIONS, BoardNode, Explorer, PositionCache, Trainer
+
+
+def board(explorer, board_id):
+    return explorer.repertoire.position(board_id)
+
+
+def test_entry_of_a_position(explorer):
+    cache = PositionCache()
+    entry = cache.get(explorer.db, board(explorer, 4))
+    assert entry["legal"]["f1c4"] == "Bc4"
+    assert len(entry["legal"]) == chess.Board(board(explorer, 4).fen).legal_moves.count()
+    assert entry["answers"] == {"f1b5": [0], "f1c4": [0]}
+    assert cache.get(explorer.db, board(explorer, 4)) is entry
+    assert cache.stats() == {"size": 1, "maxsize": 4096, "hits": 1, "misses": 1}
+
+
+def test_least_recently_used_entries_are_dropped(explorer):
+    cache = PositionCache(maxsize=2)
+    for board_id in (0, 1, 0, 2):
+        cache.get(explorer.db, board(explorer, board_id))
+    assert cache.cached(explorer.db, 0) is not None
+    assert cache.cached(explorer.db, 1) is None
+
+
+def test_warmed_entry_of_an_invalidated_position_is_dropped(explorer, monkeypatch):
+    cache = PositionCache()
+    computing = threading.Event()
+    release = threading.Event()
+    compute = PositionCache._compute
+
+    def slow_compute(db, position):
+        computing.set()
+        release.wait(5)
+        return compute(db, position)
+    monkeypatch.setattr(PositionCache, "_compute", staticmethod(slow_compute))
+    cache.warm(explorer.db, [board(explorer, 4)])
+    assert computing.wait(5)
+    cache.invalidate(explorer.db, 4)
+    release.set()
+    cache._executor.shutdown(wait=True)
+    assert cache.cached(explorer.db, 4) is None
+
+
+def test_warmed_entries_are_stored(explorer):
+    cache = PositionCache()
+    cache.warm(explorer.db, [board(explorer, 0), board(explorer, 1)])
+    cache._executor.shutdown(wait=True)
+    assert cache.cached(explorer.db, 1)["answers"] == {"e7e5": [0], "c7c6": [1]}
+
+
+def test_explorer_changes_reach_the_trainer(explorer, client):
+    trainer = Trainer("test", client=client, position_cache=explorer.position_cache)
+    position = board(explorer, 4)
+    assert set(trainer.position_cache.get(trainer.db, position)["answers"]) == {"f1b5", "f1c4"}
+    explorer.goto(4)
+    explorer.push(chess.Move.from_uci("d2d3"))
+    assert set(trainer.position_cache.get(trainer.db, position)["answers"]) == {"f1b5", "f1c4", "d2d3"}
+    trainer.close()
+
+
+def test_caches_of_different_apps_are_independent(explorer, client):
+    other = Explorer("test", client=client)
+    assert other.position_cache is not explorer.position_cache
+
+
+def test_notation_without_cached_entry(explorer):
+    explorer.goto(0)
+    assert explorer.position_cache.cached(explorer.db, 0) is None
+    assert explorer.push(chess.Move.from_uci("d2d4")) == "d4"
+    assert explorer.position_cache.cached(explorer.db, 0) is None
+
+
+def test_board_color():
+    assert BoardNode(chess.Board().fen(), 0).color == "w"
+
+
+def test_next_warms_the_upcoming_positions(explorer, client):
+    trainer = Trainer("test", client=client)
+    trainer.change_opening(0)
+    trainer.complete_opening()
+    board, move = trainer.next()
+    trainer.position_cache._executor.shutdown(wait=True)
+    upcoming = [upcoming_board.board_id for upcoming_board, _ in trainer.queue.peek("w", WARM_POSITIONS)]
+    assert upcoming
+    assert all(trainer.position_cache.cached(trainer.db, board_id) is not None for board_id in upcoming)
+    trainer.close()
+
+
+def test_lookups_are_counted(explorer):
+    cache = PositionCache()
+    before = metrics.POSITION_CACHE._series.get(("hit",), 0)
+    cache.get(explorer.db, board(explorer, 0))
+    cache.get(explorer.db, board(explorer, 0))
+    assert metrics.POSITION_CACHE._series[("hit",)] == before + 1
+
+
+def test_invalidations_do_not_grow_the_cache(explorer):
+    cache = PositionCache(maxsize=2)
+    for board_id in range(1000):
+        cache.invalidate(explorer.db, board_id)
+    cache.clear(explorer.db)
+    assert len(cache._generations) == 1
+    assert cache.get(explorer.db, board(explorer, 4)) is cache.cached(explorer.db, 4)
@@ -0,0 +1,41 @@
+import chess
+import mongomock
+
+import migrations
+from explorer import position_hash
+
+
+def test_hash_ignores_the_move_counters():
+    board = chess.Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1")
+    other = chess.Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 5 9")
+    assert position_hash(board) == position_hash(other)
+    assert position_hash(board) != position_hash(chess.Board())
+
+
+def test_hash_fits_a_signed_64_bit_integer():
+    for fen in (chess.STARTING_FEN, "8/8/8/8/8/8/8/K6k w - - 0 1", "r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1"):
+        assert -2**63 <= position_hash(chess.Board(fen)) < 2**63
+
+
+def test_transposition_reaches_the_same_position(explorer):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    for uci in ("g1f3", "b8c6", "e2e4", "e7e5"):
+        explorer.push(chess.Move.from_uci(uci))
+    assert explorer.board.board_id == 4
+
+
+def test_merge_duplicate_positions():
+    db = mongomock.MongoClient().test
+    board = chess.Board()
+    board.push_uci("e2e4")
+    fen = board.fen()
+    db.positions.insert_many([{"BoardId": 0, "fen": chess.STARTING_FEN},
+                              {"BoardId": 1, "fen": fen},
+                              {"BoardId": 2, "fen": fen.replace(" 0 1", " 4 7")}])
+    db.moves.insert_many([{"_id": 1, "board_start": 0, "board_end": 1, "move": "e2e4", "opening": [0]},
+                          {"_id": 2, "board_start": 0, "board_end": 2, "move": "e2e4", "opening": [1]}])
+    assert migrations.merge_duplicate_positions(db) == (1, 1)
+    assert [pos["BoardId"] for pos in db.positions.find()] == [0, 1]
+    assert db.positions.find_one({"BoardId": 1})["hash"] == position_hash(board)
+    assert list(db.moves.find({}, {"_id": 0})) == [{"board_start": 0, "board_end": 1, "move": "e2e4",
+                                                    "opening": [0, 1]}]
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+import chess
+import pytest
+
+from explorer import BoardNode, Move, position_hash
+
+
+def test_records_have_no_instance_dict():
+    with pytest.raises(AttributeError):
+        Move("e2e4", 0, 1).extra = 1
+    with pytest.raises(AttributeError):
+        BoardNode(chess.STARTING_FEN, 0).extra = 1
+
+
+def test_board_node_hash_and_color_are_derived_from_the_fen():
+    board = chess.Board()
+    board.push_uci("e2e4")
+    node = next(BoardNode.from_mongodb([{"fen": board.fen(), "BoardId": 1}]))
+    assert node.color == "b"
+    assert node.hash == position_hash(board)
+
+
+def test_review_state_is_decoded_on_use():
+    reviewed = datetime(2024, 2, 1, 8)
+    move = next(Move.from_mongodb([{"_id": 7, "move": "e2e4", "board_start": 0, "board_end": 1,
+                                    "opening": (0, 1), "san": "e4",
+                                    "date_last_reviewed": int(reviewed.timestamp()),
+                                    "days_between_reviews": 2}]))
+    assert move.opening == [0, 1] and move.doc_id == 7
+    assert move.date_last_reviewed == reviewed
+    assert move.date_due == reviewed + timedelta(days=2)
+    assert move.difficulty == 0.3
+
+
+def test_update_performance_keeps_fractions_of_days():
+    move = Move("e2e4", 0, 1, [0], doc_id=3)
+    assert move.needs_review and move.date_due is None
+    now = datetime.now()
+    assert move.update_performance(0.4, now, timedelta(hours=12))
+    assert move.date_due == now + timedelta(hours=12)
+    assert not move.update_performance(0.4, now, timedelta(days=1))
+    find, fields = move.performance_update()
+    assert find == {"_id": 3}
+    assert fields == {"difficulty": 0.4, "date_last_reviewed": now, "days_between_reviews": 0.5,
+                      "date_due": now + timedelta(hours=12)}
+
+
+def test_performance_update_without_id():
+    find, _ = Move("e2e4", 0, 1).performance_update()
+    assert find == {"board_start": 0, "board_end": 1}
@@ -0,0 +1,60 @@
+import chess
+
+
+def test_remove_move_removes_its_subtree(explorer):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    removed = explorer.remove_move(4, "f1b5")
+    assert removed == {"moves": 3, "positions": 3}
+    assert explorer.board.board_id == 4
+    assert [move.uci for move in explorer.repertoire.moves_from(4)] == ["f1c4"]
+    assert explorer.db.find_positions([5, 9, 10]) == []
+    assert len(explorer.db.find_moves(opening=0)) == 7
+
+
+def test_remove_last_move(explorer):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(8)
+    explorer.push(chess.Move.from_uci("g8f6"))
+    assert explorer.remove_last_move() == {"moves": 1, "positions": 1}
+    assert explorer.board.board_id == 8
+    assert explorer.repertoire.moves_from(8) == []
+
+
+def test_moves_of_other_openings_are_kept(explorer):
+    explorer.opening = {"name": "Caro-Kann", "color": "Black"}
+    removed = explorer.remove_move(0, "e2e4")
+    # e4 is part of the Italian as well, only the opening is taken from it
+    assert removed == {"moves": 0, "positions": 0}
+    assert explorer.repertoire.find_move(0, "e2e4") is not None
+
+
+def test_remove_opening(explorer):
+    removed = explorer.remove_opening("Caro-Kann", "Black")
+    assert removed == {"moves": 7, "positions": 7}
+    assert explorer.db.find_opening("Caro-Kann", "Black") is None
+    assert explorer.repertoire.find_move(0, "e2e4").opening == [0]
+    assert explorer.db.find_moves(board_start=0)[0]["opening"] == [0]
+    assert len(explorer.db.find_moves()) == 10
+
+
+def test_remove_opening_does_not_scan_the_repertoire(explorer):
+    class Unscannable(dict):
+        def values(self):
+            raise AssertionError("every move of the repertoire was visited")
+
+    explorer.repertoire._moves = Unscannable(explorer.repertoire._moves)
+    removed = explorer.remove_opening("Caro-Kann", "Black")
+    assert removed == {"moves": 7, "positions": 7}
+    assert 1 not in explorer.repertoire._opening_moves
+    assert explorer.repertoire.find_move(0, "e2e4").opening == [0]
+
+
+def test_opening_index_follows_inserts_and_removes(explorer):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    assert len(explorer.repertoire._opening_moves[0]) == 10
+    explorer.goto(8)
+    explorer.push(chess.Move.from_uci("g8f6"))
+    assert (8, "g8f6") in explorer.repertoire._opening_moves[0]
+    explorer.remove_last_move()
+    assert (8, "g8f6") not in explorer.repertoire._opening_moves[0]
+    assert explorer.remove_opening("Italian", "White") == {"moves": 9, "positions": 9}
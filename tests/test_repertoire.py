@@ -0,0 +1,66 @@
+import chess
+
+from explorer import Repertoire
+
+
+def push(explorer, *moves):
+    return [explorer.push(chess.Move.from_uci(move)) for move in moves]
+
+
+def test_navigation_does_not_read_the_db(explorer, monkeypatch):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    for method in ("find_positions", "find_moves"):
+        monkeypatch.setattr(explorer.db, method, None)
+    assert push(explorer, "e2e4", "e7e5") == ["e4", "e5"]
+    assert explorer.candidate_moves == {"major": ["Nf3"], "minor": []}
+    explorer.previous()
+    assert explorer.candidate_moves == {"major": ["e5"], "minor": ["c6"]}
+    assert explorer.next() == "e5"
+    assert explorer.board.board_id == 2
+
+
+def test_new_moves_are_written_through(explorer, client):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    push(explorer, "e2e4", "e7e5", "d2d4")
+    board_id = explorer.board.board_id
+    assert explorer.repertoire.find_move(2, "d2d4").to_id == board_id
+    stored = explorer.db.find_moves(board_start=2, board_end=board_id)
+    assert [(move["san"], move["opening"], move["color"]) for move in stored] == [("d4", [0], False)]
+    reloaded = Repertoire(explorer.db)
+    assert reloaded.position(board_id).fen == explorer.board.fen
+    assert reloaded.find_move(2, "d2d4").san == "d4"
+
+
+def test_existing_move_joins_the_opening(explorer):
+    explorer.opening = {"name": "Caro-Kann", "color": "Black"}
+    push(explorer, "e2e4", "e7e5")
+    assert sorted(explorer.repertoire.find_move(1, "e7e5").opening) == [0, 1]
+    assert sorted(explorer.db.find_moves(board_start=1, board_end=2)[0]["opening"]) == [0, 1]
+
+
+def test_openings_at(explorer):
+    assert explorer.repertoire.openings_at(1) == {0, 1}
+    assert explorer.repertoire.openings_at(4) == {0}
+
+
+def test_tree_window(explorer):
+    tree = explorer.tree(1, root=1, depth=2)
+    assert set(tree["positions"]) == {1, 1001, 1002}
+    assert [1, 2, "e7e5", "e5", 0] in tree["edges"]
+    assert [1, 1001, "c7c6", "c6", 1] in tree["edges"]
+
+
+def test_candidate_moves_use_the_stored_san(explorer, monkeypatch):
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(4)
+    monkeypatch.setattr(explorer.repertoire.boards, "get", None)
+    assert sorted(explorer.candidate_moves["major"]) == ["Bb5", "Bc4"]
+
+
+def test_moves_without_san_get_it_computed_once(explorer):
+    move = explorer.repertoire.find_move(4, "f1c4")
+    move.san = None
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(4)
+    assert "Bc4" in explorer.candidate_moves["major"]
+    assert move.san == "Bc4"
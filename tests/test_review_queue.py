@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import chess
+
+from explorer import BoardNode, Move, ReviewQueue
+
+WHITE = BoardNode(chess.Board().fen(), 0)
+NOW = datetime(2024, 5, 1)
+
+
+def move(from_id, to_id, reviewed_days_ago=None, interval=3):
+    date_last_reviewed = None if reviewed_days_ago is None else NOW - timedelta(days=reviewed_days_ago)
+    return Move("e2e4", from_id, to_id, [0], date_last_reviewed=date_last_reviewed,
+                days_between_reviews=interval)
+
+
+def test_moves_are_popped_in_order_of_their_due_date():
+    queue = ReviewQueue()
+    queue.fill([(WHITE, move(0, 1, 5)), (WHITE, move(0, 2)), (WHITE, move(0, 3, 4)), (WHITE, move(0, 4, 1))])
+    popped = []
+    while True:
+        board, due = queue.pop("w", NOW)
+        if due is None:
+            break
+        popped.append(due.to_id)
+    # Never reviewed first, the move which is not due yet stays in the queue
+    assert popped == [2, 1, 3]
+    assert len(queue) == 1
+    assert queue.pop("b", NOW) == (None, None)
+
+
+def test_peek_does_not_change_the_queue():
+    queue = ReviewQueue()
+    queue.fill([(WHITE, move(0, i, 10-i)) for i in range(1, 6)])
+    assert [m.to_id for _, m in queue.peek("w", 3, NOW)] == [1, 2, 3]
+    assert [queue.pop("w", NOW)[1].to_id for _ in range(3)] == [1, 2, 3]
+
+
+def test_pushed_move_moves_to_its_new_due_date():
+    queue = ReviewQueue()
+    first, second = move(0, 1, 5), move(0, 2, 4)
+    queue.fill([(WHITE, first), (WHITE, second)])
+    board, popped = queue.pop("w", NOW)
+    assert popped is first and queue.popped == [(0, 1)]
+    first.update_performance(0.3, datetime.now(), timedelta(days=0))
+    queue.push(board, first)
+    assert queue.popped == []
+    assert queue.pop("w", NOW)[1] is second
+    assert queue.pop("w", datetime.now() + timedelta(seconds=1))[1] is first
+
+
+def test_discard_restores_a_queue():
+    queue = ReviewQueue()
+    queue.fill([(WHITE, move(0, i)) for i in range(1, 4)])
+    queue.discard([[0, 1], [0, 3]])
+    assert sorted(queue.popped) == [(0, 1), (0, 3)]
+    assert queue.pop("w", NOW)[1].to_id == 2
+    assert queue.get((0, 3))[1].to_id == 3
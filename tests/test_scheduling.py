@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import scheduling
+
+
+def test_priority_of_zero_day_intervals_is_finite():
+    now = datetime(2024, 1, 10)
+    schedule = scheduling.ReviewSchedule([
+        {"_id": 1, "difficulty": 0.8, "date_last_reviewed": now - timedelta(hours=5), "days_between_reviews": 0},
+        {"_id": 2, "difficulty": 0.3, "date_last_reviewed": now, "days_between_reviews": 0},
+        {"_id": 3, "difficulty": 0.3, "date_last_reviewed": None, "days_between_reviews": 3}])
+    weights = scheduling.priority(schedule.difficulty, schedule.overdue(now))
+    assert np.all(np.isfinite(weights))
+    assert weights[0] == scheduling.MAX_OVERDUE*1.3
+    assert weights[2] == 2*0.8
+
+
+def test_priority_is_never_zero():
+    weights = scheduling.priority([0, 0.5], [0, -1])
+    assert np.all(weights == scheduling.MIN_PRIORITY)
+
+
+def test_review_of_arrays_matches_single_moves():
+    difficulty = [0.3, 0.5, 0.9, 0.1]
+    interval = [3, 10, 1, 0]
+    since = [float("nan"), 12, 0, 4]
+    performance = [True, True, False, True]
+    arrays = scheduling.review(difficulty, interval, since, performance)
+    for i in range(4):
+        single = scheduling.review(difficulty[i], interval[i], since[i], performance[i])
+        assert arrays[0][i] == pytest.approx(float(single[0]))
+        assert arrays[1][i] == pytest.approx(float(single[1]))
+
+
+def test_wrong_answer_shortens_the_interval():
+    difficulty, days = scheduling.review(0.3, 10, 10, False)
+    assert difficulty > 0.3 and days <= 1
+    difficulty, days = scheduling.review(0.3, 10, 10, True)
+    assert difficulty < 0.3 and days > 10
+
+
+NOW = datetime(2024, 1, 10, 12)
+
+
+@pytest.fixture
+def schedule():
+    return scheduling.ReviewSchedule([
+        {"_id": 1, "color": False, "date_last_reviewed": NOW - timedelta(days=5), "days_between_reviews": 3},
+        {"_id": 2, "color": False, "date_last_reviewed": NOW - timedelta(days=1), "days_between_reviews": 3},
+        {"_id": 3, "color": True},
+        {"_id": 4, "color": False, "date_last_reviewed": NOW, "days_between_reviews": 10}])
+
+
+def test_due_and_forecast(schedule):
+    assert schedule.due(NOW).tolist() == [True, False, True, False]
+    assert schedule.due(NOW, color=False).tolist() == [True, False, False, False]
+    assert schedule.forecast(12, NOW).tolist() == [2, 0, 1] + [0]*7 + [1, 0]
+
+
+def test_summary(schedule):
+    summary = schedule.summary(3, NOW, color=False)
+    assert (summary["moves"], summary["due"], summary["never_reviewed"]) == (3, 1, 0)
+    assert summary["mean_overdue"] == pytest.approx((5/3 + 1/3 + 0)/3)
+    assert summary["forecast"] == [1, 0, 1]
+
+
+def test_review_and_write(explorer):
+    db = explorer.db
+    schedule = scheduling.ReviewSchedule.from_db(db, 0)
+    schedule.review(True, now=NOW)
+    assert schedule.write(db, batch_size=3) == 10
+    moves = db.find_moves(opening=0)
+    assert all(move["date_due"] == NOW + timedelta(days=move["days_between_reviews"]) for move in moves)
+    assert not scheduling.ReviewSchedule.from_db(db, 0).due(NOW).any()
+
+
+def test_intervals_grow_again_after_wrong_answers():
+    difficulty, days = 0.3, 3
+    intervals = []
+    for performance in (False, False, True, True, True, True):
+        difficulty, days = scheduling.review(difficulty, days, days, performance)
+        intervals.append(float(days))
+    assert min(intervals) >= scheduling.MIN_DAYS_BETWEEN_REVIEWS
+    assert intervals[2:] == sorted(set(intervals[2:]))
+    assert intervals[-1] > intervals[1]
+
+
+def test_schedule_keeps_fractions_of_days():
+    now = datetime(2024, 1, 10)
+    schedule = scheduling.ReviewSchedule([
+        {"_id": 1, "date_last_reviewed": now - timedelta(hours=18), "days_between_reviews": 0.5}])
+    schedule.review(True, now=now)
+    assert schedule.days_between_reviews[0] > 0.5 and schedule.days_between_reviews[0] % 1
@@ -0,0 +1,126 @@
+import chess
+import mongomock
+import pytest
+
+from explorer import BoardNode, Move, Repertoire, position_hash, variation_trees
+from sessions import SessionPool, SessionStore
+
+
+@pytest.fixture
+def store():
+    return SessionStore(mongomock.MongoClient().sessions.sessions)
+
+
+@pytest.fixture
+def pool(explorer, client, store):
+    pool = SessionPool("test", client, flush_policy="session", store=store)
+    yield pool
+    pool.close()
+
+
+def answer(session):
+    trainer = session.trainer
+    trainer.change_opening(0)
+    trainer.complete_opening()
+    trainer.next()
+    trainer.update_move_performance(True)
+
+
+def test_release_keeps_buffered_updates(pool):
+    session = pool.acquire("a")
+    answer(session)
+    pool.release(session)
+    assert len(session.trainer.performance) == 1
+    assert all("date_last_reviewed" not in move for move in session.trainer.db.find_moves())
+
+
+def test_unchanged_state_is_not_saved_again(pool, store):
+    session = pool.acquire("a")
+    pool.release(session)
+    version = store.load("a")[0]
+    session = pool.acquire("a")
+    pool.release(session)
+    assert store.load("a")[0] == version == session.version
+
+
+def test_state_is_restored_by_another_pool(pool, explorer, client, store):
+    session = pool.acquire("a")
+    answer(session)
+    pool.release(session)
+    other = SessionPool("test", client, store=store)
+    restored = other.acquire("a")
+    assert restored.trainer.opening == 0
+    assert restored.trainer.queue.popped == session.trainer.queue.popped
+    other.release(restored)
+    other.close()
+
+
+def test_eviction_writes_buffered_updates(pool):
+    session = pool.acquire("a")
+    answer(session)
+    pool.release(session)
+    assert pool.close() == 1
+    assert len(pool) == 0
+    reviewed = [move for move in session.trainer.db.find_moves() if "date_last_reviewed" in move]
+    assert len(reviewed) == 1
+
+
+def test_least_recently_used_sessions_are_evicted(explorer, client):
+    pool = SessionPool("test", client, maxsize=2)
+    for session_id in ("a", "b", "a", "c"):
+        pool.release(pool.acquire(session_id))
+    assert sorted(pool._sessions) == ["a", "c"]
+    pool.close()
+
+
+def test_idle_sessions_are_evicted(explorer, client):
+    pool = SessionPool("test", client, max_idle=60)
+    session = pool.acquire("a")
+    pool.release(session)
+    session.last_used -= 120
+    assert pool.evict() == 1 and len(pool) == 0
+
+
+def test_sessions_in_use_are_not_evicted(explorer, client):
+    pool = SessionPool("test", client, max_idle=0)
+    session = pool.acquire("a")
+    assert pool.evict() == 0
+    pool.release(session)
+    pool.close()
+
+
+def test_explorer_state_round_trip(pool, client, store):
+    session = pool.acquire("a")
+    session.explorer.opening = {"name": "Italian", "color": "White"}
+    session.explorer.goto(4)
+    session.explorer.push(chess.Move.from_uci("f1c4"))
+    session.explorer.previous()
+    pool.release(session)
+    other = SessionPool("test", client, store=store)
+    restored = other.acquire("a")
+    assert (restored.explorer.opening, restored.explorer.board.board_id) == (0, 4)
+    assert restored.explorer.next() == "Bc4"
+    other.release(restored)
+    other.close()
+
+
+def test_acquire_loads_the_changes_of_another_worker(pool):
+    session = pool.acquire("a")
+    session.explorer.opening = {"name": "Italian", "color": "White"}
+    session.explorer.goto(2)
+    db = session.explorer.db
+    variation_trees.get(db, 0)
+    pool.release(session)
+
+    other = Repertoire(db)
+    board = chess.Board()
+    for uci in ("e2e4", "e7e5", "d2d4"):
+        board.push_uci(uci)
+    node = other.insert_position(BoardNode(board.fen(), other.board_ids.next(), position_hash(board)))
+    other.insert_move(Move("d2d4", 2, node.board_id, [0], san="d4"), False)
+
+    session = pool.acquire("a")
+    assert session.explorer.board.board_id == 2
+    assert session.explorer.candidate_moves["major"] == ["Nf3", "d4"]
+    assert (db.name, 0) not in variation_trees._trees
+    pool.release(session)
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+import chess
+import chess.polyglot
+
+import snapshot
+
+
+def italian_board(*ucis):
+    board = chess.Board()
+    for uci in ucis:
+        board.push_uci(uci)
+    return board
+
+
+def test_export_and_lookup(explorer, tmp_path):
+    path = str(tmp_path / "italian.bin")
+    assert snapshot.export(explorer.db, path, opening=0) == 10
+    with snapshot.Snapshot(path) as book:
+        assert len(book) == 10
+        board = italian_board("e2e4", "e7e5", "g1f3", "b8c6")
+        assert sorted(move.uci() for move, _ in book.moves(board)) == ["f1b5", "f1c4"]
+        assert board in book and chess.Board() in book
+        assert italian_board("d2d4") not in book
+        _, review = book.moves(chess.Board())[0]
+        assert (review["board_start"], review["board_end"]) == (0, 1)
+
+
+def test_book_is_readable_by_polyglot_readers(explorer, tmp_path):
+    path = str(tmp_path / "repertoire.bin")
+    assert snapshot.export(explorer.db, path) == 17
+    with chess.polyglot.open_reader(path) as reader:
+        moves = sorted(entry.move.uci() for entry in reader.find_all(italian_board("e2e4")))
+    assert moves == ["c7c6", "e7e5"]
+
+
+def test_due_moves_of_a_position(explorer, tmp_path):
+    now = datetime.now()
+    explorer.db.update_moves([({"board_start": 4, "board_end": 5},
+                               {"date_last_reviewed": now, "days_between_reviews": 3})])
+    path = str(tmp_path / "italian.bin")
+    snapshot.export(explorer.db, path, opening=0)
+    with snapshot.Snapshot(path) as book:
+        board = italian_board("e2e4", "e7e5", "g1f3", "b8c6")
+        assert [move.uci() for move in book.due(board, now)] == ["f1c4"]
+        assert len(book.due(board, now + timedelta(days=4))) == 2
+
+
+def test_castling_is_encoded_as_king_captures_rook():
+    fen = "r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1"
+    assert snapshot.encode_move("e1g1", fen) == snapshot.encode_move("e1h1", fen)
+    assert snapshot.encode_move("e1g1", "8/8/8/8/8/8/8/4Q2K w - - 0 1") != snapshot.encode_move("e1h1", fen)
@@ -0,0 +1,216 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import chess
+import mongomock
+import pytest
+
+from explorer import Explorer, IdAllocator, Repertoire
+from storage import AsyncStorage, DuplicatePositionError, MemoryClient, SQLiteClient, create_client
+
+
+@pytest.fixture(params=["memory", "sqlite", "mongodb"])
+def client(request, tmp_path):
+    if request.param == "memory":
+        return MemoryClient()
+    if request.param == "sqlite":
+        return SQLiteClient(str(tmp_path))
+    return mongomock.MongoClient()
+
+
+@pytest.fixture
+def db(explorer):
+    return explorer.db
+
+
+def test_opening_statistics(db):
+    statistics = db.opening_statistics({0: False, 1: True}, datetime.now())
+    assert statistics[0] == {"moves": 10, "positions": 11, "due": 6, "difficulty": pytest.approx(0.3), "depth": 7}
+    assert statistics[1] == {"moves": 8, "positions": 9, "due": 4, "difficulty": pytest.approx(0.3), "depth": 6}
+    assert 2 not in db.opening_statistics({2: False}, datetime.now())
+
+
+def test_opening_statistics_count_only_due_moves_of_the_trainee(db):
+    now = datetime.now()
+    reviewed = [({"_id": move["_id"]}, {"date_last_reviewed": now, "days_between_reviews": 3,
+                                        "date_due": now + timedelta(days=3), "difficulty": 0.6})
+                for move in db.find_moves(opening=1)]
+    db.update_moves(reviewed[:2])
+    statistics = db.opening_statistics({1: True}, now)[1]
+    due = [move for move in db.find_moves(opening=1) if move["color"] and "date_due" not in move]
+    assert statistics["due"] == len(due)
+    assert statistics["difficulty"] == pytest.approx((6*0.3 + 2*0.6)/8)
+
+
+def test_statistics_cache_uses_the_trainee_color(explorer):
+    statistics = explorer.openings()["statistics"]
+    assert statistics["White"]["Italian"]["due"] == 6
+    assert statistics["Black"]["Caro-Kann"]["due"] == 4
+
+
+def test_moves_from(db):
+    moves = list(db.moves_from([4, 1001], [0]))
+    assert sorted((move["board_start"], move["board_end"]) for move in moves) == [(4, 5), (4, 6)]
+    assert len(list(db.moves_from([1]))) == 2
+
+
+def test_reserved_ids_start_after_the_ids_in_use(db):
+    end = db.reserve_ids("positions", "BoardId", 10, first=1)
+    assert end - 10 > max(position["BoardId"] for position in db.find_positions())
+    assert db.reserve_ids("positions", "BoardId", 5, first=1) == end + 5
+    assert db.reserve_ids("opening", "id", 1) == 3
+
+
+def test_parallel_allocators_hand_out_unique_ids(db):
+    allocators = [IdAllocator(db, "positions", "BoardId", first=1, block_size=7) for _ in range(4)]
+    ids = []
+
+    def allocate(allocator):
+        for _ in range(50):
+            ids.append(allocator.next())
+    threads = [threading.Thread(target=allocate, args=(allocator,)) for allocator in allocators]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 200
+
+
+def test_sample_moves(db):
+    sample = list(db.sample_moves(0, False, 4))
+    assert len(sample) == 4
+    for move in sample:
+        assert move["color"] is False and 0 in move["opening"]
+        assert [position["BoardId"] for position in move["position"]] == [move["board_start"]]
+    assert len(list(db.sample_moves(0, False, 100))) == 6
+
+
+def test_find_moves(db):
+    moves = db.find_moves(opening=0, board_start=4, fields=("move", "san"))
+    assert sorted((move["move"], move["san"]) for move in moves) == [("f1b5", "Bb5"), ("f1c4", "Bc4")]
+    assert all(set(move) == {"_id", "move", "san"} for move in moves)
+    assert [move["move"] for move in db.find_moves(board_end=1001)] == ["c7c6"]
+
+
+def test_variation_only_follows_reachable_moves(db):
+    db.insert_moves([{"board_start": 500, "board_end": 501, "move": "a2a3", "san": "a3",
+                      "color": False, "opening": [0]}])
+    assert len(db.variation(0)) == 10
+    assert sorted(move["move"] for move in db.variation(0, root=5)) == ["a7a6", "b5a4"]
+
+
+def test_add_and_pull_opening(db):
+    db.add_opening([(4, "f1c4"), (6, "f8c5")], 1)
+    assert sorted(move["board_end"] for move in db.find_moves(opening=1) if move["board_end"] < 1000) == [1, 6, 7]
+    db.pull_opening(1)
+    assert list(db.find_moves(opening=1)) == []
+    assert len(list(db.find_moves(opening=0))) == 10
+
+
+def test_delete_and_update_moves(db):
+    ids = [move["_id"] for move in db.find_moves(board_start=4)]
+    db.update_moves([({"board_start": 4, "board_end": 5}, {"difficulty": 0.7})])
+    assert db.find_moves(board_end=5)[0]["difficulty"] == 0.7
+    db.delete_moves(ids)
+    assert list(db.find_moves(board_start=4)) == []
+    db.delete_positions([5, 6])
+    assert [position["BoardId"] for position in db.find_positions([4, 5, 6])] == [4]
+
+
+def test_openings(db):
+    assert db.find_opening("Italian", "White")["id"] == 0
+    assert db.find_opening(id=1)["name"] == "Caro-Kann"
+    assert [opening["name"] for opening in db.find_openings("Black")] == ["Caro-Kann"]
+    revision = db.find_opening(id=0)["revision"]
+    db.touch_openings([0])
+    assert db.find_opening(id=0)["revision"] == revision + 1
+    db.delete_opening("Caro-Kann", "Black")
+    assert db.find_opening("Caro-Kann", "Black") is None
+
+
+def test_async_storage(db):
+    async def read():
+        async_db = AsyncStorage(db)
+        moves, positions = await asyncio.gather(async_db.find_moves(opening=0), async_db.find_positions([0, 1]))
+        return moves, positions
+    moves, positions = asyncio.run(read())
+    assert len(moves) == 10 and len(positions) == 2
+
+
+def test_create_client(tmp_path):
+    assert isinstance(create_client("memory"), MemoryClient)
+    client = create_client("sqlite:" + str(tmp_path))
+    db = client["user"]
+    db.insert_positions([{"BoardId": 0, "fen": "fen", "hash": 1}])
+    assert client["user"] is db
+    db.close()
+    assert SQLiteClient(str(tmp_path))["user"].find_positions() == [{"BoardId": 0, "fen": "fen", "hash": 1}]
+
+
+def test_due_moves_pages(db):
+    now = datetime.now()
+    white = [move for move in db.find_moves() if move["color"] is False]
+    db.update_moves([({"_id": move["_id"]}, {"date_last_reviewed": now - timedelta(days=10), "days_between_reviews": 3,
+                                             "date_due": now - timedelta(days=7-i)})
+                     for i, move in enumerate(white[:3])])
+    db.update_moves([({"_id": white[3]["_id"]}, {"date_due": now + timedelta(days=1)})])
+    pages = []
+    after = None
+    while True:
+        page = list(db.due_moves([0, 1], False, now, after, limit=2))
+        pages.append([move["_id"] for move in page])
+        if len(page) < 2:
+            break
+        after = (page[-1].get("date_due"), page[-1]["_id"])
+    due = [move_id for page in pages for move_id in page]
+    never_reviewed = sorted(move["_id"] for move in white[4:])
+    assert due == never_reviewed + [move["_id"] for move in white[:3]]
+
+
+def worker(client):
+    """Explorer of another worker process, which loads its own repertoire."""
+    Repertoire._loaded.clear()
+    other = Explorer("test", client=client)
+    other.opening = {"name": "Italian", "color": "White"}
+    return other
+
+
+def test_repertoire_revision(db):
+    revision = db.repertoire_revision()
+    assert revision > 0
+    assert db.touch_repertoire() == revision + 1 == db.repertoire_revision()
+
+
+def test_positions_are_unique(db):
+    db.ensure_indexes()
+    existing = db.find_positions([1])[0]
+    with pytest.raises(DuplicatePositionError) as err:
+        db.insert_positions([{"BoardId": 100, "fen": existing["fen"], "hash": existing["hash"]},
+                             {"BoardId": 101, "fen": "8/8/8/8/8/8/8/K1k5 w - - 0 1", "hash": 12345}])
+    assert err.value.hashes == [existing["hash"]]
+    assert [pos["BoardId"] for pos in db.find_positions([100, 101])] == [101]
+
+
+def test_workers_load_the_moves_of_other_workers(explorer, client):
+    other = worker(client)
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(2)
+    explorer.push(chess.Move.from_uci("d2d4"))
+    assert other.repertoire.stale()
+    assert other.repertoire.find_move(2, "d2d4") is None
+    other.refresh()
+    assert other.repertoire.find_move(2, "d2d4").to_id == explorer.board.board_id
+    assert not other.repertoire.stale() and not explorer.repertoire.stale()
+
+
+def test_position_inserted_by_another_worker(explorer, client):
+    explorer.db.ensure_indexes()
+    other = worker(client)
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(2)
+    explorer.push(chess.Move.from_uci("d2d4"))
+    other.goto(2)
+    assert other.push(chess.Move.from_uci("d2d4")) == "d4"
+    assert other.board.board_id == explorer.board.board_id
+    assert len(list(explorer.db.find_moves(board_start=2))) == 2
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import scheduling
+from explorer import Trainer
+
+
+@pytest.fixture
+def trainer(explorer, client):
+    trainer = Trainer("test", client=client)
+    trainer.change_opening(0)
+    yield trainer
+    trainer.close()
+
+
+def test_weighted_random_position_with_zero_day_intervals(trainer):
+    trainer.db.update_moves([({"_id": move["_id"]}, {"date_last_reviewed": datetime.now(),
+                                                      "days_between_reviews": 0})
+                             for move in trainer.db.find_moves(opening=0)])
+    for _ in range(10):
+        board, move = trainer.random_position(weighted=True)
+        assert 0 in move.opening and board.color == "w"
+
+
+def test_weighted_random_position_without_weights(trainer, monkeypatch):
+    monkeypatch.setattr(scheduling, "priority", lambda difficulty, overdue: difficulty*0)
+    board, move = trainer.random_position(weighted=True)
+    assert board.board_id == move.from_id
+
+
+def test_random_position_of_the_trainee(trainer):
+    for weighted in (False, True):
+        board, move = trainer.random_position(weighted)
+        assert board.color == "w" and board.board_id == move.from_id
+        assert trainer.last_move is move
+
+
+def test_random_position_of_an_empty_opening(trainer):
+    trainer.change_opening(5)
+    assert trainer.random_position(True) == (None, None)
+
+
+def test_wrong_wrong_correct_answers(trainer):
+    _, move = trainer.random_position()
+    intervals = []
+    for performance in (False, False, True, True, True, True):
+        move._date_last_reviewed = datetime.now() - move.days_between_reviews - timedelta(seconds=1)
+        assert trainer.update_move_performance(performance)
+        intervals.append(move.days_between_reviews)
+    assert min(intervals) > timedelta(0)
+    assert intervals[2:] == sorted(set(intervals[2:]))
+    trainer.performance.flush()
+    stored, = [document["days_between_reviews"] for document in trainer.db.find_moves(board_start=move.from_id)
+               if document["move"] == move.uci]
+    assert stored == pytest.approx(intervals[-1].total_seconds()/scheduling.SECONDS_PER_DAY)
@@ -0,0 +1,38 @@
+import io
+
+import chess
+
+from explorer import VariationTree, variation_trees
+
+TRANSPOSITION = "1. e4 (1. Nf3 Nc6 2. e4 e5 3. Bb5) 1... e5 2. Nf3 Nc6 3. Bc4 *"
+
+
+def test_every_move_is_traversed_once(explorer):
+    tree = VariationTree.from_db(explorer.db, 0)
+    moves = [move for _, move in tree.traverse()]
+    assert len(moves) == 10
+    assert len(set((move.from_id, move.to_id) for move in moves)) == 10
+    for board, move in tree.traverse():
+        assert board.board_id == move.from_id
+
+
+def test_transpositions_are_expanded_once(explorer):
+    explorer.add_opening("Transposition", "White")
+    explorer.opening = {"name": "Transposition", "color": "White"}
+    explorer.import_pgn(io.StringIO(TRANSPOSITION))
+    tree = VariationTree.from_db(explorer.db, explorer.opening)
+    moves = [move.san for _, move in tree.traverse()]
+    assert sorted(moves) == sorted(["e4", "e5", "Nf3", "Nc6", "Bc4", "Nf3", "Nc6", "e4", "e5", "Bb5"])
+    # Bb5 and Bc4 are played from the same position, which is only expanded once
+    assert len(set(move.from_id for _, move in tree.traverse() if move.san in ("Bb5", "Bc4"))) == 1
+
+
+def test_cached_tree_is_patched_by_the_explorer(explorer):
+    tree = variation_trees.get(explorer.db, 0)
+    assert variation_trees.get(explorer.db, 0) is tree
+    explorer.opening = {"name": "Italian", "color": "White"}
+    explorer.goto(8)
+    explorer.push(chess.Move.from_uci("g8f6"))
+    assert [move.san for _, move in tree.traverse()][-1] == "Nf6"
+    variation_trees.invalidate(explorer.db, 0)
+    assert variation_trees.get(explorer.db, 0) is not tree